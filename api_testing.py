@@ -1,6 +1,35 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
 import unittest
+import warnings
 
-from blurring_faces import FaceTracksFinder, remove_noise_from_tracks
+import cv2
+import numpy as np
+
+from blurring_faces import (FaceTracksFinder, remove_noise_from_tracks, detect_frames, iterate_frames, open_video,
+                            blur_faces, track_cache_parameters, BLUR_FILL)
+from boxes import box_iou
+from track_cache import TrackCache
+from track_store import TrackStore, DetectedObject
+from track_postprocessing import TrackPostprocessor
+from batch_jobs import BatchJob, output_paths, run_batch
+from checkpoint import CheckpointStore
+from chunked_tracking import ChunkTracks, stitch_chunk_tracks
+from detector_backends import load_detector, OnnxDetector, DETECTOR_ONNXRUNTIME, DETECTOR_OPENCV
+from detection import TiledDetector, crop_regions, map_crop_detections, non_maximum_suppression, tile_regions
+from streaming import LookaheadTrackFilter, follow_video_frames
+from detection_scheduling import AdaptiveDetectionScheduler, MotionGate
+from export import SegmentCache, VideoExporter, plan_passthrough, segment_signature
+from benchmark_suite import make_synthetic_video, StubDetector, StubImageEncoder, FACE_COLOR
+from profiling import Profiler, DISABLED_PROFILER
+from frame_cache import KeyframeIndex
+from frame_transport import SharedFrameRing, frame_ring_for, ring_frames
+from preview_rendering import FrameRing, PreviewQueue, letterbox, render_preview, view_to_frame
+from tracker import Tracker, TRACKING_IOU
 
 
 class TestDetector(unittest.TestCase):
@@ -39,3 +68,655 @@ class TestDetector(unittest.TestCase):
         for i in range(len(all_tracks)):
             assert tracks[i] is not None
 
+    def test_batched_detection(self):
+        single_tracks = list(FaceTracksFinder("full_faces.mp4"))
+        batched_finder = FaceTracksFinder("full_faces.mp4", batch_size=8)
+        batched_tracks = list(batched_finder)
+        all_tracks = batched_finder.get_face_tracks()
+        self.assertEqual(len(single_tracks), len(batched_tracks))
+        self.assertEqual(len(single_tracks), len(all_tracks))
+        for single, batched in zip(single_tracks, batched_tracks):
+            self.assertEqual([d.id for d in single], [d.id for d in batched])
+            for a, b in zip(single, batched):
+                np.testing.assert_allclose(a.bbox, b.bbox, atol=1e-3)
+
+    def test_shared_models(self):
+        face_detector = FaceTracksFinder("full_faces.mp4")
+        shared_detector = FaceTracksFinder("full_faces.mp4", detector=face_detector.detector,
+                                           image_encoder=face_detector.tracker.image_encoder)
+        self.assertIs(shared_detector.detector, face_detector.detector)
+        tracks = TrackStore.from_tracks(face_detector.get_face_tracks())
+        shared_tracks = TrackStore.from_tracks(shared_detector.get_face_tracks())
+        np.testing.assert_array_equal(tracks.ids, shared_tracks.ids)
+        np.testing.assert_array_equal(tracks.boxes, shared_tracks.boxes)
+
+    def test_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoints = CheckpointStore(checkpoint_dir, interval=5)
+            interrupted_detector = FaceTracksFinder("full_faces.mp4", checkpoints=checkpoints)
+            for _ in range(12):
+                next(interrupted_detector)
+            resumed_tracks = TrackStore.from_tracks(FaceTracksFinder("full_faces.mp4", checkpoints=checkpoints))
+            tracks = TrackStore.from_tracks(FaceTracksFinder("full_faces.mp4"))
+            np.testing.assert_array_equal(resumed_tracks.offsets, tracks.offsets)
+            np.testing.assert_array_equal(resumed_tracks.ids, tracks.ids)
+            np.testing.assert_allclose(resumed_tracks.boxes, tracks.boxes)
+            self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    @unittest.skipUnless(os.path.exists("best.onnx"), "needs the detector exported to best.onnx")
+    def test_detector_backends(self):
+        video_capture = cv2.VideoCapture("full_faces.mp4")
+        frames = [video_capture.read()[1] for _ in range(10)]
+        video_capture.release()
+        reference = load_detector("best.pt")(frames)
+        for backend in (DETECTOR_ONNXRUNTIME, DETECTOR_OPENCV):
+            detections = load_detector("best.onnx", backend)(frames)
+            for reference_boxes, boxes in zip(reference, detections):
+                reference_boxes = reference_boxes[reference_boxes[:, 4] > 0.5]
+                boxes = boxes[boxes[:, 4] > 0.5]
+                self.assertEqual(len(boxes), len(reference_boxes))
+                if len(boxes):
+                    self.assertTrue((box_iou(reference_boxes[:, :4], boxes[:, :4]).max(axis=1) > 0.9).all())
+                    np.testing.assert_allclose(np.sort(boxes[:, 4]), np.sort(reference_boxes[:, 4]), atol=0.05)
+
+    def test_fixed_input_size(self):
+        class FixedSizeDetector(OnnxDetector):
+            def run(self, blobs):
+                self.sizes.append(blobs.shape[2])
+                return np.zeros((len(blobs), 5, 0), dtype=np.float32)
+
+            def clone(self):
+                return self
+
+        self.assertRaises(TypeError, OnnxDetector, "model.onnx")
+        detector = FixedSizeDetector("model.onnx")
+        detector.fixed_input_size, detector.sizes = 640, []
+        frame = np.zeros((240, 320, 3), dtype=np.uint8)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            detector([frame], imgsz=640)
+        with self.assertWarns(RuntimeWarning):
+            detector([frame], imgsz=320)
+        self.assertEqual(detector.sizes, [640, 640])
+
+
+class TestTrackStore(unittest.TestCase):
+
+    def test_matches_face_tracks(self):
+        tracks = FaceTracksFinder("full_faces.mp4").get_face_tracks()
+        store = TrackStore.from_tracks(tracks)
+        self.assertEqual(len(store), len(tracks))
+        for frame_number, frame_tracks in enumerate(tracks):
+            ids, boxes = store.frame(frame_number)
+            self.assertEqual(ids.tolist(), [d.id for d in frame_tracks])
+            for detection, bbox in zip(frame_tracks, boxes):
+                np.testing.assert_array_equal(detection.bbox, bbox)
+                x1, y1, x2, y2 = detection.bbox
+                self.assertIn(detection.id, store.hit_test(frame_number, (x1 + x2) / 2, (y1 + y2) / 2))
+
+    def test_track_postprocessor(self):
+        tracks = [[DetectedObject(1, np.array([float(x), 0, x + 10, 10]))] if x != 3 else [] for x in range(6)]
+        tracks[5].append(DetectedObject(2, np.array([50., 50, 60, 60])))
+        store = TrackPostprocessor(min_track_length=2, max_gap=1)(tracks)
+        self.assertEqual(len(store), 6)
+        self.assertEqual([len(frame) for frame in store], [1, 1, 1, 1, 1, 1])
+        ids, boxes = store.frame(3)
+        self.assertEqual(ids.tolist(), [1])
+        np.testing.assert_allclose(boxes[0], [3, 0, 13, 10])
+
+
+class TestTrackCache(unittest.TestCase):
+
+    def test_track_cache(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            path_to_detector = os.path.join(work_dir, "stub.pt")
+            make_synthetic_video(path_to_video, 320, 240, 20, faces=2)
+            with open(path_to_detector, "wb") as file:
+                file.write(b"stub weights")
+            track_cache = TrackCache(os.path.join(work_dir, "cache"))
+            detector = StubDetector()
+            calls = []
+
+            def counting_detector(images, imgsz=None):
+                calls.append(len(images))
+                return detector(images, imgsz)
+
+            def find(detection_threshold=0.5):
+                return FaceTracksFinder(path_to_video, path_to_detector, detection_threshold, track_cache=track_cache,
+                                        tracking_mode=TRACKING_IOU, detector=counting_detector,
+                                        image_encoder=StubImageEncoder())
+
+            tracks = find().get_face_tracks()
+            self.assertEqual(len(calls), 20)
+            cached_tracks = find().get_face_tracks()
+            self.assertEqual(len(calls), 20)
+            self.assertIsInstance(cached_tracks, TrackStore)
+            self.assertEqual(len(cached_tracks), len(tracks))
+            for frame_number, frame_tracks in enumerate(tracks):
+                ids, boxes = cached_tracks.frame(frame_number)
+                self.assertEqual(ids.tolist(), [detected_object.id for detected_object in frame_tracks])
+                np.testing.assert_allclose(boxes, np.reshape([detected_object.bbox for detected_object in frame_tracks],
+                                                             (-1, 4)))
+
+            # Looking tracks up before a finder exists uses the key the finder stored them with
+            self.assertEqual(track_cache_parameters(0.5, TRACKING_IOU), find().cache_parameters())
+            self.assertIsNotNone(track_cache.load(path_to_video, path_to_detector,
+                                                  **track_cache_parameters(0.5, TRACKING_IOU)))
+            self.assertIsNone(track_cache.load(path_to_video, path_to_detector,
+                                               **track_cache_parameters(0.6, TRACKING_IOU)))
+            find(0.6).get_face_tracks()
+            self.assertEqual(len(calls), 40)
+
+            # Another video at the same path misses the cache
+            make_synthetic_video(path_to_video, 320, 240, 20, faces=2, seed=1)
+            self.assertIsNone(track_cache.load(path_to_video, path_to_detector,
+                                               **track_cache_parameters(0.5, TRACKING_IOU)))
+            find().get_face_tracks()
+            self.assertEqual(len(calls), 60)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_follow_video_frames(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 320, 240, 40, faces=2)
+            frames = list(iterate_frames(cv2.VideoCapture(path_to_video)))
+            for start_frame in (17, 39, 40, 45):
+                video_capture = open_video(path_to_video, start_frame)
+                ret, frame = video_capture.read()
+                video_capture.release()
+                self.assertEqual(ret, start_frame < len(frames))
+                if ret:
+                    np.testing.assert_array_equal(frame, frames[start_frame])
+            followed_frames = list(follow_video_frames(path_to_video, poll_interval=0, idle_timeout=0))
+        self.assertEqual(len(followed_frames), len(frames))
+        for followed_frame, frame in zip(followed_frames, frames):
+            np.testing.assert_array_equal(followed_frame, frame)
+
+    def test_lookahead_track_filter(self):
+        tracks = [[DetectedObject(1, np.array([float(x), 0, x + 10, 10]))] if x != 3 else [] for x in range(6)]
+        tracks[5].append(DetectedObject(2, np.array([50., 50, 60, 60])))
+        track_filter = LookaheadTrackFilter(min_track_length=2, max_gap=1)
+        released = []
+        for frame_number, detected_objects in enumerate(tracks):
+            released += track_filter.push(frame_number, detected_objects)
+            self.assertLessEqual(len(track_filter.window), track_filter.lookahead)
+        released += track_filter.flush()
+        expected = TrackPostprocessor(min_track_length=2, max_gap=1)(tracks)
+        self.assertEqual([frame_number for frame_number, _ in released], list(range(6)))
+        for (_, detected_objects), expected_objects in zip(released, expected):
+            self.assertEqual([d.id for d in detected_objects], [d.id for d in expected_objects])
+            for detected_object, expected_object in zip(detected_objects, expected_objects):
+                np.testing.assert_allclose(detected_object.bbox, expected_object.bbox)
+
+
+class TestIouTracking(unittest.TestCase):
+
+    def test_ambiguous_match(self):
+        tracker = Tracker(TRACKING_IOU, StubImageEncoder())
+        frame = np.random.RandomState(0).randint(0, 256, (240, 320, 3)).astype(np.uint8)
+        for step in range(30):
+            # Two faces moving towards each other until their boxes overlap
+            shift = 3.5 * min(step, 20)
+            tracks = tracker.update_batch([frame], [[[40 + shift, 80, 100 + shift, 140, 0.9],
+                                                     [200 - shift, 84, 260 - shift, 144, 0.9]]])[0]
+        self.assertGreater(tracker.embedded_boxes, 0)
+        self.assertEqual(sorted(track.track_id for track in tracks), [1, 2])
+        for track in tracks:
+            self.assertEqual(np.ndim(track.feature), 1)
+
+
+class TestChunkedTracking(unittest.TestCase):
+
+    @staticmethod
+    def chunk(warm_start, start, end, trajectories):
+        """
+        :param trajectories: dict of chunk track id to (box function of the frame number, appearance feature)
+        """
+        tracks = [[DetectedObject(track_id, box(frame_number)) for track_id, (box, _) in trajectories.items()]
+                  for frame_number in range(warm_start, end)]
+        features = {track_id: feature for track_id, (_, feature) in trajectories.items()}
+        return ChunkTracks(warm_start, start, TrackStore.from_tracks(tracks), features, features)
+
+    def test_track_across_chunks(self):
+        def box(frame_number):
+            return np.array([100. + 2 * frame_number, 50, 140 + 2 * frame_number, 100])
+
+        feature = np.array([1., 0, 0])
+        # Every chunk numbers its tracks from its own tracker
+        tracks = stitch_chunk_tracks([self.chunk(0, 0, 30, {1: (box, feature)}),
+                                      self.chunk(20, 30, 60, {4: (box, feature)}),
+                                      self.chunk(50, 60, 90, {2: (box, feature)})])
+        self.assertEqual(len(tracks), 90)
+        self.assertEqual({detected_object.id for frame in tracks for detected_object in frame}, {1})
+
+    def test_crossing_tracks(self):
+        # Two faces of the same size moving towards each other cross on the chunk boundary at frame 30
+        def right(frame_number):
+            return np.array([4. * frame_number, 50, 4 * frame_number + 40, 90])
+
+        def left(frame_number):
+            return np.array([236. - 4 * frame_number, 50, 276 - 4 * frame_number, 90])
+
+        first_chunk = self.chunk(0, 0, 30, {1: (right, np.array([1., 0, 0])), 2: (left, np.array([0., 1, 0]))})
+        # The second chunk found the faces in the opposite order
+        second_chunk = self.chunk(20, 30, 60, {1: (left, np.array([0., 1, 0])), 2: (right, np.array([1., 0, 0]))})
+        tracks = stitch_chunk_tracks([first_chunk, second_chunk])
+        self.assertEqual(len(tracks), 60)
+        ids = {"right": set(), "left": set()}
+        for frame_number, frame in enumerate(tracks):
+            for detected_object in frame:
+                name = "right" if detected_object.bbox[0] == 4 * frame_number else "left"
+                ids[name].add(detected_object.id)
+        self.assertEqual(ids, {"right": {1}, "left": {2}})
+
+
+class TestParallelExport(unittest.TestCase):
+
+    @unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "needs ffmpeg and ffprobe")
+    def test_export_parallel(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 320, 240, 75, faces=2)
+            face_tracks = TrackStore.from_tracks(FaceTracksFinder(path_to_video, detector=StubDetector(),
+                                                                  image_encoder=StubImageEncoder()).get_face_tracks())
+            for fourcc, extension in (("MJPG", ".avi"), ("mp4v", ".mp4")):
+                serial_path = os.path.join(work_dir, "serial" + extension)
+                parallel_path = os.path.join(work_dir, "parallel" + extension)
+                VideoExporter(path_to_video, serial_path, face_tracks, fourcc=fourcc).export()
+                VideoExporter(path_to_video, parallel_path, face_tracks, fourcc=fourcc).export_parallel(workers=3)
+                serial_frames = list(iterate_frames(cv2.VideoCapture(serial_path)))
+                parallel_frames = list(iterate_frames(cv2.VideoCapture(parallel_path)))
+                self.assertEqual(len(parallel_frames), 75)
+                self.assertEqual(len(parallel_frames), len(serial_frames))
+                for serial_frame, parallel_frame in zip(serial_frames, parallel_frames):
+                    difference = np.abs(serial_frame.astype(np.int16) - parallel_frame)
+                    if fourcc == "MJPG":
+                        self.assertEqual(difference.max(), 0)
+                    else:
+                        self.assertLess(difference.mean(), 1)
+
+    @unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "needs ffmpeg and ffprobe")
+    def test_export_parallel_blur_boxes(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            mpeg4_path = os.path.join(work_dir, "synthetic_mpeg4.mp4")
+            path_to_video = os.path.join(work_dir, "synthetic.ts")
+            make_synthetic_video(mpeg4_path, 320, 240, 75, faces=2)
+            # OpenCV does not seek to the requested frame of H.264 in MPEG-TS
+            subprocess.run([shutil.which("ffmpeg"), "-v", "error", "-i", mpeg4_path, "-c:v", "libx264", "-g", "12",
+                            path_to_video], check=True)
+            face_tracks = TrackStore.from_tracks(FaceTracksFinder(path_to_video, detector=StubDetector(),
+                                                                  image_encoder=StubImageEncoder()).get_face_tracks())
+            source_frames = list(iterate_frames(cv2.VideoCapture(path_to_video)))
+            # A lossless codec and filled boxes, so every output frame must be its source frame with its boxes filled
+            serial_path = os.path.join(work_dir, "serial.avi")
+            parallel_path = os.path.join(work_dir, "parallel.avi")
+            exporter = VideoExporter(path_to_video, serial_path, face_tracks, fourcc="FFV1", blur_style=BLUR_FILL)
+            exporter.export()
+            VideoExporter(path_to_video, parallel_path, face_tracks, fourcc="FFV1",
+                          blur_style=BLUR_FILL).export_parallel(workers=3)
+            for path in (serial_path, parallel_path):
+                frames = list(iterate_frames(cv2.VideoCapture(path)))
+                self.assertEqual(len(frames), len(source_frames))
+                for frame_number, (frame, source_frame) in enumerate(zip(frames, source_frames)):
+                    boxes, _ = exporter.frame_blur_plan(frame_number)
+                    expected_frame = blur_faces(source_frame.copy(), boxes, mode=BLUR_FILL)
+                    np.testing.assert_array_equal(frame, expected_frame, err_msg=f"{path} frame {frame_number}")
+
+
+class TestPassthroughExport(unittest.TestCase):
+
+    def test_plan_passthrough(self):
+        needs_blur = [False] * 10 + [False, True] + [False] * 8 + [False] * 5
+        runs = plan_passthrough(25, [0, 5, 10, 15, 20], needs_blur)
+        self.assertEqual(runs, [(0, 10, False), (10, 15, True), (15, 25, False)])
+        self.assertEqual(plan_passthrough(4, [2], [True] * 4), [(0, 4, True)])
+        runs = plan_passthrough(25, [0, 5, 10, 15, 20], [True] * 25, segment_frames=8)
+        self.assertEqual(runs, [(0, 10, True), (10, 20, True), (20, 25, True)])
+
+
+class TestIncrementalExport(unittest.TestCase):
+
+    def test_segment_signature(self):
+        plan = [(np.array([[10., 20, 50, 60]]), [25]), (np.zeros((0, 4)), [])]
+        parameters = {"blur_style": 0, "start": 0, "end": 2}
+        self.assertEqual(segment_signature(plan, parameters), segment_signature(list(plan), dict(parameters)))
+        self.assertNotEqual(segment_signature(plan, parameters), segment_signature([plan[0], (plan[0][0], [25])],
+                                                                                   parameters))
+        self.assertNotEqual(segment_signature(plan, parameters), segment_signature([(plan[0][0], [30]), plan[1]],
+                                                                                   parameters))
+
+    @unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "needs ffmpeg and ffprobe")
+    def test_reencode_changed_segments(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            mpeg4_path = os.path.join(work_dir, "synthetic_mpeg4.mp4")
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(mpeg4_path, 160, 120, 80, faces=1)
+            subprocess.run([shutil.which("ffmpeg"), "-v", "error", "-i", mpeg4_path, "-c:v", "libx264",
+                            "-g", "10", "-keyint_min", "10", "-sc_threshold", "0", path_to_video], check=True)
+            # Face 1 is in the GOPs starting at frames 0 and 10, face 2 in the GOP starting at frame 50
+            tracks = [[] for _ in range(80)]
+            for frame_number in range(20):
+                tracks[frame_number].append(DetectedObject(1, np.array([10., 10, 50, 50])))
+            for frame_number in range(50, 60):
+                tracks[frame_number].append(DetectedObject(2, np.array([80., 40, 120, 90])))
+            face_tracks = TrackStore.from_tracks(tracks)
+            segment_cache = SegmentCache(os.path.join(work_dir, "segments"))
+            save_path = os.path.join(work_dir, "blurred.mp4")
+
+            def export(id_to_blur_intensity):
+                exporter = VideoExporter(path_to_video, save_path, face_tracks,
+                                         id_to_blur_intensity=id_to_blur_intensity, segment_cache=segment_cache)
+                return exporter.export_passthrough(segment_seconds=0.4)
+
+            self.assertEqual(export({}), {"copied_frames": 50, "encoded_frames": 30, "reused_frames": 0})
+            self.assertEqual(export({}), {"copied_frames": 50, "encoded_frames": 0, "reused_frames": 30})
+            self.assertEqual(export({2: 40}), {"copied_frames": 50, "encoded_frames": 10, "reused_frames": 20})
+            self.assertEqual(len(list(iterate_frames(cv2.VideoCapture(save_path)))), 80)
+
+            segment_cache.max_size_bytes = 0
+            export({1: 40})
+            self.assertEqual(os.listdir(segment_cache.cache_dir), [])
+
+
+class TestBatchJobs(unittest.TestCase):
+
+    def test_run_batch(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path, summary_path = output_paths("full_faces.mp4", output_dir)
+            summaries = run_batch([BatchJob("full_faces.mp4", output_path, summary_path)])
+            self.assertEqual(summaries[0]["status"], "ok")
+            self.assertGreater(summaries[0]["faces"], 0)
+            self.assertTrue(os.path.exists(output_path))
+            with open(summary_path) as file:
+                self.assertEqual(json.load(file)["frames"], summaries[0]["frames"])
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+
+    def test_stub_detector_finds_synthetic_faces(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            ground_truth = make_synthetic_video(path_to_video, 320, 240, 10, faces=1)
+            video_capture = cv2.VideoCapture(path_to_video)
+            frames = [video_capture.read()[1] for _ in ground_truth]
+            video_capture.release()
+        for true_boxes, detections in zip(ground_truth, StubDetector()(frames)):
+            self.assertEqual(len(detections), 1)
+            self.assertGreater(box_iou(true_boxes, detections[:, :4])[0, 0], 0.8)
+
+
+class TestFrameCache(unittest.TestCase):
+
+    @unittest.skipUnless(shutil.which("ffprobe"), "needs ffprobe")
+    def test_keyframe_index(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 160, 120, 30, faces=1)
+            keyframe_index = KeyframeIndex(path_to_video)
+            self.assertEqual(keyframe_index.keyframe_before(17), 17)
+            keyframe_index.start()
+            keyframe_index.join()
+            # OpenCV writes mp4v with a keyframe every 12 frames
+            self.assertEqual(keyframe_index.keyframe_before(17), 12)
+
+            # ffprobe fails on files it cannot read, which are looked up without the index
+            unreadable_path = os.path.join(work_dir, "unreadable.mp4")
+            with open(unreadable_path, "wb") as file:
+                file.write(b"not a video")
+            keyframe_index = KeyframeIndex(unreadable_path)
+            keyframe_index.start()
+            keyframe_index.join()
+            self.assertIsNone(keyframe_index.keyframes)
+            self.assertEqual(keyframe_index.keyframe_before(12), 12)
+
+
+class TestPreviewRendering(unittest.TestCase):
+
+    def test_view_to_frame(self):
+        for frame_size, view_size in [((1920, 1080), (800, 800)), ((480, 640), (800, 600)), ((640, 480), (640, 480))]:
+            left, top, width, height = letterbox(frame_size, view_size)
+            scale_x, scale_y = width / frame_size[0], height / frame_size[1]
+            for x in range(left, left + width, 7):
+                for y in range(top, top + height, 7):
+                    frame_x, frame_y = view_to_frame(x, y, frame_size, view_size)
+                    self.assertTrue(0 <= frame_x < frame_size[0] and 0 <= frame_y < frame_size[1])
+                    # The source pixel covers the preview pixel it was picked from
+                    self.assertTrue(left + frame_x * scale_x <= x < left + (frame_x + 1) * scale_x)
+                    self.assertTrue(top + frame_y * scale_y <= y < top + (frame_y + 1) * scale_y)
+        self.assertEqual(letterbox((1920, 1080), (800, 800)), (0, 175, 800, 450))
+        self.assertIsNone(view_to_frame(400, 100, (1920, 1080), (800, 800)))
+        self.assertIsNone(view_to_frame(400, 625, (1920, 1080), (800, 800)))
+        self.assertEqual(view_to_frame(0, 175, (1920, 1080), (800, 800)), (0, 0))
+
+    def test_drops_stale_frames(self):
+        ring = FrameRing((32, 24), slots=1)
+        queue = PreviewQueue(ring)
+        self.assertIsNone(queue.take(timeout=0.01))
+        queue.submit("frame 0", 0)
+        frame, frame_number, slot = queue.take()
+        self.assertEqual((frame, frame_number), ("frame 0", 0))
+
+        # The GUI still holds the only buffer, so the frames submitted meanwhile wait and only the newest is kept
+        queue.submit("frame 1", 1)
+        queue.submit("frame 2", 2)
+        self.assertEqual(queue.frames_dropped, 1)
+        self.assertIsNone(queue.take(timeout=0.01))
+        queue.release(slot)
+        self.assertEqual(queue.take(timeout=1)[:2], ("frame 2", 2))
+        self.assertIsNone(queue.take(timeout=0.01))
+
+        # Closing wakes up a renderer waiting for frames
+        taken = []
+        renderer = threading.Thread(target=lambda: taken.append(queue.take()))
+        renderer.start()
+        queue.close()
+        renderer.join(timeout=1)
+        self.assertFalse(renderer.is_alive())
+        self.assertEqual(taken, [None])
+
+    def test_render_preview(self):
+        ring = FrameRing((80, 80), slots=1)
+        frame = np.full((90, 160, 3), (255, 0, 0), dtype=np.uint8)
+        render_preview(frame, 0, TrackStore(), {}, BLUR_FILL, 160, ring, ring.acquire())
+        # The BGR frame is letterboxed as RGB between black bars
+        self.assertEqual(ring.geometries[0], (0, 17, 80, 45))
+        self.assertTrue((ring.buffers[0][17:62] == (0, 0, 255)).all())
+        self.assertFalse(ring.buffers[0][:17].any() or ring.buffers[0][62:].any())
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profiler(self):
+        profiler = Profiler()
+        for seconds in [0.001] * 90 + [0.1] * 10:
+            profiler.record("detect", seconds)
+            profiler.frame(detections=2)
+        stages = profiler.snapshot()["stages"]
+        self.assertEqual(stages["detect"]["count"], 100)
+        self.assertAlmostEqual(stages["detect"]["p50_milliseconds"], 1, delta=0.1)
+        self.assertAlmostEqual(stages["detect"]["p99_milliseconds"], 100, delta=10)
+        self.assertEqual(profiler.snapshot()["detections_per_frame"], 2)
+
+    def test_disabled_profiler(self):
+        frames = [np.zeros(1)]
+        self.assertIs(DISABLED_PROFILER.iterate("decode", frames), frames)
+        self.assertIs(DISABLED_PROFILER.timed("detect", len), len)
+        DISABLED_PROFILER.record("detect", 1.0)
+        self.assertEqual(DISABLED_PROFILER.snapshot()["stages"], {})
+
+    def test_profiled_face_tracks(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 320, 240, 12, faces=2)
+            profiler = Profiler()
+            face_tracks = FaceTracksFinder(path_to_video, detector=StubDetector(), image_encoder=StubImageEncoder(),
+                                           batch_size=4, profiler=profiler).get_face_tracks()
+        snapshot = profiler.snapshot()
+        self.assertEqual(snapshot["frames"], len(face_tracks))
+        self.assertEqual(snapshot["frames"], 12)
+        self.assertEqual(snapshot["stages"]["detect"]["count"], 3)
+        self.assertIn("track", snapshot["stages"])
+
+
+class TestFrameTransport(unittest.TestCase):
+
+    def test_shared_frame_ring(self):
+        ring = SharedFrameRing((4, 6, 3), slots=2)
+        try:
+            frame = np.arange(2 * 3 * 3, dtype=np.uint8).reshape(2, 3, 3)
+            slot = ring.write(frame, frame_number=7)
+            np.testing.assert_array_equal(ring.view(slot, 7), frame)
+            self.assertIsNone(ring.view(slot, 8))
+            ring.write(frame, frame_number=8)
+            self.assertEqual(ring.free_slots(), 0)
+            self.assertIsNone(ring.write(frame, frame_number=9, timeout=0))
+            ring.release(slot)
+            self.assertEqual(ring.write(frame, frame_number=9), slot)
+            self.assertIsNone(ring.view(slot, 7))
+        finally:
+            ring.close()
+
+    def test_ring_frames(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 320, 240, 6, faces=1)
+            video_capture = cv2.VideoCapture(path_to_video)
+            frames = [video_capture.read()[1] for _ in range(6)]
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ring, first_frame = frame_ring_for(video_capture, slots=2)
+            self.assertIsNone(first_frame)
+            for slot, frame_number, frame in ring_frames(video_capture, ring):
+                np.testing.assert_array_equal(frame, frames[frame_number])
+                self.assertTrue(np.shares_memory(ring.view(slot, frame_number), ring.buffers[slot]))
+                ring.release(slot)
+            video_capture.release()
+        self.assertEqual(frame_number, 5)
+        self.assertEqual(ring.free_slots(), 2)
+
+    def test_ring_frames_unreported_size(self):
+        class UnreportedSizeCapture:
+            def __init__(self, video_capture):
+                self.video_capture = video_capture
+
+            def __getattr__(self, name):
+                return getattr(self.video_capture, name)
+
+            def get(self, property_id):
+                if property_id in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT):
+                    return 0.0
+                return self.video_capture.get(property_id)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_video = os.path.join(work_dir, "synthetic.mp4")
+            make_synthetic_video(path_to_video, 320, 240, 6, faces=1)
+            video_capture = UnreportedSizeCapture(cv2.VideoCapture(path_to_video))
+            frames = [video_capture.read()[1] for _ in range(6)]
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ring, first_frame = frame_ring_for(video_capture, slots=2)
+            self.assertEqual(ring.max_frame_shape, (240, 320, 3))
+            decoded = []
+            for slot, frame_number, frame in ring_frames(video_capture, ring, first_frame=first_frame):
+                np.testing.assert_array_equal(frame, frames[frame_number])
+                decoded.append(frame_number)
+                ring.release(slot)
+            self.assertEqual(decoded, list(range(6)))
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            stop_event = threading.Event()
+            frames = ring_frames(video_capture, ring, stop_event=stop_event)
+            next(frames), next(frames)
+            stop_event.set()
+            self.assertIsNone(next(frames, None))
+            video_capture.release()
+            ring.close()
+
+
+class TestRoiDetection(unittest.TestCase):
+
+    def test_crop_regions(self):
+        regions = crop_regions(np.array([[100., 100, 150, 160], [140, 100, 200, 160], [900, 500, 950, 560]]),
+                               (600, 1000, 3), margin=1.0, min_size=96)
+        self.assertEqual(len(regions), 2)
+        for x1, y1, x2, y2 in regions:
+            self.assertTrue(0 <= x1 < x2 <= 1000 and 0 <= y1 < y2 <= 600)
+        self.assertEqual(regions[1][2:], [1000, 600])
+
+    def test_map_crop_detections(self):
+        region = [100, 50, 300, 250]
+        detections = map_crop_detections([[10, 20, 60, 80, 0.9], [150, 20, 200, 80, 0.8]], region, (600, 1000, 3))
+        self.assertEqual(detections, [[110, 70, 160, 130, 0.9]])
+        detections = non_maximum_suppression(detections + [[112, 70, 160, 132, 0.95]])
+        self.assertEqual(detections, [[112, 70, 160, 132, 0.95]])
+
+
+class TestDetectionScheduler(unittest.TestCase):
+
+    def test_adaptive_interval(self):
+        scheduler = AdaptiveDetectionScheduler(min_interval=1, max_interval=8)
+        frame = np.random.RandomState(0).randint(0, 256, (240, 320, 3)).astype(np.uint8)
+        detected_frames = []
+        for frame_number in range(60):
+            if scheduler.should_detect(frame):
+                detected_frames.append(frame_number)
+                # A second face appears at frame 20 and the first one is lost at frame 40
+                scheduler.tracks_detected({1} if frame_number < 20 else {1, 2} if frame_number < 40 else {2})
+        # The interval doubles up to max_interval while the same faces are found, and restarts when they change
+        self.assertEqual(detected_frames, [0, 1, 3, 7, 15, 23, 24, 26, 30, 38, 46, 47, 49, 53])
+        self.assertEqual(scheduler.statistics()["detected_frames"], len(detected_frames))
+
+        scheduler.reset()
+        self.assertTrue(scheduler.should_detect(frame))
+        # Without reported tracks, detections are max_interval frames apart on a static video
+        self.assertEqual([scheduler.should_detect(frame) for _ in range(8)], [False] * 7 + [True])
+
+        # A scene cut forces a detection whatever the interval
+        scheduler.reset()
+        scheduler.should_detect(frame)
+        self.assertTrue(scheduler.should_detect(255 - frame))
+
+
+class TestMotionGate(unittest.TestCase):
+
+    def test_motion_gate(self):
+        detector = StubDetector()
+        frame = np.full((360, 640, 3), 40, dtype=np.uint8)
+        cv2.ellipse(frame, (100, 100), (30, 40), 0, 0, 360, (120, 160, 215), -1)
+        motion_gate = MotionGate()
+        self.assertTrue(motion_gate.check(frame))
+        self.assertIsNone(motion_gate.regions)
+        motion_gate.remember(detect_frames(detector, [frame], 0.5)[0][1])
+        self.assertFalse(motion_gate.check(frame.copy()))
+
+        moved = frame.copy()
+        cv2.ellipse(moved, (500, 250), (30, 40), 0, 0, 360, (120, 160, 215), -1)
+        self.assertTrue(motion_gate.check(moved))
+        self.assertEqual(len(motion_gate.regions), 1)
+        detections = motion_gate.detect(detector, moved, 0.5)
+        self.assertEqual(len(detections), 2)
+        statistics = motion_gate.statistics()
+        self.assertEqual(statistics["static_frames"], 1)
+        self.assertGreater(statistics["skipped_pixel_fraction"], 0.3)
+
+
+class TestTiledDetection(unittest.TestCase):
+
+    def test_tile_regions(self):
+        regions = tile_regions((2160, 3840, 3), tile_size=640, overlap=0.2)
+        coverage = np.zeros((2160, 3840), dtype=bool)
+        for x1, y1, x2, y2 in regions:
+            self.assertEqual((x2 - x1, y2 - y1), (640, 640))
+            coverage[y1:y2, x1:x2] = True
+        self.assertTrue(coverage.all())
+        self.assertEqual(tile_regions((300, 500, 3)), [[0, 0, 500, 300]])
+
+    def test_tiled_detector_workers(self):
+        frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+        frame[100:160, 1000:1050] = FACE_COLOR
+        with TiledDetector(workers=2, include_full_frame=False) as tiled_detector:
+            detections = tiled_detector.detect(StubDetector(), frame, None, 0.5)
+            self.assertIsNotNone(tiled_detector.executor)
+        self.assertIsNone(tiled_detector.executor)
+        self.assertEqual(len(detections), 1)
+        np.testing.assert_allclose(detections[0][:4], [1000, 100, 1050, 160])
@@ -0,0 +1,161 @@
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from blurring_faces import FaceTracksFinder, BLUR_GAUSSIAN, DEFAULT_BLUR_STRENGTH
+from detector_backends import load_detector, DETECTOR_ULTRALYTICS
+from export import VideoExporter
+from profiling import Profiler
+from track_store import TrackStore
+from tracker import TRACKING_DEEPSORT, load_image_encoder
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov")
+
+# Models of the current worker process, loaded once by _init_worker and reused by every job it runs
+_worker_models = {}
+
+
+class BatchJob:
+    """
+    One video to process, with the settings shared by the whole batch
+    """
+    def __init__(self, input_path, output_path, summary_path, detection_threshold=0.5,
+                 tracking_mode=TRACKING_DEEPSORT, blur_style=BLUR_GAUSSIAN, blur_strength=DEFAULT_BLUR_STRENGTH,
+                 fourcc="mp4v", batch_size=1, track_cache=None, track_postprocessor=None,
+                 checkpoints=None, region_detector=None, passthrough=False, profile=False, motion_gate=None,
+                 segment_cache=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.summary_path = summary_path
+        self.detection_threshold = detection_threshold
+        self.tracking_mode = tracking_mode
+        self.blur_style = blur_style
+        self.blur_strength = blur_strength
+        self.fourcc = fourcc
+        self.batch_size = batch_size
+        self.track_cache = track_cache
+        self.track_postprocessor = track_postprocessor
+        self.checkpoints = checkpoints
+        self.region_detector = region_detector
+        self.passthrough = passthrough
+        self.profile = profile
+        self.motion_gate = motion_gate
+        self.segment_cache = segment_cache
+
+
+def expand_inputs(patterns):
+    """
+    :param patterns: list of paths, directories or glob patterns
+    :return: paths: sorted list of video files without duplicates
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(os.path.join(pattern, name) for name in os.listdir(pattern)
+                         if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif os.path.exists(pattern):
+            paths.add(pattern)
+        else:
+            paths.update(glob.glob(pattern, recursive=True))
+    return sorted(os.path.normpath(path) for path in paths)
+
+
+def output_paths(input_path, output_dir=None, suffix="_blurred", extension=None):
+    """
+    :param input_path: str
+    :param output_dir: str or None, next to the input when None
+    :param suffix: str
+    :param extension: str or None, the input extension when None
+    :return: (output_path, summary_path)
+    """
+    name, input_extension = os.path.splitext(os.path.basename(input_path))
+    output_dir = output_dir or os.path.dirname(input_path)
+    output_path = os.path.join(output_dir, f"{name}{suffix}{extension or input_extension}")
+    return output_path, os.path.splitext(output_path)[0] + ".json"
+
+
+def _init_worker(path_to_detector, detector_backend, detector_threads):
+    _worker_models["detector"] = load_detector(path_to_detector, detector_backend, threads=detector_threads)
+    _worker_models["image_encoder"] = load_image_encoder()
+    _worker_models["path_to_detector"] = path_to_detector
+
+
+def run_job(job):
+    """
+    :param job: BatchJob
+    :return: summary: dict
+    Finds face tracks and writes the blurred video with the models of the current worker,
+    the summary is also written as JSON to job.summary_path
+    """
+    summary = {"input": job.input_path, "output": job.output_path, "status": "ok"}
+    start_time = time.perf_counter()
+    profiler = None
+    if job.profile:
+        profiler = Profiler(trace_path=os.path.splitext(job.summary_path)[0] + ".trace.jsonl")
+    try:
+        face_tracks_finder = FaceTracksFinder(job.input_path, _worker_models["path_to_detector"],
+                                              job.detection_threshold, batch_size=job.batch_size,
+                                              track_cache=job.track_cache, tracking_mode=job.tracking_mode,
+                                              track_postprocessor=job.track_postprocessor,
+                                              detector=_worker_models["detector"],
+                                              image_encoder=_worker_models["image_encoder"],
+                                              checkpoints=job.checkpoints, region_detector=job.region_detector,
+                                              profiler=profiler, motion_gate=job.motion_gate)
+        face_tracks = TrackStore.from_tracks(face_tracks_finder.get_face_tracks())
+        tracking_time = time.perf_counter() - start_time
+        if profiler is not None:
+            summary["profile"] = {"tracking": profiler.snapshot()}
+            profiler.reset()
+
+        track_ids = face_tracks.track_ids()
+        exporter = VideoExporter(job.input_path, job.output_path, face_tracks, job.fourcc,
+                                 blur_style=job.blur_style,
+                                 id_to_blur_intensity={int(track_id): job.blur_strength for track_id in track_ids},
+                                 profiler=profiler, segment_cache=job.segment_cache)
+        if job.passthrough:
+            summary.update(exporter.export_passthrough())
+        else:
+            exporter.export()
+        if job.motion_gate is not None:
+            summary["motion_gate"] = job.motion_gate.statistics()
+        summary.update({"frames": len(face_tracks),
+                        "faces": len(track_ids),
+                        "face_detections": len(face_tracks.ids),
+                        "frames_with_faces": int((face_tracks.offsets[1:] > face_tracks.offsets[:-1]).sum()),
+                        "tracking_seconds": tracking_time,
+                        "export_seconds": time.perf_counter() - start_time - tracking_time})
+    except Exception as error:
+        summary.update({"status": "failed", "error": repr(error), "traceback": traceback.format_exc()})
+    finally:
+        if job.region_detector is not None:
+            job.region_detector.close()
+    summary["total_seconds"] = time.perf_counter() - start_time
+    if profiler is not None:
+        summary.setdefault("profile", {})["export"] = profiler.snapshot()
+        profiler.close()
+
+    with open(job.summary_path, "w") as file:
+        json.dump(summary, file, indent=2)
+    return summary
+
+
+def run_batch(jobs, path_to_detector="best.pt", workers=1, detector_backend=DETECTOR_ULTRALYTICS,
+              detector_threads=None):
+    """
+    :param jobs: list of BatchJob
+    :param path_to_detector: str
+    :param detector_backend: one of DETECTOR_BACKENDS
+    :param detector_threads: int or None, intra-op threads of the CPU detector backends
+    :param workers: int, number of processes, every process loads the models once
+    :return: summaries: list of dict in the order of jobs
+    """
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        _init_worker(path_to_detector, detector_backend, detector_threads)
+        return [run_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(path_to_detector, detector_backend, detector_threads)) as executor:
+        return list(executor.map(run_job, jobs))
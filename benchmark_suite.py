@@ -0,0 +1,326 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks import measure_blur_renderers
+from blurring_faces import (FaceTracksFinder, blur_faces, detect_frames, read_frames, track_detections_batch,
+                            remove_noise_from_tracks, iterate_frames, BLUR_GAUSSIAN)
+from boxes import box_iou
+from export import VideoExporter
+from track_store import TrackStore
+from tracker import Tracker, TRACKING_DEEPSORT
+
+SUITE_FORMAT_VERSION = 1
+STAGES = ("decode", "detect", "embed", "track", "noise_removal", "blur", "encode")
+# Synthetic faces have this BGR color, which the background never reaches, so the stub detector finds them exactly
+FACE_COLOR = (120, 160, 215)
+FACE_COLOR_TOLERANCE = 30
+
+# (width, height, frames, faces)
+DEFAULT_CONFIGURATIONS = ((640, 360, 150, 1), (1280, 720, 150, 4), (1920, 1080, 150, 8), (3840, 2160, 60, 8))
+QUICK_CONFIGURATIONS = ((640, 360, 50, 2),)
+
+
+def make_synthetic_video(path_to_video, width=1280, height=720, frames_count=150, faces=4, fps=25, seed=0):
+    """
+    :param path_to_video: str
+    :param width: int
+    :param height: int
+    :param frames_count: int
+    :param faces: int
+    :param fps: float
+    :param seed: int, the same seed writes the same video
+    :return: ground_truth: list of np.ndarray of [x1, y1, x2, y2], the face boxes of every frame
+    Writes a video of face-like ellipses with eyes and a mouth moving over a textured background,
+    every face has its own mouth color, so appearance features tell them apart
+    """
+    random_generator = np.random.default_rng(seed)
+    background = random_generator.integers(0, 80, (height, width, 1), dtype=np.uint8).repeat(3, axis=2)
+    background = cv2.GaussianBlur(background, (0, 0), 3)
+    sizes = random_generator.uniform(0.08, 0.2, faces) * min(width, height)
+    positions = random_generator.uniform(0, 1, (faces, 2)) * [width - sizes.max(), height - sizes.max()]
+    velocities = random_generator.uniform(-1, 1, (faces, 2)) * min(width, height) / 100
+    mouth_colors = random_generator.integers(0, 100, (faces, 3))
+
+    writer = cv2.VideoWriter(path_to_video, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    ground_truth = []
+    for _ in range(frames_count):
+        frame = background.copy()
+        boxes = []
+        for face in range(faces):
+            size = sizes[face]
+            for axis, limit in ((0, width - size * 0.75), (1, height - size)):
+                positions[face, axis] += velocities[face, axis]
+                if not 0 <= positions[face, axis] <= limit:
+                    velocities[face, axis] *= -1
+                    positions[face, axis] = min(max(positions[face, axis], 0), limit)
+            x, y = positions[face]
+            center = (int(x + size * 0.375), int(y + size / 2))
+            cv2.ellipse(frame, center, (int(size * 0.375), int(size / 2)), 0, 0, 360, FACE_COLOR, -1)
+            for eye_x in (-0.15, 0.15):
+                cv2.circle(frame, (int(center[0] + eye_x * size), int(center[1] - 0.1 * size)),
+                           max(1, int(size * 0.05)), (30, 30, 30), -1)
+            cv2.rectangle(frame, (int(center[0] - 0.12 * size), int(center[1] + 0.18 * size)),
+                          (int(center[0] + 0.12 * size), int(center[1] + 0.25 * size)),
+                          tuple(int(channel) for channel in mouth_colors[face]), -1)
+            boxes.append([center[0] - int(size * 0.375), center[1] - int(size / 2),
+                          center[0] + int(size * 0.375) + 1, center[1] + int(size / 2) + 1])
+        writer.write(frame)
+        ground_truth.append(np.asarray(boxes, dtype=np.float64).reshape(-1, 4))
+    writer.release()
+    return ground_truth
+
+
+class StubDetector:
+    """
+    Deterministic detector of the faces of make_synthetic_video, following the interface of load_detector.
+    It needs no model files, so the suite runs offline, and its cost can be set to emulate a real model.
+    """
+    def __init__(self, min_area=64, seconds_per_image=0.0):
+        self.min_area = min_area
+        self.seconds_per_image = seconds_per_image
+        self.lower = np.clip(np.array(FACE_COLOR) - FACE_COLOR_TOLERANCE, 0, 255).astype(np.uint8)
+        self.upper = np.clip(np.array(FACE_COLOR) + FACE_COLOR_TOLERANCE, 0, 255).astype(np.uint8)
+
+    def __call__(self, images, imgsz=None):
+        results = []
+        for image in images:
+            mask = cv2.inRange(image, self.lower, self.upper)
+            count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+            detections = [[x, y, x + width, y + height, 0.9, 0] for x, y, width, height, area in stats[1:count]
+                          if area >= self.min_area]
+            results.append(np.asarray(detections, dtype=np.float32).reshape(-1, 6))
+            if self.seconds_per_image:
+                time.sleep(self.seconds_per_image)
+        return results
+
+    def clone(self):
+        return self
+
+
+class StubImageEncoder:
+    """
+    Deterministic appearance encoder with the interface of the DeepSORT image encoder,
+    features are the normalized colors of a coarse grid over the patch
+    """
+    image_shape = (128, 64, 3)
+
+    def __call__(self, patches, batch_size=32):
+        features = np.empty((len(patches), 96), dtype=np.float32)
+        for i, patch in enumerate(patches):
+            feature = cv2.resize(patch, (4, 8), interpolation=cv2.INTER_AREA).reshape(-1).astype(np.float32)
+            features[i] = feature / max(np.linalg.norm(feature), 1e-12)
+        return features
+
+
+class TimedImageEncoder:
+    """
+    Wraps an image encoder and adds up the time spent in it, to tell embedding from association in tracking
+    """
+    def __init__(self, image_encoder):
+        self.image_encoder = image_encoder
+        self.image_shape = image_encoder.image_shape
+        self.seconds = 0.0
+
+    def __call__(self, patches, batch_size=32):
+        start_time = time.perf_counter()
+        features = self.image_encoder(patches, batch_size)
+        self.seconds += time.perf_counter() - start_time
+        return features
+
+
+def measure_stages(path_to_video, detector, image_encoder, tracking_mode=TRACKING_DEEPSORT, batch_size=8,
+                   detection_threshold=0.5, blur_style=BLUR_GAUSSIAN, save_path=None):
+    """
+    :param path_to_video: str
+    :param detector: detector, see load_detector
+    :param image_encoder: appearance encoder, see Tracker
+    :param tracking_mode: str
+    :param batch_size: int
+    :param detection_threshold: float
+    :param blur_style: str
+    :param save_path: str, the blurred video, written next to the input when None
+    :return: (timings, tracks): seconds spent in every stage of STAGES and the face tracks of every frame
+    Runs the stages one after the other on whole batches, so each of them is timed on its own
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    image_encoder = TimedImageEncoder(image_encoder)
+    tracker = Tracker(tracking_mode, image_encoder)
+    video_capture = cv2.VideoCapture(path_to_video)
+    tracks = []
+    while True:
+        start_time = time.perf_counter()
+        frames = read_frames(video_capture, batch_size)
+        timings["decode"] += time.perf_counter() - start_time
+        if not frames:
+            break
+        start_time = time.perf_counter()
+        detected_frames = detect_frames(detector, frames, detection_threshold)
+        timings["detect"] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        tracks += track_detections_batch(tracker, detected_frames)
+        timings["track"] += time.perf_counter() - start_time
+    video_capture.release()
+    timings["embed"] = image_encoder.seconds
+    timings["track"] -= image_encoder.seconds
+
+    start_time = time.perf_counter()
+    tracks = remove_noise_from_tracks(tracks)
+    timings["noise_removal"] = time.perf_counter() - start_time
+
+    save_path = save_path or os.path.splitext(path_to_video)[0] + "_stages.mp4"
+    video_capture = cv2.VideoCapture(path_to_video)
+    video_dimensions = (int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                        int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*"mp4v"), video_capture.get(cv2.CAP_PROP_FPS),
+                             video_dimensions)
+    for frame, detected_objects in zip(iterate_frames(video_capture), tracks):
+        start_time = time.perf_counter()
+        boxes = np.array([detected_object.bbox for detected_object in detected_objects]).reshape(-1, 4)
+        frame = blur_faces(frame, boxes, mode=blur_style)
+        timings["blur"] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        writer.write(frame)
+        timings["encode"] += time.perf_counter() - start_time
+    video_capture.release()
+    writer.release()
+    return timings, tracks
+
+
+def detection_recall(ground_truth, tracks, iou_threshold=0.5):
+    """
+    :param ground_truth: list of np.ndarray of [x1, y1, x2, y2]
+    :param tracks: list of lists of DetectedObject
+    :param iou_threshold: float
+    :return: recall: float, fraction of the true face boxes covered by a tracked box
+    """
+    found = total = 0
+    for true_boxes, detected_objects in zip(ground_truth, tracks):
+        total += len(true_boxes)
+        if len(true_boxes) and detected_objects:
+            ious = box_iou(true_boxes, [detected_object.bbox for detected_object in detected_objects])
+            found += int((ious.max(axis=1) >= iou_threshold).sum())
+    return found / total if total else 1.0
+
+
+def run_configuration(work_dir, width, height, frames_count, faces, detector=None, image_encoder=None,
+                      tracking_mode=TRACKING_DEEPSORT, batch_size=8):
+    """
+    :param work_dir: str, synthetic videos and outputs are written there
+    :return: results: dict
+    Benchmarks the stages, the face tracks finder and the export of one synthetic video
+    """
+    detector = detector or StubDetector()
+    image_encoder = image_encoder or StubImageEncoder()
+    name = f"synthetic_{width}x{height}_{frames_count}f_{faces}faces"
+    path_to_video = os.path.join(work_dir, name + ".mp4")
+    ground_truth = make_synthetic_video(path_to_video, width, height, frames_count, faces)
+
+    timings, tracks = measure_stages(path_to_video, detector, image_encoder, tracking_mode, batch_size,
+                                     save_path=os.path.join(work_dir, name + "_stages.mp4"))
+    results = {"name": name, "width": width, "height": height, "frames": len(tracks), "faces": faces,
+               "tracking_mode": tracking_mode, "batch_size": batch_size,
+               "stages": {stage: {"seconds": seconds, "milliseconds_per_frame": 1000 * seconds / max(1, len(tracks))}
+                          for stage, seconds in timings.items()},
+               "detection_recall": detection_recall(ground_truth, tracks)}
+
+    face_tracks_finder = FaceTracksFinder(path_to_video, batch_size=batch_size, tracking_mode=tracking_mode,
+                                          detector=detector, image_encoder=image_encoder)
+    start_time = time.perf_counter()
+    face_tracks = TrackStore.from_tracks(list(face_tracks_finder))
+    elapsed = time.perf_counter() - start_time
+    results["face_tracks_finder_fps"] = len(face_tracks) / elapsed if elapsed > 0 else 0.0
+
+    exporter = VideoExporter(path_to_video, os.path.join(work_dir, name + "_blurred.mp4"), face_tracks)
+    start_time = time.perf_counter()
+    exporter.export()
+    elapsed = time.perf_counter() - start_time
+    results["export_fps"] = len(face_tracks) / elapsed if elapsed > 0 else 0.0
+    results["blur_renderers_milliseconds"] = measure_blur_renderers((height, width), faces,
+                                                                    int(0.15 * min(width, height)), repeats=5)
+    return results
+
+
+def run_suite(configurations=DEFAULT_CONFIGURATIONS, output_path=None, work_dir=None, **parameters):
+    """
+    :param configurations: iterable of (width, height, frames, faces)
+    :param output_path: str or None, the results are also written there as JSON
+    :param work_dir: str or None, a temporary directory removed afterwards when None
+    :param parameters: run_configuration parameters
+    :return: results: dict
+    """
+    results = {"version": SUITE_FORMAT_VERSION,
+               "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                               "processor": platform.processor(), "cpus": os.cpu_count(),
+                               "opencv": cv2.__version__, "numpy": np.__version__},
+               "configurations": []}
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        for width, height, frames_count, faces in configurations:
+            results["configurations"].append(run_configuration(work_dir or temporary_dir, width, height,
+                                                               frames_count, faces, **parameters))
+    if output_path:
+        with open(output_path, "w") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def compare_results(baseline, results, tolerance=0.1):
+    """
+    :param baseline: dict, results of run_suite
+    :param results: dict, results of run_suite with the same configurations
+    :param tolerance: float, relative slowdown reported as a regression
+    :return: regressions: list of str
+    """
+    regressions = []
+    baseline_configurations = {configuration["name"]: configuration for configuration in baseline["configurations"]}
+    for configuration in results["configurations"]:
+        reference = baseline_configurations.get(configuration["name"])
+        if reference is None:
+            continue
+        for stage, timing in configuration["stages"].items():
+            before = reference["stages"][stage]["milliseconds_per_frame"]
+            after = timing["milliseconds_per_frame"]
+            if after > before * (1 + tolerance) and after - before > 0.05:
+                regressions.append(f"{configuration['name']} {stage}: {before:.2f} -> {after:.2f} ms/frame")
+        for key in ("face_tracks_finder_fps", "export_fps"):
+            if configuration[key] < reference[key] / (1 + tolerance):
+                regressions.append(f"{configuration['name']} {key}: {reference[key]:.1f} -> {configuration[key]:.1f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every stage of face blurring on synthetic videos "
+                                                 "with stub models, offline on any CPU.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to report regressions against")
+    parser.add_argument("--quick", action="store_true", help="a single small video")
+    parser.add_argument("--tracking-mode", default=TRACKING_DEEPSORT)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    arguments = parser.parse_args(argv)
+
+    results = run_suite(QUICK_CONFIGURATIONS if arguments.quick else DEFAULT_CONFIGURATIONS, arguments.output,
+                        tracking_mode=arguments.tracking_mode, batch_size=arguments.batch_size)
+    for configuration in results["configurations"]:
+        stages = ", ".join(f"{stage} {timing['milliseconds_per_frame']:.2f}"
+                           for stage, timing in configuration["stages"].items())
+        print(f"{configuration['name']}: {stages} ms/frame, finder {configuration['face_tracks_finder_fps']:.1f} fps, "
+              f"export {configuration['export_fps']:.1f} fps, recall {configuration['detection_recall']:.3f}")
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = compare_results(json.load(file), results, arguments.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+import os
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from blurring_faces import (FaceTracksFinder, blur_face, blur_faces, detect_frames, frame_batches, track_detections,
+                            iterate_frames, BLUR_MODES)
+from boxes import box_iou
+from detection import RoiDetector, TiledDetector
+from detection_scheduling import AdaptiveDetectionScheduler, MotionGate
+from detector_backends import load_detector, DETECTOR_ULTRALYTICS, DETECTOR_ONNXRUNTIME, DETECTOR_OPENCV
+from tracker import Tracker, TRACKING_DEEPSORT, TRACKING_MODES
+
+
+def measure_batch_throughput(path_to_video, batch_sizes=(1, 4, 8, 16), path_to_detector="best.pt"):
+    """
+    :param path_to_video: str
+    :param batch_sizes: iterable of int
+    :param path_to_detector: str
+    :return: results: dict
+    Runs the face tracks finder with every batch size and returns frames/sec for each of them.
+    Measured on one Xeon core with PyTorch 2.14 and ultralytics 8.4, yolov8n at 640, 1280x720 synthetic video,
+    two runs: batch_size 1: 9.1-9.5 fps, 4: 9.7-11.2 fps, 8: 9.0-10.4 fps, 16: 9.7-10.2 fps.
+    Batches save the per-call overhead, a single core gains little beyond 4 frames per batch.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, batch_size=batch_size)
+        start_time = time.perf_counter()
+        frames = sum(1 for _ in face_tracks_finder)
+        elapsed = time.perf_counter() - start_time
+        results[batch_size] = frames / elapsed if elapsed > 0 else 0.0
+    return results
+
+
+def measure_detection_scheduling(path_to_video, path_to_detector="best.pt", **scheduler_parameters):
+    """
+    :param path_to_video: str
+    :param path_to_detector: str
+    :param scheduler_parameters: AdaptiveDetectionScheduler parameters
+    :return: results: dict
+    Compares frames/sec of detecting every frame with the adaptive detection scheduler
+    """
+    results = {}
+    for name, scheduler in (("every_frame", None), ("adaptive", AdaptiveDetectionScheduler(**scheduler_parameters))):
+        face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, detection_scheduler=scheduler)
+        start_time = time.perf_counter()
+        frames = sum(1 for _ in face_tracks_finder)
+        elapsed = time.perf_counter() - start_time
+        results[name] = {"frames_per_second": frames / elapsed if elapsed > 0 else 0.0}
+        if scheduler is not None:
+            results[name].update(scheduler.statistics())
+    return results
+
+
+def measure_roi_detection(path_to_video, path_to_detector="best.pt", iou_threshold=0.5, **roi_parameters):
+    """
+    :param path_to_video: str
+    :param path_to_detector: str
+    :param iou_threshold: float, overlap of a box with a box of the full-frame run counting it as found
+    :param roi_parameters: RoiDetector parameters
+    :return: results: dict
+    Compares frames/sec of detecting full frames with track-guided region detection,
+    and the fraction of the full-frame boxes also found with region detection
+    """
+    results = {}
+    boxes = {}
+    for name, roi_detector in (("full_frame", None), ("roi", RoiDetector(**roi_parameters))):
+        face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, region_detector=roi_detector)
+        start_time = time.perf_counter()
+        boxes[name] = [np.array([d.bbox for d in detected_objects]).reshape(-1, 4)
+                       for detected_objects in face_tracks_finder]
+        elapsed = time.perf_counter() - start_time
+        results[name] = {"frames_per_second": len(boxes[name]) / elapsed if elapsed > 0 else 0.0}
+        if roi_detector is not None:
+            results[name].update(roi_detector.statistics())
+    found = total = 0
+    for reference_boxes, roi_boxes in zip(boxes["full_frame"], boxes["roi"]):
+        total += len(reference_boxes)
+        if len(reference_boxes) and len(roi_boxes):
+            found += int((box_iou(reference_boxes, roi_boxes).max(axis=1) >= iou_threshold).sum())
+    results["roi"]["recall"] = found / total if total else 1.0
+    return results
+
+
+def measure_motion_gate(path_to_video, path_to_detector="best.pt", iou_threshold=0.5, **gate_parameters):
+    """
+    :param path_to_video: str, footage of a fixed camera
+    :param path_to_detector: str
+    :param iou_threshold: float, overlap of a box with a box of the ungated run counting it as found
+    :param gate_parameters: MotionGate parameters
+    :return: results: dict
+    Compares frames/sec of detecting every frame with motion-gated detection, the fractions of frames and pixels
+    the gate skipped, and the fraction of the ungated boxes also found with the gate
+    """
+    results = {}
+    boxes = {}
+    for name, motion_gate in (("every_frame", None), ("motion_gate", MotionGate(**gate_parameters))):
+        face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, motion_gate=motion_gate)
+        start_time = time.perf_counter()
+        boxes[name] = [np.array([d.bbox for d in detected_objects]).reshape(-1, 4)
+                       for detected_objects in face_tracks_finder]
+        elapsed = time.perf_counter() - start_time
+        results[name] = {"frames_per_second": len(boxes[name]) / elapsed if elapsed > 0 else 0.0}
+        if motion_gate is not None:
+            results[name].update(motion_gate.statistics())
+    found = total = 0
+    for reference_boxes, gated_boxes in zip(boxes["every_frame"], boxes["motion_gate"]):
+        total += len(reference_boxes)
+        if len(reference_boxes) and len(gated_boxes):
+            found += int((box_iou(reference_boxes, gated_boxes).max(axis=1) >= iou_threshold).sum())
+    results["motion_gate"]["recall"] = found / total if total else 1.0
+    return results
+
+
+def measure_tiled_detection(path_to_video, path_to_detector="best.pt", iou_threshold=0.5, **tiling_parameters):
+    """
+    :param path_to_video: str
+    :param path_to_detector: str
+    :param iou_threshold: float, overlap of two boxes counting them as the same face
+    :param tiling_parameters: TiledDetector parameters
+    :return: results: dict
+    Compares frames/sec and face boxes found by detecting whole frames with tiled detection,
+    recall_gain is the number of boxes found only by tiled detection relative to the boxes of whole frames
+    """
+    results = {}
+    boxes = {}
+    for name, tiled_detector in (("full_frame", None), ("tiled", TiledDetector(**tiling_parameters))):
+        face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, region_detector=tiled_detector)
+        start_time = time.perf_counter()
+        boxes[name] = [np.array([d.bbox for d in detected_objects]).reshape(-1, 4)
+                       for detected_objects in face_tracks_finder]
+        elapsed = time.perf_counter() - start_time
+        results[name] = {"frames_per_second": len(boxes[name]) / elapsed if elapsed > 0 else 0.0,
+                         "boxes": sum(len(frame_boxes) for frame_boxes in boxes[name])}
+        if tiled_detector is not None:
+            results[name].update(tiled_detector.statistics())
+            tiled_detector.close()
+    found_only_tiled = 0
+    for reference_boxes, tiled_boxes in zip(boxes["full_frame"], boxes["tiled"]):
+        if not len(reference_boxes):
+            found_only_tiled += len(tiled_boxes)
+        elif len(tiled_boxes):
+            found_only_tiled += int((box_iou(tiled_boxes, reference_boxes).max(axis=1) < iou_threshold).sum())
+    results["tiled"]["recall_gain"] = found_only_tiled / max(1, results["full_frame"]["boxes"])
+    results["tiled"]["relative_throughput"] = (results["tiled"]["frames_per_second"]
+                                               / max(results["full_frame"]["frames_per_second"], 1e-12))
+    return results
+
+
+def compare_detector_backends(path_to_video, models=None, frames_count=100, batch_size=8, threads=None,
+                              iou_threshold=0.5):
+    """
+    :param path_to_video: str
+    :param models: dict of backend name to model path, best.pt for ultralytics and best.onnx for the others by default
+    :param frames_count: int, frames of the video used
+    :param batch_size: int, frames per call when measuring throughput
+    :param threads: int or None, intra-op threads of the CPU backends
+    :param iou_threshold: float, overlap of a box with a box of the first backend counting it as the same detection
+    :return: results: dict
+    Measures single-frame latency, batched throughput and load time of every backend,
+    and how closely its detections match those of the first backend
+    """
+    models = models or {DETECTOR_ULTRALYTICS: "best.pt",
+                        DETECTOR_ONNXRUNTIME: "best.onnx",
+                        DETECTOR_OPENCV: "best.onnx"}
+    video_capture = cv2.VideoCapture(path_to_video)
+    frames = [frame for _, frame in zip(range(frames_count), iterate_frames(video_capture))]
+    video_capture.release()
+
+    results = {}
+    reference = None
+    for backend, path_to_detector in models.items():
+        start_time = time.perf_counter()
+        try:
+            detector = load_detector(path_to_detector, backend, threads=threads)
+        except (ImportError, OSError, cv2.error) as error:
+            results[backend] = {"error": repr(error)}
+            continue
+        load_time = time.perf_counter() - start_time
+        detector(frames[:1])
+
+        latencies = []
+        detections = []
+        for frame in frames:
+            start_time = time.perf_counter()
+            detections.append(np.asarray(detector([frame])[0]).reshape(-1, 6))
+            latencies.append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        for start in range(0, len(frames), batch_size):
+            detector(frames[start:start + batch_size])
+        elapsed = time.perf_counter() - start_time
+
+        results[backend] = {"load_seconds": load_time,
+                            "median_latency_milliseconds": 1000 * float(np.median(latencies)),
+                            "frames_per_second": len(frames) / elapsed if elapsed > 0 else 0.0}
+        if reference is None:
+            reference = detections
+            continue
+        matched = total = 0
+        deviations = []
+        for reference_boxes, boxes in zip(reference, detections):
+            total += len(reference_boxes)
+            if len(reference_boxes) and len(boxes):
+                ious = box_iou(reference_boxes[:, :4], boxes[:, :4])
+                matched += int((ious.max(axis=1) >= iou_threshold).sum())
+                deviations += (1 - ious.max(axis=1)).tolist()
+        results[backend]["matched_fraction"] = matched / total if total else 1.0
+        results[backend]["mean_box_deviation"] = float(np.mean(deviations)) if deviations else 0.0
+    return results
+
+
+def measure_blur_renderers(frame_size=(2160, 3840), faces=5, face_size=300, repeats=20):
+    """
+    :param frame_size: (height, width)
+    :param faces: int
+    :param face_size: int
+    :param repeats: int
+    :return: results: dict
+    Compares milliseconds per frame of blur_face called for every face with blur_faces in every mode
+    """
+    random_generator = np.random.default_rng(0)
+    frame = random_generator.integers(0, 256, (*frame_size, 3), dtype=np.uint8)
+    corners = random_generator.integers(0, [frame_size[1] - face_size, frame_size[0] - face_size], (faces, 2))
+    boxes = np.hstack([corners, corners + face_size]).astype(np.float64)
+
+    def blur_every_face(image):
+        for bbox in boxes:
+            image = blur_face(image, bbox)
+
+    renderers = {"blur_face": blur_every_face}
+    for mode in BLUR_MODES:
+        renderers[f"blur_faces[{mode}]"] = lambda image, mode=mode: blur_faces(image, boxes, mode=mode)
+
+    results = {}
+    for name, renderer in renderers.items():
+        image = frame.copy()
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            renderer(image)
+        results[name] = (time.perf_counter() - start_time) / repeats * 1000
+    return results
+
+
+def compare_tracking_modes(path_to_video, path_to_detector="best.pt", detection_threshold=0.5):
+    """
+    :param path_to_video: str, a short clip, all decoded frames are kept in memory
+    :param path_to_detector: str
+    :param detection_threshold: float
+    :return: results: dict
+    Tracks the same detections with every tracking mode and reports tracking cost per frame,
+    embedded boxes and id switches against the deepsort mode
+    """
+    detector = FaceTracksFinder(path_to_video, path_to_detector, detection_threshold).detector
+    video_capture = cv2.VideoCapture(path_to_video)
+    detected_frames = [detected_frame for frames in frame_batches(video_capture, 8)
+                       for detected_frame in detect_frames(detector, frames, detection_threshold)]
+    video_capture.release()
+
+    results = {}
+    tracks_per_mode = {}
+    for mode in TRACKING_MODES:
+        tracker = Tracker(mode)
+        tracks_per_mode[mode] = [track_detections(tracker, frame, detections) for frame, detections in detected_frames]
+        results[mode] = tracker.statistics()
+    for mode in TRACKING_MODES:
+        results[mode]["id_switches"] = count_id_switches(tracks_per_mode[TRACKING_DEEPSORT], tracks_per_mode[mode])
+    return results
+
+
+# Run in a child process, so every measurement starts from a cold interpreter. Prints the time of showing
+# the window and, after waiting choose_file_seconds like a user choosing a video, of the first tracked frame.
+_STARTUP_SCRIPT = """
+import time
+start_time = time.perf_counter()
+{preload}
+from PyQt6.QtWidgets import QApplication
+import main
+from blurring_faces import FaceTracksFinder
+if not {warmup}:
+    main.ModelWarmup.start = lambda self: None
+application = QApplication([])
+window = main.MainWindow()
+window.show()
+application.processEvents()
+print("window", time.perf_counter() - start_time, flush=True)
+while time.perf_counter() - start_time < {choose_file_seconds}:
+    application.processEvents()
+    time.sleep(0.01)
+click_time = time.perf_counter()
+detector, image_encoder = window.model_warmup.result() if {warmup} else (None, None)
+next(FaceTracksFinder({path_to_video!r}, detector=detector, image_encoder=image_encoder))
+print("detection", time.perf_counter() - click_time, flush=True)
+window.close()
+"""
+
+# What importing main used to load before the window could be shown
+_EAGER_IMPORTS = "import ultralytics\nimport torch\nfrom deep_sort.tools import generate_detections"
+
+
+def measure_startup(path_to_video, choose_file_seconds=3.0):
+    """
+    :param path_to_video: str
+    :param choose_file_seconds: float, time the user takes to choose a video after the window appears
+    :return: results: dict
+    Compares time to the first shown window and time from clicking FIND FACES to the first tracked frame
+    with the heavy libraries imported up front and models loaded on the click, as before lazy imports,
+    and with lazy imports and the background model warm-up.
+    Measured on one Xeon core with offscreen PyQt6, PyTorch 2.14, TensorFlow 2.21, yolov8n as best.pt and an encoder
+    graph laid out like mars-small128: eager, the window shows after 7.5-8.1 s and the first detection comes
+    2.5-2.8 s after the click; lazy with warm-up, the window shows after 1.1-1.2 s and the first detection comes
+    0.2-1.3 s after a click 10 s later, but 7.8-8.2 s after a click 3 s later, as the warm-up takes about 10 s
+    on one core and the click waits for it.
+    """
+    results = {}
+    environment = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    for name, preload, warmup in (("eager", _EAGER_IMPORTS, False), ("lazy_with_warmup", "", True)):
+        script = _STARTUP_SCRIPT.format(preload=preload, choose_file_seconds=choose_file_seconds, warmup=warmup,
+                                        path_to_video=path_to_video)
+        start_time = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), env=environment)
+        results[name] = {}
+        for line in process.stdout:
+            event, seconds = line.split()
+            if event == "window":
+                # Includes interpreter startup, measured from the launch of the process
+                results[name]["time_to_first_window_seconds"] = time.perf_counter() - start_time
+            elif event == "detection":
+                results[name]["time_to_first_detection_seconds"] = float(seconds)
+        process.wait()
+    return results
+
+
+def count_id_switches(reference_tracks, tracks, iou_threshold=0.5):
+    """
+    :param reference_tracks: list of lists of DetectedObject
+    :param tracks: list of lists of DetectedObject
+    :param iou_threshold: float
+    :return: id_switches: int
+    Counts how many times the id matched to a reference track changes
+    """
+    assigned_ids = {}
+    id_switches = 0
+    for reference_objects, detected_objects in zip(reference_tracks, tracks):
+        if not reference_objects or not detected_objects:
+            continue
+        ious = box_iou([d.bbox for d in reference_objects], [d.bbox for d in detected_objects])
+        used_rows, used_columns = set(), set()
+        for i, j in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+            if ious[i, j] < iou_threshold:
+                break
+            if i in used_rows or j in used_columns:
+                continue
+            used_rows.add(i)
+            used_columns.add(j)
+            reference_id, track_id = reference_objects[i].id, detected_objects[j].id
+            if assigned_ids.get(reference_id, track_id) != track_id:
+                id_switches += 1
+            assigned_ids[reference_id] = track_id
+    return id_switches
+
+
+if __name__ == "__main__":
+    for name, milliseconds in measure_blur_renderers().items():
+        print(f"{name}: {milliseconds:.2f} ms/frame")
+    video = sys.argv[1] if len(sys.argv) > 1 else "full_faces.mp4"
+    for size, fps in measure_batch_throughput(video).items():
+        print(f"batch_size={size}: {fps:.1f} frames/sec")
+    for name, statistics in measure_detection_scheduling(video).items():
+        print(f"{name}: {statistics}")
+    for name, statistics in measure_roi_detection(video).items():
+        print(f"{name}: {statistics}")
+    for name, statistics in measure_motion_gate(video).items():
+        print(f"{name}: {statistics}")
+    for name, statistics in measure_tiled_detection(video).items():
+        print(f"{name}: {statistics}")
+    for backend, statistics in compare_detector_backends(video).items():
+        print(f"{backend}: {statistics}")
+    for name, statistics in measure_startup(video).items():
+        print(f"{name}: {statistics}")
+    for mode, statistics in compare_tracking_modes(video).items():
+        print(f"{mode}: {statistics['milliseconds_per_frame']:.2f} ms/frame, "
+              f"{statistics['embedded_boxes']} embedded boxes, {statistics['id_switches']} id switches")
@@ -1,95 +1,440 @@
 import copy
+import threading
+from collections import deque
 import cv2
-from ultralytics import YOLO
-from tracker import Tracker
+from detector_backends import load_detector, DETECTOR_ULTRALYTICS
+from frame_transport import frame_ring_for, ring_frame_batches
+from tracker import Tracker, TRACKING_DEEPSORT
+from pipeline import Pipeline
+from profiling import DISABLED_PROFILER
+from track_store import DetectedObject
 import numpy as np
 
 
-class DetectedObject:
-    """
-    Reproduce detected object
-    """
-    def __init__(self, object_id, object_bbox):
-        self.id = object_id
-        self.bbox = object_bbox
-
-
 class FaceTracksFinder:
     """
     This class helps to find tracks of faces with identities
     """
-    def __init__(self, path_to_video="", path_to_detector="best.pt", detection_threshold=0.5):
+    def __init__(self, path_to_video="", path_to_detector="best.pt", detection_threshold=0.5, batch_size=1,
+                 pipelined=False, max_queue_size=4, track_cache=None, start_frame=0, end_frame=None,
+                 tracking_mode=TRACKING_DEEPSORT, detection_scheduler=None, track_postprocessor=None, detector=None,
+                 image_encoder=None, checkpoints=None, region_detector=None, detector_backend=DETECTOR_ULTRALYTICS,
+                 detector_threads=None, profiler=None, motion_gate=None, frame_ring=None):
+        """
+        :param detector: loaded detector to share between finders, see load_detector,
+        loaded from path_to_detector with detector_backend when None
+        :param image_encoder: loaded appearance encoder to share between finders, see Tracker
+        :param checkpoints: CheckpointStore, searches of whole videos save checkpoints to it and resume from them,
+        iteration first replays the frames of the checkpoint. Not used with pipelined=True,
+        where the tracker runs ahead of the returned frames.
+        :param region_detector: RoiDetector or TiledDetector, detects regions of the frames instead of whole frames
+        :param profiler: Profiler, records the decode, detect, embed and track stages and every returned frame
+        :param motion_gate: MotionGate, frames without motion reuse the previous tracks,
+        frames with motion are detected only around it
+        :param frame_ring: SharedFrameRing the frames are decoded into, with at least batch_size slots as large as
+        the frames, a private ring sized for the video when None
+        """
         self.path_to_video = path_to_video
         self.path_to_detector_model = path_to_detector
         self.detection_threshold = detection_threshold
-        self.video_capture = cv2.VideoCapture(self.path_to_video)
-        self.detector = YOLO(self.path_to_detector_model)
-        self.tracker = Tracker()
-        self.current_frame_number = 0
-        self.ret, self.frame = self.video_capture.read()
+        self.batch_size = max(1, int(batch_size))
+        self.pipelined = pipelined
+        self.max_queue_size = max_queue_size
+        self.track_cache = track_cache
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.tracking_mode = tracking_mode
+        self.detection_scheduler = detection_scheduler
+        self.track_postprocessor = track_postprocessor
+        self.checkpoints = checkpoints
+        self.region_detector = region_detector
+        self.motion_gate = motion_gate
+        self.frame_ring = frame_ring
+        self.pipeline = None
+        self.profiler = profiler or DISABLED_PROFILER
+        self.detector = detector or load_detector(self.path_to_detector_model, detector_backend,
+                                                  threads=detector_threads)
+        self.tracker = Tracker(self.tracking_mode, image_encoder, profiler=self.profiler)
+        self.current_frame_number = self.start_frame
+        self.tracked_frames = deque()
+        # The checkpoint is resumed and the video opened by the first __next__, get_face_tracks needs neither
+        self.checkpointer = None
+        self.video_capture = None
+        self.tracked_batches = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        while True:
-            if not self.ret:
+        if self.tracked_batches is None:
+            self.start_tracking()
+        while not self.tracked_frames:
+            if self.checkpointer is not None:
+                self.checkpointer.save_if_due(self.tracker)
+            batch = next(self.tracked_batches, None)
+            if batch is None:
+                if self.checkpointer is not None:
+                    self.checkpointer.finish()
+                self.close()
                 raise StopIteration
-            results = self.detector(self.frame)
-            for result in results:
-                detections = []
-                for r in result.boxes.data.tolist():
-                    x1, y1, x2, y2, score, _ = r
-                    if score > self.detection_threshold:
-                        detections.append([x1, y1, x2, y2, score])
-
-                detected_objects_on_frame = []
-                if detections:
-                    self.tracker.update(self.frame, detections)
-                    if self.tracker.tracks:
-                        for track in self.tracker.tracks:
-                            bounding_box = track.bounding_box
-                            track_id = track.track_id
-                            detected_objects_on_frame.append(DetectedObject(track_id, bounding_box))
-                self.ret, self.frame = self.video_capture.read()
-                self.current_frame_number += 1
-                return detected_objects_on_frame
+            if self.checkpointer is not None:
+                self.checkpointer.record(batch)
+            self.tracked_frames.extend(batch)
+        self.current_frame_number += 1
+        detected_objects = self.tracked_frames.popleft()
+        if self.profiler.enabled:
+            self.profiler.frame(len(detected_objects))
+        return detected_objects
+
+    def start_tracking(self):
+        """
+        Resumes the checkpoint of the search, if any, and opens the video for iteration
+        """
+        self.checkpointer = self.open_checkpoint()
+        resume_frame = 0
+        if self.checkpointer is not None:
+            resume_frame = self.checkpointer.resume(self.tracker)
+            self.tracked_frames.extend(self.checkpointer.tracks)
+        self.video_capture = open_video(self.path_to_video, self.start_frame + resume_frame)
+        self.tracked_batches = self.track_batches(self.video_capture, self.detector, self.tracker)
+
+    def close(self):
+        """
+        Releases the video opened for iteration, iteration ends afterwards
+        """
+        if self.video_capture is None:
+            return
+        # Stops the pipeline of the batches before the video is released
+        self.tracked_batches.close()
+        self.video_capture.release()
+        self.video_capture = None
+        self.tracked_batches = iter(())
+
+    def track_batches(self, video_capture, detector, tracker):
+        """
+        :param video_capture: cv2.VideoCapture
+        :param detector: detector, see load_detector
+        :param tracker: Tracker
+        :return: generator of lists of detected objects, one list per frame
+        Decodes up to batch_size frames ahead, runs a single detector call on all of them
+        and feeds the results to the tracker in frame order.
+        With pipelined=True decode, detection and tracking run in separate workers.
+        With a detection_scheduler the detector runs only on the frames it selects,
+        the other frames get the boxes predicted by the tracker.
+        With a region_detector frames are detected one by one, by regions chosen by it.
+        With a motion_gate frames are checked for motion one by one before detection.
+        Frames are decoded into the slots of a frame ring, which are reused once their batch has been tracked.
+        """
+        def detect_batch(frames):
+            return detect_frames(detector, frames, self.detection_threshold)
+
+        detect_batch = self.profiler.timed("detect", detect_batch)
+
+        def detect(slotted_frames):
+            slots, frames = slotted_frames
+            return slots, detect_batch(frames)
+
+        def track(slotted_detections):
+            slots, detected_frames = slotted_detections
+            detected_objects = track_detections_batch(tracker, detected_frames)
+            ring.release_all(slots)
+            return detected_objects
+
+        frames_count = None if self.end_frame is None else self.end_frame - self.start_frame
+        ring, first_frame = self.frame_ring, None
+        if ring is None:
+            # Batches in flight are bounded by the pipeline queues, a batch is released before the next one otherwise
+            batches_in_flight = 2 * self.max_queue_size + 3 if self.pipelined else 1
+            ring, first_frame = frame_ring_for(video_capture, self.batch_size * batches_in_flight, shared=False)
+        stop_event = threading.Event()
+        batches = self.profiler.iterate("decode", ring_frame_batches(video_capture, ring, self.batch_size, frames_count,
+                                                                     stop_event, first_frame))
+        if self.detection_scheduler is not None or self.region_detector is not None or self.motion_gate is not None:
+            yield from self.track_scheduled_batches(batches, detector, tracker, ring)
+            return
+        if not self.pipelined:
+            for slotted_frames in batches:
+                yield track(detect(slotted_frames))
+            return
+
+        self.pipeline = Pipeline(batches, [("detect", detect), ("track", track)], self.max_queue_size,
+                                 stop_event=stop_event)
+        try:
+            yield from self.pipeline
+        finally:
+            self.pipeline.close()
+
+    def track_scheduled_batches(self, batches, detector, tracker, ring):
+        """
+        :param batches: iterable of (slots, frames), see ring_frame_batches
+        :param detector: detector, see load_detector
+        :param tracker: Tracker
+        :param ring: SharedFrameRing holding the frames, their slots are released once tracked
+        :return: generator of lists of detected objects, one list per frame
+        Tracks frame by frame, detecting on the frames selected by the detection_scheduler, or on all of them
+        """
+        if self.detection_scheduler is not None:
+            self.detection_scheduler.reset()
+        if self.region_detector is not None:
+            self.region_detector.reset()
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+        detect_frame = self.profiler.timed("detect", self.detect_frame)
+        detected_objects_on_frame = []
+        for slots, frames in batches:
+            tracked_frames = []
+            for frame in frames:
+                if self.motion_gate is not None and not self.motion_gate.check(frame):
+                    # Nothing moved since the last detection, so neither did the faces
+                    tracked_frames.append(detected_objects_on_frame)
+                    continue
+                if self.detection_scheduler is None or self.detection_scheduler.should_detect(
+                        frame, tracker.prediction_uncertainty()):
+                    detections = detect_frame(detector, tracker, frame)
+                    detected_objects_on_frame = track_detections(tracker, frame, detections)
+                    if self.detection_scheduler is not None:
+                        # Without detections the tracker is not updated, so every face was lost
+                        self.detection_scheduler.tracks_detected(tracker.updated_track_ids() if len(detections) else ())
+                elif detected_objects_on_frame:
+                    # Nothing is predicted when the last detection found no faces
+                    detected_objects_on_frame = [DetectedObject(track.track_id, track.bounding_box,
+                                                                feature=track.feature)
+                                                 for track in tracker.predict()]
+                tracked_frames.append(detected_objects_on_frame)
+            ring.release_all(slots)
+            yield tracked_frames
+
+    def detect_frame(self, detector, tracker, frame):
+        """
+        :return: detections: list of [x1, y1, x2, y2, score]
+        """
+        if self.motion_gate is not None and self.motion_gate.regions is not None:
+            return self.motion_gate.detect(detector, frame, self.detection_threshold)
+        if self.region_detector is None:
+            detections = detect_frames(detector, [frame], self.detection_threshold)[0][1]
+        else:
+            detections = self.region_detector.detect(detector, frame, tracker.predicted_boxes(),
+                                                     self.detection_threshold)
+        if self.motion_gate is not None:
+            self.motion_gate.remember(detections)
+        return detections
+
+    def queue_depths(self):
+        """
+        :return: depths: dict
+        Returns the queue depth of every pipeline stage, empty if the pipeline is not running
+        """
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.queue_depths()
 
     def get_face_tracks(self):
         """
         :return:
-        Returns the full set of tracks not by iterating
+        Returns the full set of tracks not by iterating,
+        tracks are taken from and saved to track_cache when it is set,
+        cached tracks come back as a TrackStore,
+        with a track_postprocessor the tracks are cleaned up by it and come back as a TrackStore
         """
-        video_capture = cv2.VideoCapture(self.path_to_video)
-        ret, frame = video_capture.read()
-        model = YOLO(self.path_to_detector_model)
-        tracker = Tracker()
-        n = 0
+        use_cache = self.track_cache is not None and self.start_frame == 0 and self.end_frame is None
+        if use_cache:
+            cached_tracks = self.track_cache.load(self.path_to_video, self.path_to_detector_model,
+                                                  **self.cache_parameters())
+            if cached_tracks is not None:
+                return self.postprocess(cached_tracks)
+
+        # A fresh tracker state, the loaded models are reused
+        tracker = Tracker(self.tracking_mode, self.tracker.image_encoder, profiler=self.profiler)
         detected_objects = []
-        while ret:
-            results = model.predict(frame)
-            for result in results:
-                detections = []
-                for r in result.boxes.data.tolist():
-                    x1, y1, x2, y2, score, _ = r
-                    if score > self.detection_threshold:
-                        detections.append([x1, y1, x2, y2, score])
-
-                detected_objects_on_frame = []
-                if detections:
-                    tracker.update(frame, detections)
-                    if tracker.tracks:
-                        for track in tracker.tracks:
-                            bounding_box = track.bounding_box
-                            track_id = track.track_id
-                            detected_objects_on_frame.append(DetectedObject(track_id, bounding_box))
-                detected_objects.append(detected_objects_on_frame)
-            n += 1
-            ret, frame = video_capture.read()
+        checkpointer = self.open_checkpoint()
+        resume_frame = 0
+        if checkpointer is not None:
+            resume_frame = checkpointer.resume(tracker)
+            detected_objects.extend(checkpointer.tracks)
+        video_capture = open_video(self.path_to_video, self.start_frame + resume_frame)
+        for batch in self.track_batches(video_capture, self.detector, tracker):
+            detected_objects.extend(batch)
+            if self.profiler.enabled:
+                for frame_objects in batch:
+                    self.profiler.frame(len(frame_objects))
+            if checkpointer is not None:
+                checkpointer.record(batch)
+                checkpointer.save_if_due(tracker)
 
         video_capture.release()
+        if checkpointer is not None:
+            checkpointer.finish()
+        if use_cache:
+            self.track_cache.store(detected_objects, self.path_to_video, self.path_to_detector_model,
+                                   **self.cache_parameters())
 
-        return detected_objects
+        return self.postprocess(detected_objects)
+
+    def open_checkpoint(self):
+        """
+        :return: Checkpointer or None when the search is not checkpointed
+        """
+        if self.checkpoints is None or self.pipelined or self.start_frame != 0 or self.end_frame is not None:
+            return None
+        return self.checkpoints.open(self.path_to_video, self.path_to_detector_model, **self.cache_parameters())
+
+    def cache_parameters(self):
+        """
+        :return: parameters: dict
+        Returns the parameters the tracks depend on, which key the track cache and the checkpoints
+        """
+        return track_cache_parameters(self.detection_threshold, self.tracking_mode, self.region_detector,
+                                      self.motion_gate)
+
+    def postprocess(self, tracks):
+        if self.track_postprocessor is None:
+            return tracks
+        return self.track_postprocessor(tracks)
+
+
+def track_cache_parameters(detection_threshold=0.5, tracking_mode=TRACKING_DEEPSORT, region_detector=None,
+                           motion_gate=None):
+    """
+    :return: parameters: dict
+    Returns the cache parameters of a FaceTracksFinder with these settings, see FaceTracksFinder.cache_parameters,
+    for looking tracks up in the cache before a finder and its models are loaded
+    """
+    parameters = {"detection_threshold": detection_threshold, "tracking_mode": tracking_mode}
+    if region_detector is not None:
+        parameters["region_detector"] = region_detector.settings()
+    if motion_gate is not None:
+        parameters["motion_gate"] = motion_gate.settings()
+    return parameters
+
+
+def open_video(path_to_video, start_frame=0):
+    """
+    :param path_to_video: str
+    :param start_frame: int
+    :return: video_capture: cv2.VideoCapture
+    Opens the video positioned at start_frame, or at its end when it is shorter
+    """
+    video_capture = cv2.VideoCapture(path_to_video)
+    if not start_frame:
+        return video_capture
+    video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    # Seeking is not frame-accurate in every container, e.g. past the index of a file still being written,
+    # so the position the seek landed on is checked and the remaining frames are decoded and skipped
+    position = int(video_capture.get(cv2.CAP_PROP_POS_FRAMES))
+    if position > start_frame or position < 0:
+        video_capture.release()
+        video_capture = cv2.VideoCapture(path_to_video)
+        position = 0
+    for _ in range(start_frame - position):
+        if not video_capture.grab():
+            break
+    return video_capture
+
+
+def frame_batches(video_capture, batch_size, frames_count=None):
+    """
+    :param video_capture: cv2.VideoCapture
+    :param batch_size: int
+    :param frames_count: int or None, reads until the end of the video when None
+    :return: generator of lists of frames
+    Decodes the video in lists of up to batch_size frames
+    """
+    while frames_count is None or frames_count > 0:
+        count = batch_size if frames_count is None else min(batch_size, frames_count)
+        frames = read_frames(video_capture, count)
+        if not frames:
+            return
+        yield frames
+        if frames_count is not None:
+            frames_count -= len(frames)
+
+
+def iterate_frames(video_capture):
+    """
+    :param video_capture: cv2.VideoCapture
+    :return: generator of frames
+    Decodes the video frame by frame
+    """
+    ret, frame = video_capture.read()
+    while ret:
+        yield frame
+        ret, frame = video_capture.read()
+
+
+def read_frames(video_capture, count):
+    """
+    :param video_capture: cv2.VideoCapture
+    :param count: int
+    :return: frames: list
+    Reads up to count frames, an empty list means the end of the video
+    """
+    frames = []
+    while len(frames) < count:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    return frames
+
+
+def detect_frames(detector, frames, detection_threshold):
+    """
+    :param detector: detector, see load_detector
+    :param frames: list
+    :param detection_threshold: float
+    :return: detected_frames: list of (frame, detections) tuples
+    Runs a single detector call on the whole list of frames
+    """
+    results = detector(frames)
+    return [(frame, extract_detections(result, detection_threshold)) for frame, result in zip(frames, results)]
+
+
+def extract_detections(result, detection_threshold):
+    """
+    :param result: detector result for a single frame, [x1, y1, x2, y2, score, class] rows or an ultralytics result
+    :param detection_threshold: float
+    :return: detections: list
+    Returns [x1, y1, x2, y2, score] boxes whose score is above the threshold
+    """
+    rows = result.boxes.data.tolist() if hasattr(result, "boxes") else np.asarray(result).tolist()
+    detections = []
+    for r in rows:
+        x1, y1, x2, y2, score, _ = r
+        if score > detection_threshold:
+            detections.append([x1, y1, x2, y2, score])
+    return detections
+
+
+def track_detections(tracker, frame, detections):
+    """
+    :param tracker: Tracker
+    :param frame: np.ndarray
+    :param detections: list
+    :return: detected_objects_on_frame: list
+    Feeds one frame's detections to the tracker and returns the tracked objects on it
+    """
+    detected_objects_on_frame = []
+    if detections:
+        tracker.update(frame, detections)
+        if tracker.tracks:
+            for track in tracker.tracks:
+                bounding_box = track.bounding_box
+                track_id = track.track_id
+                detected_objects_on_frame.append(DetectedObject(track_id, bounding_box, feature=track.feature))
+    return detected_objects_on_frame
+
+
+def track_detections_batch(tracker, detected_frames):
+    """
+    :param tracker: Tracker
+    :param detected_frames: list of (frame, detections) tuples
+    :return: detected_objects: list of lists of detected objects, one list per frame
+    Feeds a batch of frames to the tracker, appearance features of the whole batch are computed in one call
+    """
+    frames = [frame for frame, _ in detected_frames]
+    tracks_per_frame = tracker.update_batch(frames, [detections for _, detections in detected_frames])
+    return [[DetectedObject(track.track_id, track.bounding_box, feature=track.feature) for track in tracks]
+            for tracks in tracks_per_frame]
 
 
 def remove_noise_from_tracks(tracks):
@@ -126,4 +471,68 @@ def blur_face(image, bbox, core=(25, 25), sigma=10):
     return final_image
 
 
+BLUR_GAUSSIAN = "gaussian"
+BLUR_PIXELATE = "pixelate"
+BLUR_DOWNSCALE = "downscale"
+BLUR_FILL = "fill"
+BLUR_MODES = (BLUR_GAUSSIAN, BLUR_PIXELATE, BLUR_DOWNSCALE, BLUR_FILL)
+DEFAULT_BLUR_STRENGTH = 10
+
+
+def blur_faces(image, boxes, strengths=DEFAULT_BLUR_STRENGTH, mode=BLUR_GAUSSIAN, core=(25, 25),
+               fill_color=(0, 0, 0)):
+    """
+    :param image: np.ndarray, modified in place
+    :param boxes: array of [x1, y1, x2, y2] boxes
+    :param strengths: number or a number per box, gaussian sigma for BLUR_GAUSSIAN,
+    block size / 2 for BLUR_PIXELATE and the downscale factor for BLUR_DOWNSCALE
+    :param mode: one of BLUR_MODES
+    :param core: gaussian kernel size
+    :param fill_color: colour for BLUR_FILL
+    :return: image: np.ndarray
+    Blurs all faces of a frame in one pass, working only on the boxes clipped to the frame.
+    Every region is rendered from the original pixels before any of them is written back,
+    so overlapping boxes are not blurred twice, and the strongest box wins on the overlap.
+    """
+    if image is None or boxes is None:
+        raise Exception("Image and bounding boxes must not be None")
+    if mode not in BLUR_MODES:
+        raise ValueError(f"Unknown blur mode {mode}, expected one of {BLUR_MODES}")
+    height, width = image.shape[:2]
+    if np.isscalar(strengths):
+        strengths = [strengths] * len(boxes)
+
+    regions = []
+    for bbox, strength in zip(boxes, strengths):
+        x1, y1, x2, y2 = np.asarray(bbox).astype(int)
+        x1, x2 = max(x1, 0), min(x2, width)
+        y1, y2 = max(y1, 0), min(y2, height)
+        if x1 < x2 and y1 < y2:
+            regions.append((strength, x1, y1, x2, y2))
+    regions.sort(key=lambda region: region[0])
+
+    if mode == BLUR_FILL:
+        for _, x1, y1, x2, y2 in regions:
+            image[y1:y2, x1:x2] = fill_color
+        return image
+
+    rendered_regions = [(x1, y1, x2, y2, _render_region(image[y1:y2, x1:x2], strength, mode, core))
+                        for strength, x1, y1, x2, y2 in regions]
+    for x1, y1, x2, y2, rendered_region in rendered_regions:
+        image[y1:y2, x1:x2] = rendered_region
+    return image
+
 
+def _render_region(region, strength, mode, core):
+    height, width = region.shape[:2]
+    if mode == BLUR_GAUSSIAN:
+        return cv2.GaussianBlur(region, core, strength)
+    if mode == BLUR_PIXELATE:
+        block_size = max(2, int(2 * strength))
+        small = cv2.resize(region, (max(1, width // block_size), max(1, height // block_size)),
+                           interpolation=cv2.INTER_AREA)
+        return cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+    factor = max(1.0, float(strength))
+    small = cv2.resize(region, (max(1, int(width / factor)), max(1, int(height / factor))),
+                       interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    :param boxes_a: np.ndarray of [x1, y1, x2, y2]
+    :param boxes_b: np.ndarray of [x1, y1, x2, y2]
+    :return: ious: np.ndarray of shape (len(boxes_a), len(boxes_b))
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64)[:, None, :]
+    boxes_b = np.asarray(boxes_b, dtype=np.float64)[None, :, :]
+    width = np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(boxes_a[..., 0], boxes_b[..., 0])
+    height = np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(boxes_a[..., 1], boxes_b[..., 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-12)
@@ -0,0 +1,124 @@
+import os
+import pickle
+
+import numpy as np
+
+from track_cache import DEFAULT_CACHE_DIR, content_key
+from track_store import TrackStore
+
+CHECKPOINT_FORMAT_VERSION = 1
+DEFAULT_CHECKPOINT_DIR = os.path.join(DEFAULT_CACHE_DIR, "checkpoints")
+CHECKPOINT_FILE_SUFFIX = ".checkpoint"
+
+
+class CheckpointStore:
+    """
+    Checkpoints of face track searches still in progress, one per video, detector weights and detection parameters.
+    A checkpoint holds the tracks of the frames processed so far and the tracker state after the last of them,
+    so a search restarted after a crash continues from there instead of from the first frame.
+    """
+    def __init__(self, checkpoint_dir=DEFAULT_CHECKPOINT_DIR, interval=1000):
+        """
+        :param checkpoint_dir: str
+        :param interval: int, number of frames between checkpoints
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.interval = max(1, interval)
+
+    def path(self, path_to_video, path_to_detector, **parameters):
+        key = content_key(path_to_video, path_to_detector, version=CHECKPOINT_FORMAT_VERSION, **parameters)
+        return os.path.join(self.checkpoint_dir, key + CHECKPOINT_FILE_SUFFIX)
+
+    def open(self, path_to_video, path_to_detector, **parameters):
+        """
+        :return: Checkpointer
+        """
+        return Checkpointer(self, self.path(path_to_video, path_to_detector, **parameters))
+
+    def save(self, path, tracks, tracker):
+        """
+        :param path: str
+        :param tracks: TrackStore, tracks of every frame processed so far
+        :param tracker: Tracker, state after the last of these frames
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        checkpoint = {"version": CHECKPOINT_FORMAT_VERSION,
+                      "frame_number": len(tracks),
+                      "tracker": tracker.state()}
+        for name in ("offsets", "ids", "boxes", "scores"):
+            checkpoint[name] = np.array(getattr(tracks, name))
+        # Written aside and renamed, so a run killed while saving leaves the previous checkpoint intact
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    def load(self, path):
+        """
+        :param path: str
+        :return: (tracks, tracker_state) or None when there is no usable checkpoint
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as file:
+                checkpoint = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if checkpoint.get("version") != CHECKPOINT_FORMAT_VERSION:
+            return None
+        tracks = TrackStore(checkpoint["offsets"], checkpoint["ids"], checkpoint["boxes"], checkpoint["scores"])
+        return tracks, checkpoint["tracker"]
+
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Checkpointer:
+    """
+    Records the frames of one face track search and saves a checkpoint every interval frames
+    """
+    def __init__(self, checkpoint_store, path):
+        self.checkpoint_store = checkpoint_store
+        self.path = path
+        self.tracks = TrackStore()
+        self.saved_frames = 0
+
+    def resume(self, tracker):
+        """
+        :param tracker: Tracker, gets the saved state
+        :return: frame_number: int, first frame which still has to be processed, 0 without a checkpoint
+        """
+        checkpoint = self.checkpoint_store.load(self.path)
+        if checkpoint is None:
+            return 0
+        tracks, tracker_state = checkpoint
+        try:
+            tracker.restore_state(tracker_state)
+        except ValueError:
+            return 0
+        self.tracks = tracks
+        self.saved_frames = len(tracks)
+        return len(tracks)
+
+    def record(self, frames):
+        """
+        :param frames: list of lists of DetectedObject, the next processed frames
+        """
+        for detected_objects in frames:
+            self.tracks.append(detected_objects)
+
+    def save_if_due(self, tracker):
+        """
+        :param tracker: Tracker, must have processed exactly the recorded frames
+        """
+        if len(self.tracks) - self.saved_frames >= self.checkpoint_store.interval:
+            self.checkpoint_store.save(self.path, self.tracks, tracker)
+            self.saved_frames = len(self.tracks)
+
+    def finish(self):
+        """
+        Removes the checkpoint once the search is complete
+        """
+        self.checkpoint_store.remove(self.path)
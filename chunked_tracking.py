@@ -0,0 +1,162 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from blurring_faces import FaceTracksFinder
+from boxes import box_iou
+from track_store import DetectedObject, TrackStore
+
+
+class ChunkTracks:
+    """
+    Tracks found in one time chunk of a video.
+    The chunk is tracked from warm_start, frames warm_start:start overlap the previous chunk and are used for stitching.
+    """
+    def __init__(self, warm_start, start, tracks, head_features, tail_features):
+        self.warm_start = warm_start
+        self.start = start
+        self.tracks = tracks
+        self.head_features = head_features
+        self.tail_features = tail_features
+
+    def frame(self, frame_number):
+        return self.tracks.frame(frame_number - self.warm_start)
+
+    @property
+    def end(self):
+        return self.warm_start + len(self.tracks)
+
+
+def find_face_tracks_chunked(path_to_video, path_to_detector="best.pt", detection_threshold=0.5, workers=None,
+                             chunks=None, overlap=30, batch_size=1):
+    """
+    :param path_to_video: str
+    :param path_to_detector: str
+    :param detection_threshold: float
+    :param workers: int, number of processes, all CPUs by default
+    :param chunks: int, number of time chunks, one per worker by default
+    :param overlap: int, frames each chunk re-tracks from the end of the previous one
+    :param batch_size: int
+    :return: tracks: list of lists of DetectedObject
+    Finds face tracks of time chunks in separate processes and stitches track ids across chunk boundaries,
+    the result has the same per-frame format as FaceTracksFinder.get_face_tracks
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = chunks or workers
+    video_capture = cv2.VideoCapture(path_to_video)
+    frames_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_capture.release()
+
+    chunks = max(1, min(chunks, frames_count // max(1, 2 * overlap)))
+    starts = [round(i * frames_count / chunks) for i in range(chunks)]
+    tasks = []
+    for index, start in enumerate(starts):
+        # The last chunk runs to the end of the stream in case the container frame count is short
+        end = starts[index + 1] if index + 1 < chunks else None
+        tasks.append((path_to_video, path_to_detector, detection_threshold, batch_size,
+                      max(0, start - overlap), start, end, overlap))
+    with ProcessPoolExecutor(max_workers=min(workers, chunks)) as executor:
+        chunk_tracks = list(executor.map(_track_chunk, tasks))
+    return stitch_chunk_tracks(chunk_tracks)
+
+
+def _track_chunk(task):
+    path_to_video, path_to_detector, detection_threshold, batch_size, warm_start, start, end, overlap = task
+    face_tracks_finder = FaceTracksFinder(path_to_video, path_to_detector, detection_threshold, batch_size=batch_size,
+                                          start_frame=warm_start, end_frame=end)
+    tracks = TrackStore()
+    head_features = {}
+    tail_features = []
+    for frame_number, detected_objects in enumerate(face_tracks_finder, warm_start):
+        tracks.append(detected_objects)
+        frame_features = {d.id: d.feature for d in detected_objects if d.feature is not None}
+        if frame_number < start:
+            for track_id, feature in frame_features.items():
+                head_features.setdefault(track_id, []).append(feature)
+        tail_features.append(frame_features)
+        if len(tail_features) > overlap:
+            tail_features.pop(0)
+    return ChunkTracks(warm_start, start, tracks, _mean_features(head_features),
+                       _mean_features(_group_features(tail_features)))
+
+
+def _group_features(frames_features):
+    grouped = {}
+    for frame_features in frames_features:
+        for track_id, feature in frame_features.items():
+            grouped.setdefault(track_id, []).append(feature)
+    return grouped
+
+
+def _mean_features(grouped_features):
+    mean_features = {}
+    for track_id, features in grouped_features.items():
+        feature = np.mean(features, axis=0)
+        mean_features[track_id] = feature / max(np.linalg.norm(feature), 1e-12)
+    return mean_features
+
+
+def stitch_chunk_tracks(chunk_tracks, iou_threshold=0.3, appearance_threshold=0.2):
+    """
+    :param chunk_tracks: list of ChunkTracks in time order
+    :param iou_threshold: float, minimal mean box overlap of two tracks on the shared frames
+    :param appearance_threshold: float, maximal cosine distance of tracks which do not overlap
+    :return: tracks: list of lists of DetectedObject
+    Gives a track of a chunk the id of the previous chunk track it overlaps on the shared frames,
+    or failing that the one it looks most similar to, and a new id otherwise
+    """
+    tracks = []
+    next_id = 1
+    previous = None
+    previous_ids = {}
+    for chunk in chunk_tracks:
+        ids = {}
+        if previous is not None:
+            ids = _match_chunks(previous, previous_ids, chunk, iou_threshold, appearance_threshold)
+        for frame_number in range(chunk.start, chunk.end):
+            frame_ids, boxes = chunk.frame(frame_number)
+            detected_objects = []
+            for track_id, bbox in zip(frame_ids.tolist(), boxes):
+                if track_id not in ids:
+                    ids[track_id] = next_id
+                    next_id += 1
+                detected_objects.append(DetectedObject(ids[track_id], bbox))
+            tracks.append(detected_objects)
+        previous, previous_ids = chunk, ids
+    return tracks
+
+
+def _match_chunks(previous, previous_ids, chunk, iou_threshold, appearance_threshold):
+    overlap_sums = {}
+    for frame_number in range(chunk.warm_start, min(chunk.start, previous.end)):
+        previous_frame_ids, previous_boxes = previous.frame(frame_number)
+        frame_ids, boxes = chunk.frame(frame_number)
+        if len(previous_frame_ids) == 0 or len(frame_ids) == 0:
+            continue
+        ious = box_iou(previous_boxes, boxes)
+        for i, previous_id in enumerate(previous_frame_ids.tolist()):
+            for j, track_id in enumerate(frame_ids.tolist()):
+                key = (previous_id, track_id)
+                total, count = overlap_sums.get(key, (0.0, 0))
+                overlap_sums[key] = (total + ious[i, j], count + 1)
+
+    candidates = []
+    for (previous_id, track_id), (total, count) in overlap_sums.items():
+        if total / count >= iou_threshold:
+            candidates.append((1 - total / count, previous_id, track_id))
+    for previous_id, previous_feature in previous.tail_features.items():
+        for track_id, feature in chunk.head_features.items():
+            distance = 1 - float(np.dot(previous_feature, feature))
+            if distance <= appearance_threshold:
+                candidates.append((1 + distance, previous_id, track_id))
+
+    ids = {}
+    used_previous_ids = set()
+    for _, previous_id, track_id in sorted(candidates):
+        if track_id in ids or previous_id in used_previous_ids or previous_id not in previous_ids:
+            continue
+        ids[track_id] = previous_ids[previous_id]
+        used_previous_ids.add(previous_id)
+    return ids
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import sys
+
+import cv2
+
+from batch_jobs import BatchJob, expand_inputs, output_paths, run_batch
+from blurring_faces import BLUR_MODES, BLUR_GAUSSIAN, DEFAULT_BLUR_STRENGTH, iterate_frames
+from checkpoint import CheckpointStore
+from detection import TiledDetector
+from detection_scheduling import MotionGate
+from detector_backends import DETECTOR_BACKENDS, DETECTOR_ULTRALYTICS
+from export import SegmentCache
+from streaming import StreamingBlurrer, LazyVideoWriter, RawFrameWriter, raw_frames, follow_video_frames
+from track_cache import TrackCache
+from track_postprocessing import TrackPostprocessor
+from tracker import TRACKING_MODES, TRACKING_DEEPSORT
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Blur every face in videos without the GUI")
+    parser.add_argument("inputs", nargs="+", help="video files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", help="directory for the blurred videos, next to the inputs by default")
+    parser.add_argument("--suffix", default="_blurred", help="appended to the input file name")
+    parser.add_argument("--extension", help="output container extension, the input one by default")
+    parser.add_argument("--fourcc", default="mp4v")
+    parser.add_argument("--detector", default="best.pt",
+                        help="path to the YOLO face detector, an exported .onnx model for the CPU backends")
+    parser.add_argument("--detector-backend", choices=DETECTOR_BACKENDS, default=DETECTOR_ULTRALYTICS)
+    parser.add_argument("--detector-threads", type=int, help="intra-op threads of the CPU detector backends")
+    parser.add_argument("--threshold", type=float, default=0.5, help="detection confidence threshold")
+    parser.add_argument("--tracking-mode", choices=TRACKING_MODES, default=TRACKING_DEEPSORT)
+    parser.add_argument("--blur-style", choices=BLUR_MODES, default=BLUR_GAUSSIAN)
+    parser.add_argument("--blur-strength", type=int, default=DEFAULT_BLUR_STRENGTH)
+    parser.add_argument("--batch-size", type=int, default=1, help="frames per detector call")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="parallel jobs, every worker loads the models once")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the track and segment caches")
+    parser.add_argument("--checkpoint-interval", type=int, default=1000,
+                        help="frames between checkpoints an interrupted job resumes from")
+    parser.add_argument("--no-checkpoints", action="store_true", help="always search faces from the first frame")
+    parser.add_argument("--passthrough", action="store_true",
+                        help="copy video without faces from the input and re-encode only the rest, keeps the audio, "
+                             "segments re-encoded by an earlier run with the same faces are reused")
+    parser.add_argument("--profile", action="store_true",
+                        help="add per-stage latencies to every summary and write a .trace.jsonl next to it")
+    parser.add_argument("--skip-existing", action="store_true", help="skip inputs whose output already exists")
+    tiling = parser.add_argument_group("tiling", "detect overlapping tiles at native resolution to find small faces")
+    tiling.add_argument("--tiled", action="store_true")
+    tiling.add_argument("--tile-size", type=int, default=640)
+    tiling.add_argument("--tile-overlap", type=float, default=0.2, help="fraction of a tile shared with neighbours")
+    tiling.add_argument("--tile-workers", type=int, default=1, help="threads detecting tiles of a frame")
+    gating = parser.add_argument_group("motion gating", "skip detection on static frames of fixed cameras")
+    gating.add_argument("--motion-gate", action="store_true")
+    gating.add_argument("--motion-threshold", type=float, default=15.0,
+                        help="gray level change of a downscaled pixel counting as motion")
+    gating.add_argument("--static-fraction", type=float, default=0.001,
+                        help="fraction of changed downscaled pixels below which a frame is static")
+    gating.add_argument("--max-motion-fraction", type=float, default=0.5,
+                        help="fraction of the frame in motion above which the whole frame is detected")
+    streaming = parser.add_argument_group("streaming", "detect, blur and write a single input in one pass")
+    streaming.add_argument("--stream", metavar="OUTPUT",
+                           help="output file, - writes raw bgr24 frames to stdout; the input - reads them from stdin")
+    streaming.add_argument("--frame-size", help="WIDTHxHEIGHT of raw frames read from stdin")
+    streaming.add_argument("--fps", type=float, help="frame rate of the output file, the input one by default")
+    streaming.add_argument("--follow", action="store_true", help="keep reading an input file which is still written")
+    return parser.parse_args(argv)
+
+
+def stream(arguments):
+    """
+    Runs the single-pass streaming mode, see StreamingBlurrer
+    """
+    if len(arguments.inputs) != 1:
+        print("Streaming takes exactly one input", file=sys.stderr)
+        return 2
+    source = arguments.inputs[0]
+    fps = arguments.fps
+    if source == "-":
+        if not arguments.frame_size:
+            print("Raw frames from stdin need --frame-size", file=sys.stderr)
+            return 2
+        width, height = (int(value) for value in arguments.frame_size.lower().split("x"))
+        frames = raw_frames(sys.stdin.buffer, width, height)
+    elif arguments.follow:
+        frames = follow_video_frames(source)
+    else:
+        video_capture = cv2.VideoCapture(source)
+        fps = fps or video_capture.get(cv2.CAP_PROP_FPS)
+        frames = iterate_frames(video_capture)
+    if arguments.stream == "-":
+        video_writer = RawFrameWriter(sys.stdout.buffer)
+    else:
+        video_writer = LazyVideoWriter(arguments.stream, arguments.fourcc, fps or 25)
+
+    blurrer = StreamingBlurrer(arguments.detector, arguments.threshold, arguments.tracking_mode, arguments.blur_style,
+                               arguments.blur_strength, batch_size=arguments.batch_size,
+                               detector_backend=arguments.detector_backend,
+                               detector_threads=arguments.detector_threads)
+    try:
+        statistics = blurrer.process(frames, video_writer)
+    finally:
+        video_writer.release()
+    print(json.dumps(statistics), file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    if arguments.stream:
+        return stream(arguments)
+    # Outputs of earlier runs written next to the inputs are not processed again
+    input_paths = [path for path in expand_inputs(arguments.inputs)
+                   if not os.path.splitext(path)[0].endswith(arguments.suffix)]
+    if not input_paths:
+        print("No input videos found", file=sys.stderr)
+        return 2
+    if arguments.output_dir:
+        os.makedirs(arguments.output_dir, exist_ok=True)
+
+    track_cache = None if arguments.no_cache else TrackCache()
+    segment_cache = None if arguments.no_cache else SegmentCache()
+    checkpoints = None if arguments.no_checkpoints else CheckpointStore(interval=arguments.checkpoint_interval)
+    jobs = []
+    for input_path in input_paths:
+        output_path, summary_path = output_paths(input_path, arguments.output_dir, arguments.suffix,
+                                                 arguments.extension)
+        if arguments.skip_existing and os.path.exists(output_path):
+            continue
+        region_detector = None
+        if arguments.tiled:
+            region_detector = TiledDetector(arguments.tile_size, arguments.tile_overlap, arguments.tile_workers)
+        motion_gate = None
+        if arguments.motion_gate:
+            motion_gate = MotionGate(arguments.motion_threshold, arguments.static_fraction,
+                                     arguments.max_motion_fraction)
+        jobs.append(BatchJob(input_path, output_path, summary_path, arguments.threshold, arguments.tracking_mode,
+                             arguments.blur_style, arguments.blur_strength, arguments.fourcc, arguments.batch_size,
+                             track_cache, TrackPostprocessor(), checkpoints, region_detector,
+                             arguments.passthrough, arguments.profile, motion_gate, segment_cache))
+    if not jobs:
+        return 0
+
+    summaries = run_batch(jobs, arguments.detector, arguments.workers, arguments.detector_backend,
+                          arguments.detector_threads)
+    for summary in summaries:
+        print(json.dumps({key: value for key, value in summary.items() if key != "traceback"}))
+    return 0 if all(summary["status"] == "ok" for summary in summaries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
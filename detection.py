@@ -0,0 +1,292 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from blurring_faces import extract_detections
+from boxes import box_iou
+
+
+def crop_regions(boxes, frame_shape, margin=1.0, min_size=96):
+    """
+    :param boxes: np.ndarray of [x1, y1, x2, y2]
+    :param frame_shape: shape of the frame
+    :param margin: float, added on every side of a box relative to its size
+    :param min_size: int, minimal width and height of a region
+    :return: regions: list of integer [x1, y1, x2, y2] inside the frame, overlapping regions are merged
+    """
+    height, width = frame_shape[:2]
+    regions = []
+    for x1, y1, x2, y2 in np.asarray(boxes, dtype=np.float64).reshape(-1, 4):
+        center_x, center_y = (x1 + x2) / 2, (y1 + y2) / 2
+        half_width = max((x2 - x1) * (0.5 + margin), min_size / 2)
+        half_height = max((y2 - y1) * (0.5 + margin), min_size / 2)
+        region = [int(max(0, center_x - half_width)), int(max(0, center_y - half_height)),
+                  int(min(width, np.ceil(center_x + half_width))), int(min(height, np.ceil(center_y + half_height)))]
+        if region[2] > region[0] and region[3] > region[1]:
+            regions.append(region)
+    return merge_regions(regions)
+
+
+def tile_regions(frame_shape, tile_size=640, overlap=0.2):
+    """
+    :param frame_shape: shape of the frame
+    :param tile_size: int, width and height of a tile
+    :param overlap: float, fraction of a tile shared with its neighbours
+    :return: regions: list of integer [x1, y1, x2, y2] covering the whole frame
+    """
+    height, width = frame_shape[:2]
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        # The last tile is aligned with the frame edge instead of sticking out of it
+        return positions + [length - tile_size]
+
+    return [[x, y, min(width, x + tile_size), min(height, y + tile_size)]
+            for y in starts(height) for x in starts(width)]
+
+
+def merge_regions(regions):
+    """
+    :param regions: list of [x1, y1, x2, y2]
+    :return: regions: list of [x1, y1, x2, y2], every group of overlapping regions replaced by its bounding box
+    """
+    merged = [list(region) for region in regions]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    merged[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def map_crop_detections(detections, region, frame_shape, border=2):
+    """
+    :param detections: list of [x1, y1, x2, y2, score] in crop coordinates
+    :param region: [x1, y1, x2, y2] of the crop in the frame
+    :param frame_shape: shape of the frame
+    :param border: int, pixels
+    :return: detections: list of [x1, y1, x2, y2, score] in frame coordinates
+    Faces cut by an edge of the crop which is not an edge of the frame are dropped, as their boxes are truncated
+    """
+    height, width = frame_shape[:2]
+    crop_width, crop_height = region[2] - region[0], region[3] - region[1]
+    mapped = []
+    for x1, y1, x2, y2, score in detections:
+        if ((x1 <= border and region[0] > 0) or (y1 <= border and region[1] > 0)
+                or (x2 >= crop_width - border and region[2] < width)
+                or (y2 >= crop_height - border and region[3] < height)):
+            continue
+        mapped.append([x1 + region[0], y1 + region[1], x2 + region[0], y2 + region[1], score])
+    return mapped
+
+
+def non_maximum_suppression(detections, iou_threshold=0.5):
+    """
+    :param detections: list of [x1, y1, x2, y2, score]
+    :param iou_threshold: float
+    :return: detections: list of [x1, y1, x2, y2, score] without the lower-scored duplicates, highest scores first
+    """
+    if not detections:
+        return []
+    detections = sorted(detections, key=lambda detection: -detection[4])
+    ious = box_iou([detection[:4] for detection in detections], [detection[:4] for detection in detections])
+    suppressed = np.zeros(len(detections), dtype=bool)
+    kept = []
+    for i, detection in enumerate(detections):
+        if suppressed[i]:
+            continue
+        kept.append(detection)
+        suppressed |= ious[i] > iou_threshold
+    return kept
+
+
+class RoiDetector:
+    """
+    Track-guided detection: every full_frame_interval frames, or when nothing is tracked, the whole frame is
+    detected at the reduced input size full_frame_size. On every frame, regions around the boxes predicted
+    by the tracker are detected at crop_size, which keeps small faces near existing tracks in full detail.
+    The detector letterboxes every input to the requested size, so the inference cost follows these sizes
+    rather than the resolution of the video.
+    """
+    def __init__(self, full_frame_interval=5, full_frame_size=480, crop_size=320, crop_margin=1.0,
+                 min_crop_size=96, iou_threshold=0.5):
+        """
+        :param full_frame_interval: int, frames between full-frame passes
+        :param full_frame_size: int, detector input size of full-frame passes
+        :param crop_size: int, detector input size of the regions around tracks
+        :param crop_margin: float, added around predicted boxes relative to their size
+        :param min_crop_size: int, pixels
+        :param iou_threshold: float, overlap above which detections of different regions are duplicates
+        """
+        self.full_frame_interval = max(1, full_frame_interval)
+        self.full_frame_size = full_frame_size
+        self.crop_size = crop_size
+        self.crop_margin = crop_margin
+        self.min_crop_size = min_crop_size
+        self.iou_threshold = iou_threshold
+        self.reset()
+
+    def settings(self):
+        return {"type": "roi", "full_frame_interval": self.full_frame_interval,
+                "full_frame_size": self.full_frame_size, "crop_size": self.crop_size, "crop_margin": self.crop_margin,
+                "min_crop_size": self.min_crop_size, "iou_threshold": self.iou_threshold}
+
+    def reset(self):
+        self.frames_since_full_frame = None
+        self.frames = 0
+        self.full_frame_passes = 0
+        self.crops = 0
+
+    def close(self):
+        # Holds no threads, for compatibility with TiledDetector
+        pass
+
+    def detect(self, detector, frame, predicted_boxes, detection_threshold):
+        """
+        :param detector: detector, see load_detector
+        :param frame: np.ndarray
+        :param predicted_boxes: np.ndarray of [x1, y1, x2, y2], see Tracker.predicted_boxes
+        :param detection_threshold: float
+        :return: detections: list of [x1, y1, x2, y2, score] in frame coordinates
+        """
+        self.frames += 1
+        detections = []
+        if (not len(predicted_boxes) or self.frames_since_full_frame is None
+                or self.frames_since_full_frame + 1 >= self.full_frame_interval):
+            result = detector([frame], imgsz=self.full_frame_size)[0]
+            detections += extract_detections(result, detection_threshold)
+            self.frames_since_full_frame = 0
+            self.full_frame_passes += 1
+        else:
+            self.frames_since_full_frame += 1
+
+        regions = crop_regions(predicted_boxes, frame.shape, self.crop_margin, self.min_crop_size)
+        if regions:
+            crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in regions]
+            for region, result in zip(regions, detector(crops, imgsz=self.crop_size)):
+                detections += map_crop_detections(extract_detections(result, detection_threshold), region,
+                                                  frame.shape)
+            self.crops += len(regions)
+        return non_maximum_suppression(detections, self.iou_threshold)
+
+    def statistics(self, reference_size=640):
+        """
+        :param reference_size: int, detector input size of detecting every full frame
+        :return: statistics: dict
+        """
+        input_pixels = self.full_frame_passes * self.full_frame_size ** 2 + self.crops * self.crop_size ** 2
+        return {"frames": self.frames,
+                "full_frame_passes": self.full_frame_passes,
+                "crops": self.crops,
+                "relative_inference_cost": input_pixels / max(1, self.frames * reference_size ** 2)}
+
+
+class TiledDetector:
+    """
+    Detects faces on overlapping tiles at their native resolution, so small faces are not lost
+    when the whole frame is downsized to the detector input. Faces cut by a tile edge are taken from
+    the neighbouring tile they fit into, an optional full-frame pass finds faces larger than the overlap,
+    and duplicates across tiles are removed with NMS.
+    """
+    def __init__(self, tile_size=640, overlap=0.2, workers=1, include_full_frame=True, iou_threshold=0.5):
+        """
+        :param tile_size: int, also the detector input size of the tiles
+        :param overlap: float, fraction of a tile shared with its neighbours
+        :param workers: int, threads running the tiles, each with its own copy of the detector,
+        1 runs all tiles in a single batched detector call
+        :param include_full_frame: bool
+        :param iou_threshold: float, overlap above which detections of different tiles are duplicates
+        """
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.workers = max(1, workers)
+        self.include_full_frame = include_full_frame
+        self.iou_threshold = iou_threshold
+        self.executor = None
+        self.worker_detectors = None
+        self.reset()
+
+    def settings(self):
+        # The number of workers does not change the detections
+        return {"type": "tiled", "tile_size": self.tile_size, "overlap": self.overlap,
+                "include_full_frame": self.include_full_frame, "iou_threshold": self.iou_threshold}
+
+    def reset(self):
+        self.frames = 0
+        self.tiles = 0
+
+    def detect(self, detector, frame, predicted_boxes, detection_threshold):
+        """
+        :param detector: detector, see load_detector
+        :param frame: np.ndarray
+        :param predicted_boxes: not used, for compatibility with RoiDetector
+        :param detection_threshold: float
+        :return: detections: list of [x1, y1, x2, y2, score] in frame coordinates
+        """
+        self.frames += 1
+        regions = tile_regions(frame.shape, self.tile_size, self.overlap)
+        tiles = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in regions]
+        self.tiles += len(tiles)
+        if self.workers == 1 or len(tiles) == 1:
+            results = detector(tiles, imgsz=self.tile_size)
+        else:
+            results = self.detect_in_threads(detector, tiles)
+
+        detections = []
+        if self.include_full_frame and len(tiles) > 1:
+            detections += extract_detections(detector([frame], imgsz=self.tile_size)[0], detection_threshold)
+        for region, result in zip(regions, results):
+            detections += map_crop_detections(extract_detections(result, detection_threshold), region, frame.shape)
+        return non_maximum_suppression(detections, self.iou_threshold)
+
+    def detect_in_threads(self, detector, tiles):
+        if self.executor is None:
+            # Detectors are not generally thread-safe, so every thread gets its own copy
+            self.worker_detectors = [detector] + [_clone_detector(detector) for _ in range(self.workers - 1)]
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        chunks = [tiles[worker::self.workers] for worker in range(self.workers)]
+        futures = [self.executor.submit(worker_detector, chunk, imgsz=self.tile_size)
+                   for worker_detector, chunk in zip(self.worker_detectors, chunks) if chunk]
+        chunk_results = [future.result() for future in futures]
+        results = [None] * len(tiles)
+        for worker, worker_results in enumerate(chunk_results):
+            results[worker::self.workers] = worker_results
+        return results
+
+    def close(self):
+        """
+        Shuts down the worker threads, the next detect starts them again
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def statistics(self):
+        """
+        :return: statistics: dict
+        """
+        return {"frames": self.frames, "tiles_per_frame": self.tiles / max(1, self.frames)}
+
+
+def _clone_detector(detector):
+    if hasattr(detector, "clone"):
+        return detector.clone()
+    return copy.deepcopy(detector)
@@ -0,0 +1,230 @@
+import cv2
+import numpy as np
+
+from blurring_faces import extract_detections
+from detection import crop_regions, map_crop_detections
+
+
+def frame_thumbnail(frame, size=(64, 36)):
+    """
+    :param frame: np.ndarray
+    :param size: (width, height)
+    :return: thumbnail: np.ndarray
+    Returns a small grayscale copy of the frame used for cheap frame-difference analysis
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+class AdaptiveDetectionScheduler:
+    """
+    Decides on which frames the detector has to run, on the other frames boxes come from the tracker prediction.
+    A detection is forced when the frame-difference energy spikes, at scene cuts and when the tracker prediction
+    becomes uncertain, and is kept between min_interval and max_interval frames apart.
+    When the tracks are reported with tracks_detected, the interval between detections starts at min_interval,
+    doubles while detections find the same tracks and goes back to min_interval when a track appears or is lost.
+    """
+    def __init__(self, min_interval=1, max_interval=10, motion_threshold=6.0, scene_cut_threshold=0.5,
+                 max_uncertainty=0.25, analysis_size=(64, 36)):
+        """
+        :param min_interval: int, minimal number of frames between detections
+        :param max_interval: int, maximal number of frames between detections
+        :param motion_threshold: float, mean absolute gray level difference to the previous frame
+        :param scene_cut_threshold: float, histogram correlation drop since the last detection
+        :param max_uncertainty: float, predicted position standard deviation relative to the box height
+        :param analysis_size: (width, height) of the thumbnails
+        """
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.motion_threshold = motion_threshold
+        self.scene_cut_threshold = scene_cut_threshold
+        self.max_uncertainty = max_uncertainty
+        self.analysis_size = analysis_size
+        self.reset()
+
+    def reset(self):
+        self.previous_thumbnail = None
+        self.detection_histogram = None
+        self.frames_since_detection = 0
+        self.frames = 0
+        self.detections = 0
+        self.interval = self.max_interval
+        self.detected_track_ids = None
+
+    def should_detect(self, frame, uncertainty=0.0):
+        """
+        :param frame: np.ndarray
+        :param uncertainty: float, see Tracker.prediction_uncertainty
+        :return: bool
+        """
+        thumbnail = frame_thumbnail(frame, self.analysis_size)
+        histogram = cv2.calcHist([thumbnail], [0], None, [32], [0, 256])
+        previous_thumbnail, self.previous_thumbnail = self.previous_thumbnail, thumbnail
+        self.frames += 1
+        self.frames_since_detection += 1
+
+        if self.detection_histogram is None or self.frames_since_detection >= self.interval:
+            detect = True
+        elif self.frames_since_detection < self.min_interval:
+            detect = False
+        else:
+            energy = float(np.mean(np.abs(thumbnail - previous_thumbnail)))
+            correlation = cv2.compareHist(self.detection_histogram, histogram, cv2.HISTCMP_CORREL)
+            detect = (energy > self.motion_threshold or correlation < 1 - self.scene_cut_threshold
+                      or uncertainty > self.max_uncertainty)
+
+        if detect:
+            self.detection_histogram = histogram
+            self.frames_since_detection = 0
+            self.detections += 1
+        return detect
+
+    def tracks_detected(self, track_ids):
+        """
+        :param track_ids: iterable of the ids of the tracks the detection found, see Tracker.updated_track_ids
+        """
+        track_ids = set(track_ids)
+        if track_ids == self.detected_track_ids:
+            self.interval = min(self.max_interval, 2 * self.interval)
+        else:
+            # New or lost faces are detected again soon, until the tracks settle
+            self.interval = self.min_interval
+        self.detected_track_ids = track_ids
+
+    def statistics(self):
+        """
+        :return: statistics: dict
+        """
+        return {"frames": self.frames,
+                "detected_frames": self.detections,
+                "skipped_fraction": 1 - self.detections / max(1, self.frames)}
+
+
+class MotionGate:
+    """
+    Cheap motion pre-stage for fixed cameras. Downscaled frames are compared with the frame of the last detection:
+    when nothing changed, the frame reuses the detections and tracks of the previous frame without running the
+    detector or the tracker; when something changed, only the regions around the motion, and around the faces
+    it touches, are detected, and the previous detections elsewhere are kept.
+    Every full_frame_interval frames the whole frame is detected, so slow changes are caught up with.
+    """
+    def __init__(self, pixel_threshold=15.0, min_changed_fraction=0.001, max_region_fraction=0.5,
+                 region_margin=0.5, min_region_size=96, full_frame_interval=30, analysis_width=160,
+                 detection_size=None):
+        """
+        :param pixel_threshold: float, gray level difference of a thumbnail pixel counting it as changed
+        :param min_changed_fraction: float, fraction of changed thumbnail pixels below which a frame is static
+        :param max_region_fraction: float, fraction of the frame above which the whole frame is detected
+        :param region_margin: float, added around the motion relative to its size, see crop_regions
+        :param min_region_size: int, pixels
+        :param full_frame_interval: int, maximal number of frames between detections of the whole frame
+        :param analysis_width: int, width of the thumbnails, their height follows the aspect ratio of the frames
+        :param detection_size: int or None, detector input size of the regions, the detector default when None
+        """
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.max_region_fraction = max_region_fraction
+        self.region_margin = region_margin
+        self.min_region_size = min_region_size
+        self.full_frame_interval = max(1, full_frame_interval)
+        self.analysis_width = analysis_width
+        self.detection_size = detection_size
+        self.reset()
+
+    def settings(self):
+        return {"type": "motion_gate", "pixel_threshold": self.pixel_threshold,
+                "min_changed_fraction": self.min_changed_fraction, "max_region_fraction": self.max_region_fraction,
+                "region_margin": self.region_margin, "min_region_size": self.min_region_size,
+                "full_frame_interval": self.full_frame_interval, "analysis_width": self.analysis_width,
+                "detection_size": self.detection_size}
+
+    def reset(self):
+        self.reference_thumbnail = None
+        self.thumbnail = None
+        self.regions = None
+        self.detections = []
+        self.frames_since_full_frame = 0
+        self.frames = 0
+        self.static_frames = 0
+        self.region_frames = 0
+        self.total_pixels = 0
+        self.detected_pixels = 0
+
+    def check(self, frame):
+        """
+        :param frame: np.ndarray
+        :return: changed: bool, False when the frame can reuse the previous detections and tracks.
+        When True, regions is the list of [x1, y1, x2, y2] regions to detect, or None for the whole frame
+        """
+        height, width = frame.shape[:2]
+        analysis_size = (self.analysis_width, max(1, round(self.analysis_width * height / width)))
+        self.thumbnail = frame_thumbnail(frame, analysis_size)
+        self.frames += 1
+        self.frames_since_full_frame += 1
+        self.total_pixels += height * width
+        self.regions = None
+        if (self.reference_thumbnail is None or self.reference_thumbnail.shape != self.thumbnail.shape
+                or self.frames_since_full_frame >= self.full_frame_interval):
+            self.frames_since_full_frame = 0
+            self.detected_pixels += height * width
+            return True
+
+        changed = (np.abs(self.thumbnail - self.reference_thumbnail) > self.pixel_threshold).astype(np.uint8)
+        if changed.mean() < self.min_changed_fraction:
+            self.static_frames += 1
+            return False
+
+        changed = cv2.dilate(changed, np.ones((3, 3), dtype=np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(changed)
+        scale_x, scale_y = width / analysis_size[0], height / analysis_size[1]
+        boxes = [[x * scale_x, y * scale_y, (x + w) * scale_x, (y + h) * scale_y] for x, y, w, h, _ in stats[1:count]]
+        # Faces touched by the motion are detected whole, so they are not cut by the edge of a region
+        boxes += [detection[:4] for detection in self.detections
+                  if any(_overlaps(detection, box) for box in boxes)]
+        regions = crop_regions(np.array(boxes), frame.shape, self.region_margin, self.min_region_size)
+        region_pixels = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions)
+        if region_pixels > self.max_region_fraction * height * width:
+            self.frames_since_full_frame = 0
+            self.detected_pixels += height * width
+            return True
+        self.regions = regions
+        self.region_frames += 1
+        self.detected_pixels += region_pixels
+        return True
+
+    def detect(self, detector, frame, detection_threshold):
+        """
+        :param detector: detector, see load_detector
+        :param frame: np.ndarray, the frame of the last check, which returned regions
+        :param detection_threshold: float
+        :return: detections: list of [x1, y1, x2, y2, score], new ones in the regions and previous ones elsewhere
+        """
+        crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in self.regions]
+        results = detector(crops, imgsz=self.detection_size) if crops else []
+        detections = [detection for detection in self.detections
+                      if not any(_overlaps(detection, region) for region in self.regions)]
+        for region, result in zip(self.regions, results):
+            detections += map_crop_detections(extract_detections(result, detection_threshold), region, frame.shape)
+        self.remember(detections)
+        return detections
+
+    def remember(self, detections):
+        """
+        :param detections: list of [x1, y1, x2, y2, score] found on the frame of the last check
+        """
+        self.detections = list(detections)
+        self.reference_thumbnail = self.thumbnail
+
+    def statistics(self):
+        """
+        :return: statistics: dict
+        """
+        return {"frames": self.frames,
+                "static_frames": self.static_frames,
+                "region_frames": self.region_frames,
+                "skipped_frame_fraction": self.static_frames / max(1, self.frames),
+                "skipped_pixel_fraction": 1 - self.detected_pixels / max(1, self.total_pixels)}
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
@@ -0,0 +1,225 @@
+import abc
+import copy
+import warnings
+
+import cv2
+import numpy as np
+
+DETECTOR_ULTRALYTICS = "ultralytics"
+DETECTOR_ONNXRUNTIME = "onnxruntime"
+DETECTOR_OPENCV = "opencv"
+DETECTOR_BACKENDS = (DETECTOR_ULTRALYTICS, DETECTOR_ONNXRUNTIME, DETECTOR_OPENCV)
+
+# Defaults of ultralytics predictions, kept so every backend returns the same candidate boxes
+DEFAULT_CONFIDENCE_THRESHOLD = 0.25
+DEFAULT_IOU_THRESHOLD = 0.7
+LETTERBOX_COLOR = (114, 114, 114)
+DEFAULT_INPUT_SIZE = 640
+
+
+def load_detector(path_to_detector, backend=DETECTOR_ULTRALYTICS, input_size=None, threads=None):
+    """
+    :param path_to_detector: str, .pt weights for ultralytics, an exported .onnx model for the other backends
+    :param backend: one of DETECTOR_BACKENDS
+    :param input_size: int or None, default input size of the model, when None the imgsz stored in .pt weights
+    or DEFAULT_INPUT_SIZE for .onnx models
+    :param threads: int or None, intra-op threads of the CPU backends, library default when None
+    :return: detector: callable taking a list of BGR images and an optional imgsz and returning,
+    for every image, an np.ndarray of [x1, y1, x2, y2, score, class] rows in image coordinates
+    """
+    if backend == DETECTOR_ULTRALYTICS:
+        return UltralyticsDetector(path_to_detector, input_size)
+    if backend == DETECTOR_ONNXRUNTIME:
+        return OnnxRuntimeDetector(path_to_detector, input_size or DEFAULT_INPUT_SIZE, threads)
+    if backend == DETECTOR_OPENCV:
+        return OpenCvDnnDetector(path_to_detector, input_size or DEFAULT_INPUT_SIZE, threads)
+    raise ValueError(f"Unknown detector backend {backend}, expected one of {DETECTOR_BACKENDS}")
+
+
+def export_onnx(path_to_detector, input_size=DEFAULT_INPUT_SIZE, dynamic=True):
+    """
+    :param path_to_detector: str, .pt weights
+    :param input_size: int
+    :param dynamic: bool, exports dynamic batch and input sizes, which OpenCV DNN does not support
+    :return: path: str of the exported model
+    """
+    from ultralytics import YOLO
+    return YOLO(path_to_detector).export(format="onnx", imgsz=input_size, dynamic=dynamic)
+
+
+class UltralyticsDetector:
+    """
+    PyTorch inference through ultralytics with its own preprocessing and NMS
+    """
+    def __init__(self, path_to_detector, input_size=None):
+        # Imported here, so the other backends run without PyTorch
+        from ultralytics import YOLO
+        self.model = YOLO(path_to_detector)
+        self.input_size = input_size
+
+    def __call__(self, images, imgsz=None):
+        imgsz = imgsz or self.input_size
+        if imgsz is None:
+            # ultralytics predicts at the imgsz the weights were trained with
+            results = self.model(images, verbose=False)
+        else:
+            results = self.model(images, imgsz=imgsz, verbose=False)
+        return [result.boxes.data.cpu().numpy() for result in results]
+
+    def clone(self):
+        # Predictors keep per-call state, so concurrent threads need their own copy
+        return copy.deepcopy(self)
+
+
+def letterbox(image, size):
+    """
+    :param image: np.ndarray, BGR
+    :param size: int
+    :return: (blob, scale, pad_x, pad_y): blob is the 1x3xSxS float32 RGB input,
+    image coordinates are (model coordinates - pad) / scale
+    """
+    height, width = image.shape[:2]
+    scale = min(size / height, size / width)
+    resized_width, resized_height = round(width * scale), round(height * scale)
+    pad_x, pad_y = (size - resized_width) / 2, (size - resized_height) / 2
+    if (resized_width, resized_height) != (width, height):
+        image = cv2.resize(image, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+    top, left = round(pad_y - 0.1), round(pad_x - 0.1)
+    image = cv2.copyMakeBorder(image, top, size - resized_height - top, left, size - resized_width - left,
+                               cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    blob = cv2.dnn.blobFromImage(image, 1 / 255.0, swapRB=True)
+    return blob, scale, left, top
+
+
+def decode_predictions(predictions, scale, pad_x, pad_y, image_shape,
+                       confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD, iou_threshold=DEFAULT_IOU_THRESHOLD):
+    """
+    :param predictions: np.ndarray of shape (4 + classes, candidates), raw YOLOv8 output for one image
+    :param scale: float, see letterbox
+    :param pad_x: int, see letterbox
+    :param pad_y: int, see letterbox
+    :param image_shape: shape of the original image
+    :param confidence_threshold: float
+    :param iou_threshold: float
+    :return: detections: np.ndarray of [x1, y1, x2, y2, score, class] after per-class NMS
+    """
+    predictions = predictions.T
+    class_scores = predictions[:, 4:]
+    classes = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(classes)), classes]
+    keep = scores > confidence_threshold
+    predictions, classes, scores = predictions[keep], classes[keep], scores[keep]
+    if not len(scores):
+        return np.zeros((0, 6), dtype=np.float32)
+
+    boxes = np.empty((len(scores), 4), dtype=np.float32)
+    boxes[:, :2] = predictions[:, :2] - predictions[:, 2:4] / 2
+    boxes[:, 2:] = predictions[:, :2] + predictions[:, 2:4] / 2
+    boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad_x) / scale
+    boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad_y) / scale
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, image_shape[1])
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, image_shape[0])
+
+    # Offsetting boxes by class keeps NMS from suppressing boxes of different classes
+    offsets = classes[:, None] * (max(image_shape[:2]) + 1)
+    nms_boxes = np.hstack([boxes[:, :2] + offsets, boxes[:, 2:] - boxes[:, :2]])
+    kept = cv2.dnn.NMSBoxes(nms_boxes.tolist(), scores.tolist(), confidence_threshold, iou_threshold)
+    kept = np.asarray(kept, dtype=np.int64).reshape(-1)
+    kept = kept[np.argsort(-scores[kept], kind="stable")]
+    return np.hstack([boxes[kept], scores[kept, None], classes[kept, None]]).astype(np.float32)
+
+
+class OnnxDetector(abc.ABC):
+    """
+    Common preprocessing and postprocessing of exported YOLOv8 models, subclasses run the network.
+    Models exported with a fixed input size run at that size, an imgsz asking for another one is ignored
+    with a RuntimeWarning.
+    """
+    def __init__(self, path_to_detector, input_size=DEFAULT_INPUT_SIZE, threads=None):
+        self.path_to_detector = path_to_detector
+        self.input_size = input_size
+        self.threads = threads
+        self.fixed_input_size = None
+
+    def __call__(self, images, imgsz=None):
+        size = self.fixed_input_size or _stride_multiple(imgsz or self.input_size)
+        if imgsz and size != _stride_multiple(imgsz):
+            warnings.warn(f"{type(self).__name__} runs {self.path_to_detector} at its fixed input size {size}, "
+                          f"imgsz={imgsz} is ignored; only models exported with dynamic=True on the "
+                          f"{DETECTOR_ONNXRUNTIME} backend change their input size", RuntimeWarning, stacklevel=2)
+        prepared = [letterbox(image, size) for image in images]
+        outputs = self.run(np.concatenate([blob for blob, _, _, _ in prepared])) if prepared else []
+        return [decode_predictions(output, scale, pad_x, pad_y, image.shape)
+                for output, (_, scale, pad_x, pad_y), image in zip(outputs, prepared, images)]
+
+    @abc.abstractmethod
+    def run(self, blobs):
+        """
+        :param blobs: np.ndarray of shape (batch, 3, size, size)
+        :return: outputs: np.ndarray of shape (batch, 4 + classes, candidates)
+        """
+
+    @abc.abstractmethod
+    def clone(self):
+        """
+        :return: detector which can run on another thread concurrently with this one
+        """
+
+
+class OnnxRuntimeDetector(OnnxDetector):
+    """
+    ONNX Runtime CPU inference, the session is thread-safe and batches images when the model has a dynamic batch
+    """
+    def __init__(self, path_to_detector, input_size=DEFAULT_INPUT_SIZE, threads=None):
+        super().__init__(path_to_detector, input_size, threads)
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError("The onnxruntime detector backend needs the onnxruntime package") from error
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path_to_detector, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        if isinstance(model_input.shape[2], int):
+            self.fixed_input_size = model_input.shape[2]
+
+    def run(self, blobs):
+        if self.dynamic_batch:
+            return self.session.run(None, {self.input_name: blobs})[0]
+        return np.concatenate([self.session.run(None, {self.input_name: blob[None]})[0] for blob in blobs])
+
+    def clone(self):
+        # InferenceSession.run is thread-safe, so threads share the session, its weights and its thread pool
+        return self
+
+
+class OpenCvDnnDetector(OnnxDetector):
+    """
+    OpenCV DNN CPU inference of a model exported with a fixed input size, images are run one by one
+    """
+    def __init__(self, path_to_detector, input_size=DEFAULT_INPUT_SIZE, threads=None):
+        super().__init__(path_to_detector, input_size, threads)
+        self.net = cv2.dnn.readNetFromONNX(path_to_detector)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.fixed_input_size = input_size
+        if threads:
+            # OpenCV has a single process-wide thread pool
+            cv2.setNumThreads(threads)
+
+    def run(self, blobs):
+        outputs = []
+        for blob in blobs:
+            self.net.setInput(blob[None])
+            outputs.append(self.net.forward())
+        return np.concatenate(outputs)
+
+    def clone(self):
+        return OpenCvDnnDetector(self.path_to_detector, self.input_size, self.threads)
+
+
+def _stride_multiple(size, stride=32):
+    return max(stride, int(np.ceil(size / stride)) * stride)
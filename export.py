@@ -0,0 +1,442 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from blurring_faces import blur_faces, open_video, BLUR_GAUSSIAN, DEFAULT_BLUR_STRENGTH
+from frame_transport import frame_ring_for, ring_frames
+from pipeline import Pipeline
+from profiling import DISABLED_PROFILER
+from track_cache import DEFAULT_CACHE_DIR, evict_least_recently_used, file_digest
+
+
+SEGMENT_FORMAT_VERSION = 1
+SEGMENT_FILE_SUFFIX = ".ts"
+DEFAULT_SEGMENTS_DIR = os.path.join(DEFAULT_CACHE_DIR, "segments")
+
+# Codecs whose GOPs can be stream-copied next to re-encoded ones: encoder and bitstream filter for MPEG-TS segments
+PASSTHROUGH_CODECS = {"h264": ("libx264", "h264_mp4toannexb"), "hevc": ("libx265", "hevc_mp4toannexb")}
+
+
+def probe_packets(path_to_video):
+    """
+    :param path_to_video: str
+    :return: packets: list of (pts_time, is_keyframe) in presentation order, or None when ffprobe is not installed
+    Reads timestamps and keyframe flags of the first video stream from the container without decoding
+    """
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None
+    output = subprocess.run([ffprobe, "-v", "error", "-select_streams", "v:0",
+                             "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path_to_video],
+                            capture_output=True, text=True, check=True).stdout
+    packets = []
+    for line in output.splitlines():
+        fields = line.split(",")
+        if len(fields) < 2 or fields[0] == "N/A":
+            continue
+        packets.append((float(fields[0]), "K" in fields[1]))
+    # Packets are listed in decoding order, frame numbers follow presentation order
+    packets.sort()
+    return packets
+
+
+def probe_keyframes(path_to_video):
+    """
+    :param path_to_video: str
+    :return: keyframes: list of int or None
+    Returns frame numbers of the keyframes of the first video stream,
+    read from packet flags by ffprobe without decoding, or None when ffprobe is not installed
+    """
+    packets = probe_packets(path_to_video)
+    if packets is None:
+        return None
+    return [frame_number for frame_number, (_, is_keyframe) in enumerate(packets) if is_keyframe]
+
+
+def probe_video_stream(path_to_video):
+    """
+    :param path_to_video: str
+    :return: stream: dict of codec_name, pix_fmt, width, height and r_frame_rate of the first video stream
+    """
+    output = subprocess.run([shutil.which("ffprobe"), "-v", "error", "-select_streams", "v:0", "-show_entries",
+                             "stream=codec_name,pix_fmt,width,height,r_frame_rate", "-of", "json", path_to_video],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)["streams"][0]
+
+
+def plan_passthrough(frames_count, keyframes, needs_blur, segment_frames=None):
+    """
+    :param frames_count: int
+    :param keyframes: list of int, frame numbers of the keyframes
+    :param needs_blur: list of bool, one per frame
+    :param segment_frames: int or None, re-encoded runs are split at the first keyframe past every multiple of it
+    :return: runs: list of (start, end, reencode) tuples
+    Splits the video into runs of whole GOPs, a GOP is re-encoded when any of its frames has faces to blur.
+    Splitting re-encoded runs on a fixed grid keeps the other runs unchanged when faces change in one of them.
+    """
+    starts = sorted(set(keyframe for keyframe in keyframes if 0 <= keyframe < frames_count) | {0})
+    runs = []
+    for start, end in zip(starts, starts[1:] + [frames_count]):
+        reencode = any(needs_blur[start:end])
+        if (runs and runs[-1][2] == reencode
+                and not (reencode and segment_frames and start // segment_frames != runs[-1][0] // segment_frames)):
+            runs[-1] = (runs[-1][0], end, reencode)
+        else:
+            runs.append((start, end, reencode))
+    return runs
+
+
+def plan_segments(frames_count, segments_count, keyframes=None):
+    """
+    :param frames_count: int
+    :param segments_count: int
+    :param keyframes: list of int or None
+    :return: segments: list of (start, end) tuples
+    Splits frames into about segments_count ranges of similar length, starting every range at a keyframe if known
+    """
+    segments_count = max(1, min(segments_count, frames_count))
+    starts = [round(i * frames_count / segments_count) for i in range(segments_count)]
+    if keyframes:
+        keyframes = np.asarray(keyframes)
+        starts = [int(keyframes[max(0, np.searchsorted(keyframes, start, side="right") - 1)]) for start in starts]
+    starts = sorted(set(starts) | {0})
+    return list(zip(starts, starts[1:] + [frames_count]))
+
+
+def segment_signature(plan, parameters):
+    """
+    :param plan: list of (boxes, strengths), see VideoExporter.frame_blur_plan
+    :param parameters: dict of everything else the rendered segment depends on
+    :return: signature: str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    for boxes, strengths in plan:
+        digest.update(np.asarray(boxes, dtype=np.float32).tobytes())
+        digest.update(np.asarray(strengths, dtype=np.float32).tobytes())
+        # Separates frames, so boxes cannot move between neighbouring frames without changing the signature
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+class SegmentCache:
+    """
+    On-disk cache of the segments export_passthrough() re-encodes, keyed by their segment_signature,
+    so exporting a video again after changing the blurred faces or their intensity re-encodes only
+    the segments whose faces changed. The least recently used segments are evicted above max_size_bytes.
+    """
+    def __init__(self, cache_dir=DEFAULT_SEGMENTS_DIR, max_size_bytes=2 * 1024 * 1024 * 1024):
+        """
+        :param cache_dir: str
+        :param max_size_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+    def entry_path(self, signature):
+        return os.path.join(self.cache_dir, signature + SEGMENT_FILE_SUFFIX)
+
+    def load(self, signature):
+        """
+        :param signature: str
+        :return: path: str of the cached segment, or None
+        """
+        path = self.entry_path(signature)
+        if not os.path.exists(path):
+            return None
+        # Marks the entry as recently used for eviction
+        os.utime(path)
+        return path
+
+    def store(self, segment_path, signature):
+        """
+        :param segment_path: str, a rendered segment, moved into the cache
+        :param signature: str
+        :return: path: str of the cached segment
+        """
+        path = self.entry_path(signature)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_path = path + ".tmp"
+        shutil.move(segment_path, temporary_path)
+        os.replace(temporary_path, path)
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used segments until the cache fits into max_size_bytes
+        """
+        evict_least_recently_used(self.cache_dir, SEGMENT_FILE_SUFFIX, self.max_size_bytes)
+
+
+class VideoExporter:
+    """
+    Writes a copy of the video with faces blurred according to the face tracks
+    """
+    def __init__(self, source_video_path, save_path, face_tracks, fourcc="mp4v", fps=None, blur_mode=0,
+                 face_to_blur=None, blur_style=BLUR_GAUSSIAN, id_to_blur_intensity=None, max_queue_size=8,
+                 profiler=None, segment_cache=None):
+        """
+        :param fps: float, frame rate of the source video when None
+        :param blur_mode: 0 blurs every face, 1 only the faces in face_to_blur
+        :param profiler: Profiler, records the decode, blur and encode stages of export()
+        :param segment_cache: SegmentCache or None, re-encoded segments of export_passthrough() are reused from it
+        """
+        self.source_video_path = source_video_path
+        self.save_path = save_path
+        self.face_tracks = face_tracks
+        self.fourcc = fourcc
+        if fps is None:
+            capture = cv2.VideoCapture(source_video_path)
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25
+            capture.release()
+        self.fps = fps
+        self.blur_mode = blur_mode
+        self.face_to_blur = face_to_blur or []
+        self.blur_style = blur_style
+        self.id_to_blur_intensity = id_to_blur_intensity or {}
+        self.max_queue_size = max_queue_size
+        self.profiler = profiler or DISABLED_PROFILER
+        self.segment_cache = segment_cache
+        self.pipeline = None
+
+    def frame_blur_plan(self, frame_number):
+        """
+        :param frame_number: int
+        :return: (boxes, strengths)
+        Returns boxes to blur on the frame and the blur strength of each of them
+        """
+        if frame_number >= len(self.face_tracks):
+            return np.zeros((0, 4)), []
+        ids, boxes = self.face_tracks.frame(frame_number)
+        ids = ids.tolist()
+        rows = list(range(len(ids)))
+        if self.blur_mode == 1:
+            rows = [row for row in rows if ids[row] in self.face_to_blur]
+        strengths = [self.id_to_blur_intensity.get(ids[row], DEFAULT_BLUR_STRENGTH) for row in rows]
+        return np.array(boxes[rows]), strengths
+
+    def blur_frame(self, numbered_frame):
+        frame_number, frame = numbered_frame
+        boxes, strengths = self.frame_blur_plan(frame_number)
+        return blur_faces(frame, boxes, strengths, self.blur_style)
+
+    def export(self):
+        """
+        Decodes, blurs and encodes the whole video in a pipeline on the current process.
+        Frames are decoded into a fixed ring of buffers, blurred in place and their buffer is reused once encoded.
+        """
+        capture = cv2.VideoCapture(self.source_video_path)
+        out = None
+        ring = None
+        self.pipeline = None
+        try:
+            # Enough slots for every frame the pipeline queues and stages can hold, the decoder waits for one otherwise
+            ring, first_frame = frame_ring_for(capture, 2 * self.max_queue_size + 3, shared=False)
+            video_dimensions = (ring.max_frame_shape[1], ring.max_frame_shape[0])
+            out = cv2.VideoWriter(self.save_path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, video_dimensions)
+            blur = self.profiler.timed("blur", self.blur_frame)
+            encode = self.profiler.timed("encode", out.write)
+
+            def blur_slot(slotted_frame):
+                slot, frame_number, frame = slotted_frame
+                return slot, blur((frame_number, frame))
+
+            def encode_slot(slotted_frame):
+                slot, frame = slotted_frame
+                encode(frame)
+                ring.release(slot)
+
+            stop_event = threading.Event()
+            frames = ring_frames(capture, ring, stop_event=stop_event, first_frame=first_frame)
+            self.pipeline = Pipeline(self.profiler.iterate("decode", frames),
+                                     [("blur", blur_slot), ("encode", encode_slot)], self.max_queue_size,
+                                     stop_event=stop_event)
+            for _ in self.pipeline:
+                if self.profiler.enabled:
+                    self.profiler.frame()
+        finally:
+            # Stops the decoder first, so the capture is not released while it still reads from it
+            if self.pipeline is not None:
+                self.pipeline.close()
+            capture.release()
+            if out is not None:
+                out.release()
+            if ring is not None:
+                ring.close()
+
+    def export_parallel(self, workers=None):
+        """
+        :param workers: int, number of processes, all CPUs by default
+        Splits the video at keyframes, blurs and encodes the segments in a process pool
+        and joins them with ffmpeg without re-encoding.
+        The output has the frames of export() with the same faces blurred. With intra-only codecs such as MJPG
+        it is identical frame for frame, with inter-frame codecs such as mp4v every segment starts a new GOP,
+        so frames near the segment boundaries differ from export() by compression noise.
+        Falls back to export() when ffmpeg is not installed or the video is too short to split.
+        """
+        workers = workers or os.cpu_count() or 1
+        ffmpeg = shutil.which("ffmpeg")
+        capture = cv2.VideoCapture(self.source_video_path)
+        frames_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+        segments = plan_segments(frames_count, workers, probe_keyframes(self.source_video_path))
+        if ffmpeg is None or workers < 2 or len(segments) < 2:
+            self.export()
+            return
+
+        extension = os.path.splitext(self.save_path)[1]
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.save_path))) as work_dir:
+            tasks = []
+            for index, (start, end) in enumerate(segments):
+                # The last segment runs to the end of the stream in case the container frame count is short
+                end = None if index == len(segments) - 1 else end
+                plan_end = len(self.face_tracks) if end is None else end
+                plan = [self.frame_blur_plan(frame_number) for frame_number in range(start, plan_end)]
+                tasks.append((self.source_video_path, os.path.join(work_dir, f"segment_{index:05d}{extension}"),
+                              self.fourcc, self.fps, start, end, plan, self.blur_style))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                segment_paths = list(executor.map(_export_segment, tasks))
+            concatenate_videos(segment_paths, self.save_path, work_dir)
+
+    def export_passthrough(self, workers=1, segment_seconds=10):
+        """
+        :param workers: int, processes of the fallback export
+        :param segment_seconds: float, re-encoded runs are split into segments of about this length
+        :return: statistics: dict with the numbers of copied, re-encoded and reused frames
+        Smart render: GOPs without faces to blur are stream-copied from the source, only GOPs with faces
+        are decoded, blurred and encoded again with the source codec, and the audio of the source is copied,
+        so the output keeps the frame rate and timestamps of a constant frame rate source.
+        GOPs must be closed, which is the case for common H.264 and H.265 encoder settings.
+        With a segment_cache, re-encoded segments whose segment_signature is cached are reused,
+        so exporting again after changing the blurred faces or their intensity re-encodes only the segments
+        where the blur changed.
+        Falls back to export_parallel() or export(), which write video only, without ffmpeg
+        or for sources in other codecs.
+        """
+        ffmpeg = shutil.which("ffmpeg")
+        stream = probe_video_stream(self.source_video_path) if ffmpeg and shutil.which("ffprobe") else None
+        if stream is None or stream["codec_name"] not in PASSTHROUGH_CODECS:
+            if workers > 1:
+                self.export_parallel(workers)
+            else:
+                self.export()
+            return {"copied_frames": 0, "encoded_frames": len(self.face_tracks), "reused_frames": 0}
+
+        encoder, bitstream_filter = PASSTHROUGH_CODECS[stream["codec_name"]]
+        packets = probe_packets(self.source_video_path)
+        frame_times = [pts_time for pts_time, _ in packets]
+        keyframes = [frame_number for frame_number, (_, is_keyframe) in enumerate(packets) if is_keyframe]
+        plans = [self.frame_blur_plan(frame_number) for frame_number in range(len(packets))]
+        runs = plan_passthrough(len(packets), keyframes, [len(strengths) > 0 for _, strengths in plans],
+                                max(1, round(self.fps * segment_seconds)))
+        # Everything a re-encoded segment depends on besides the blur of its frames
+        parameters = None
+        if self.segment_cache is not None:
+            parameters = {"version": SEGMENT_FORMAT_VERSION, "source": file_digest(self.source_video_path),
+                          "stream": stream, "encoder": encoder, "blur_style": self.blur_style}
+
+        statistics = {"copied_frames": 0, "encoded_frames": 0, "reused_frames": 0}
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.save_path))) as work_dir:
+            segment_paths = []
+            for index, (start, end, reencode) in enumerate(runs):
+                segment_path = os.path.join(work_dir, f"segment_{index:05d}{SEGMENT_FILE_SUFFIX}")
+                if reencode:
+                    signature = None
+                    if parameters is not None:
+                        signature = segment_signature(plans[start:end], dict(parameters, start=start, end=end))
+                        cached_path = self.segment_cache.load(signature)
+                        if cached_path is not None:
+                            segment_paths.append(cached_path)
+                            statistics["reused_frames"] += end - start
+                            continue
+                    self.encode_segment(segment_path, start, end, frame_times[start], stream, encoder)
+                    if signature is not None:
+                        segment_path = self.segment_cache.store(segment_path, signature)
+                    statistics["encoded_frames"] += end - start
+                else:
+                    # Seeks slightly past the keyframe time, so rounding cannot land on the previous keyframe
+                    seek_time = frame_times[start] + 0.25 * (frame_times[min(start + 1, end - 1)] - frame_times[start])
+                    subprocess.run([ffmpeg, "-v", "error", "-y", "-ss", f"{seek_time:.6f}", "-copyts",
+                                    "-i", self.source_video_path, "-map", "0:v:0", "-frames:v", str(end - start),
+                                    "-c", "copy", "-bsf:v", bitstream_filter, "-muxdelay", "0", "-muxpreload", "0",
+                                    "-f", "mpegts", segment_path], check=True)
+                    statistics["copied_frames"] += end - start
+                segment_paths.append(segment_path)
+            # MPEG-TS segments carry their own timestamps and codec parameters, so they can be joined byte-wise
+            subprocess.run([ffmpeg, "-v", "error", "-y", "-i", "concat:" + "|".join(segment_paths),
+                            "-i", self.source_video_path, "-map", "0:v:0", "-map", "1:a?", "-c", "copy",
+                            self.save_path], check=True)
+        if self.segment_cache is not None:
+            self.segment_cache.evict()
+        return statistics
+
+    def encode_segment(self, segment_path, start, end, start_time, stream, encoder):
+        """
+        Decodes frames start:end, blurs them and encodes them into an MPEG-TS segment starting at start_time
+        """
+        width, height = stream["width"], stream["height"]
+        process = subprocess.Popen([shutil.which("ffmpeg"), "-v", "error", "-y",
+                                    "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+                                    "-r", stream["r_frame_rate"], "-i", "-",
+                                    "-c:v", encoder, "-crf", "18", "-pix_fmt", stream.get("pix_fmt") or "yuv420p",
+                                    "-output_ts_offset", f"{start_time:.6f}", "-muxdelay", "0", "-muxpreload", "0",
+                                    "-f", "mpegts", segment_path], stdin=subprocess.PIPE)
+        capture = open_video(self.source_video_path, start)
+        frame = None
+        try:
+            for frame_number in range(start, end):
+                # Decodes into the buffer of the previous frame, which has been written to ffmpeg
+                ret, frame = capture.read(frame)
+                if not ret:
+                    break
+                process.stdin.write(np.ascontiguousarray(self.blur_frame((frame_number, frame))).data)
+        finally:
+            capture.release()
+            process.stdin.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+
+
+def _export_segment(task):
+    source_video_path, segment_path, fourcc, fps, start, end, plan, blur_style = task
+    # A plain seek may land a few frames off, which would repeat or skip frames at the segment boundaries
+    capture = open_video(source_video_path, start)
+    video_dimensions = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    out = cv2.VideoWriter(segment_path, cv2.VideoWriter_fourcc(*fourcc), fps, video_dimensions)
+    frame_number = start
+    frame = None
+    while end is None or frame_number < end:
+        ret, frame = capture.read(frame)
+        if not ret:
+            break
+        if frame_number - start < len(plan):
+            boxes, strengths = plan[frame_number - start]
+            frame = blur_faces(frame, boxes, strengths, blur_style)
+        out.write(frame)
+        frame_number += 1
+    capture.release()
+    out.release()
+    return segment_path
+
+
+def concatenate_videos(paths, save_path, work_dir):
+    """
+    :param paths: list of str
+    :param save_path: str
+    :param work_dir: str
+    Joins videos with identical stream parameters using the ffmpeg concat demuxer and stream copy
+    """
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w") as file:
+        for path in paths:
+            file.write("file '{}'\n".format(os.path.abspath(path).replace("'", r"'\''")))
+    subprocess.run([shutil.which("ffmpeg"), "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", list_path,
+                    "-c", "copy", save_path], check=True)
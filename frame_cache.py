@@ -0,0 +1,173 @@
+import bisect
+import subprocess
+import threading
+from collections import OrderedDict
+
+import cv2
+
+from export import probe_keyframes
+
+
+def scale_to_fit(frame, size):
+    """
+    :param frame: np.ndarray
+    :param size: (width, height)
+    :return: frame: np.ndarray
+    Scales the frame down to fit into size keeping its aspect ratio, smaller frames are returned as they are
+    """
+    height, width = frame.shape[:2]
+    scale = min(size[0] / width, size[1] / height)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def cached_preview(frame, size):
+    """
+    :param frame: np.ndarray, decoded into a buffer which is reused for the next frame
+    :param size: (width, height)
+    :return: frame: np.ndarray, scaled to fit into size, owning its memory so it can be cached
+    """
+    preview = scale_to_fit(frame, size)
+    return preview.copy() if preview is frame else preview
+
+
+class KeyframeIndex(threading.Thread):
+    """
+    Frame numbers of the keyframes of a video, decoding any frame has to start from the keyframe before it.
+    ffprobe scans every packet of the file, so the index is built in the background once started,
+    frames are looked up without it until it is done.
+    """
+    def __init__(self, path_to_video):
+        super().__init__(name="keyframe-index", daemon=True)
+        self.path_to_video = path_to_video
+        self.keyframes = None
+
+    def run(self):
+        try:
+            self.keyframes = probe_keyframes(self.path_to_video)
+        except (OSError, ValueError, subprocess.SubprocessError):
+            # Files ffprobe cannot read are still decoded by OpenCV, only without the index
+            self.keyframes = None
+
+    def keyframe_before(self, frame_number):
+        """
+        :param frame_number: int
+        :return: keyframe: int, frame_number itself when the index is not available
+        """
+        if not self.keyframes:
+            return frame_number
+        return self.keyframes[max(0, bisect.bisect_right(self.keyframes, frame_number) - 1)]
+
+
+class FrameCache:
+    """
+    Thread-safe LRU cache of decoded frames bounded by memory size
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, frame_number):
+        with self.lock:
+            return frame_number in self.frames
+
+    def get(self, frame_number):
+        with self.lock:
+            frame = self.frames.get(frame_number)
+            if frame is not None:
+                self.frames.move_to_end(frame_number)
+            return frame
+
+    def put(self, frame_number, frame):
+        with self.lock:
+            if frame_number in self.frames:
+                self.size_bytes -= self.frames.pop(frame_number).nbytes
+            self.frames[frame_number] = frame
+            self.size_bytes += frame.nbytes
+            while self.size_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted_frame = self.frames.popitem(last=False)
+                self.size_bytes -= evicted_frame.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size_bytes = 0
+
+
+class FramePrefetcher(threading.Thread):
+    """
+    Background decoder keeping the frames around the playhead in a FrameCache.
+    Frames ahead of the playhead are decoded first, frames behind it are decoded forward from the keyframe before them.
+    """
+    def __init__(self, path_to_video, frame_cache, keyframe_index, preview_size, frames_count,
+                 frames_ahead=60, frames_behind=30):
+        super().__init__(daemon=True)
+        self.path_to_video = path_to_video
+        self.frame_cache = frame_cache
+        self.keyframe_index = keyframe_index
+        self.preview_size = preview_size
+        self.frames_count = frames_count
+        self.frames_ahead = frames_ahead
+        self.frames_behind = frames_behind
+        self.playhead = 0
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def set_playhead(self, frame_number):
+        if frame_number != self.playhead:
+            self.playhead = frame_number
+            self.wake_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def window(self, playhead):
+        return max(0, playhead - self.frames_behind), min(self.frames_count - 1, playhead + self.frames_ahead)
+
+    def next_missing_frame(self, playhead):
+        """
+        :return: (target, last): frames to decode, or None when the window is cached
+        """
+        low, high = self.window(playhead)
+        for frame_number in range(playhead, high + 1):
+            if frame_number not in self.frame_cache:
+                return frame_number, frame_number
+        for frame_number in range(playhead - 1, low - 1, -1):
+            if frame_number not in self.frame_cache:
+                # Decoding has to start at a keyframe anyway, so the whole run up to the playhead is filled at once
+                return frame_number, playhead - 1
+        return None
+
+    def run(self):
+        capture = cv2.VideoCapture(self.path_to_video)
+        position = 0
+        # Frames are decoded into a single buffer, only the scaled previews which are cached are allocated
+        frame = None
+        while not self.stop_event.is_set():
+            playhead = self.playhead
+            missing = self.next_missing_frame(playhead)
+            if missing is None:
+                self.wake_event.wait(0.1)
+                self.wake_event.clear()
+                continue
+            target, last = missing
+            start = self.keyframe_index.keyframe_before(target)
+            if not start <= position <= target:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+                position = start
+            low, high = self.window(playhead)
+            while position <= last and playhead == self.playhead and not self.stop_event.is_set():
+                ret, frame = capture.read(frame)
+                if not ret:
+                    self.frames_count = min(self.frames_count, position)
+                    frame = None
+                    break
+                if low <= position <= high and position not in self.frame_cache:
+                    self.frame_cache.put(position, cached_preview(frame, self.preview_size))
+                position += 1
+        capture.release()
@@ -0,0 +1,274 @@
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# Per-slot header fields, kept in the shared block so every process sees them
+_FRAME_NUMBER, _REFERENCES, _HEIGHT, _WIDTH = range(4)
+_HEADER_FIELDS = 4
+
+
+class SharedFrameRing:
+    """
+    Fixed ring of preallocated frame buffers in a single shared memory block, so frames are handed between
+    threads, or processes, by slot index and frame number instead of by copying or pickling arrays.
+    A producer acquires a free slot, decodes or copies a frame into its buffer and publishes it, every consumer
+    gets a zero-copy view of the slot and releases it once done, the slot is reused when all have released it.
+    Frames may have any shape up to max_frame_shape, views are always contiguous.
+    A shared ring can be passed to a child process when it is started, the creating process owns the memory.
+    Without shared the same buffers live in process memory, for consumers which are threads.
+    """
+    def __init__(self, max_frame_shape, slots=8, shared=True, context=None):
+        """
+        :param max_frame_shape: (height, width, channels) of the largest frame
+        :param slots: int
+        :param shared: bool, allocates the ring in shared memory and synchronises it across processes
+        :param context: multiprocessing context the consumer processes are started with, the default one when None
+        """
+        self.max_frame_shape = tuple(max_frame_shape)
+        self.slots = slots
+        self.slot_bytes = int(np.prod(self.max_frame_shape))
+        self.header_bytes = slots * _HEADER_FIELDS * np.dtype(np.int64).itemsize
+        size = self.header_bytes + slots * self.slot_bytes
+        if shared:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.condition = (context or multiprocessing.get_context()).Condition()
+        else:
+            self.memory = None
+            self.condition = threading.Condition()
+        self.owner = True
+        self.map_buffers(self.memory.buf if shared else bytearray(size))
+        self.header[:] = 0
+        self.header[:, _FRAME_NUMBER] = -1
+        self.next_slot = 0
+
+    def map_buffers(self, block):
+        self.header = np.ndarray((self.slots, _HEADER_FIELDS), dtype=np.int64, buffer=block)
+        self.buffers = [np.ndarray((self.slot_bytes,), dtype=np.uint8, buffer=block,
+                                   offset=self.header_bytes + slot * self.slot_bytes) for slot in range(self.slots)]
+
+    def __getstate__(self):
+        if self.memory is None:
+            raise TypeError("Only rings created with shared=True can be passed to other processes")
+        return {"max_frame_shape": self.max_frame_shape, "slots": self.slots, "name": self.memory.name,
+                "condition": self.condition}
+
+    def __setstate__(self, state):
+        self.max_frame_shape = state["max_frame_shape"]
+        self.slots = state["slots"]
+        self.slot_bytes = int(np.prod(self.max_frame_shape))
+        self.header_bytes = self.slots * _HEADER_FIELDS * np.dtype(np.int64).itemsize
+        # Child processes share the resource tracker of the owner, which unlinks the block only once
+        self.memory = shared_memory.SharedMemory(name=state["name"])
+        self.owner = False
+        self.condition = state["condition"]
+        self.map_buffers(self.memory.buf)
+        self.next_slot = 0
+
+    def acquire(self, timeout=None):
+        """
+        :param timeout: float or None, seconds to wait for a free slot, forever when None
+        :return: slot: int, None when no slot became free in time
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.find_free_slot() is not None, timeout):
+                return None
+            slot = self.find_free_slot()
+            self.header[slot, _REFERENCES] = 1
+            self.header[slot, _FRAME_NUMBER] = -1
+            self.next_slot = (slot + 1) % self.slots
+            return slot
+
+    def find_free_slot(self):
+        # Round robin from the last acquired slot, so recently released frames stay readable the longest
+        for offset in range(self.slots):
+            slot = (self.next_slot + offset) % self.slots
+            if self.header[slot, _REFERENCES] == 0:
+                return slot
+        return None
+
+    def buffer(self, slot, frame_shape):
+        """
+        :param slot: int, acquired by the caller
+        :param frame_shape: (height, width, channels), at most max_frame_shape
+        :return: buffer: np.ndarray of frame_shape to write the frame into, e.g. with VideoCapture.read
+        """
+        size = int(np.prod(frame_shape))
+        if size > self.slot_bytes:
+            raise ValueError(f"Frame of shape {frame_shape} does not fit into slots of {self.max_frame_shape}")
+        return self.buffers[slot][:size].reshape(frame_shape)
+
+    def publish(self, slot, frame_number, frame_shape, readers=1):
+        """
+        :param slot: int, acquired by the caller, whose reference passes to the readers
+        :param frame_number: int
+        :param frame_shape: (height, width, channels) written into the buffer
+        :param readers: int, number of consumers which will release the slot
+        """
+        with self.condition:
+            self.header[slot, _HEIGHT], self.header[slot, _WIDTH] = frame_shape[:2]
+            self.header[slot, _FRAME_NUMBER] = frame_number
+            self.header[slot, _REFERENCES] = readers
+            if readers <= 0:
+                self.condition.notify_all()
+
+    def write(self, frame, frame_number, readers=1, timeout=None):
+        """
+        :param frame: np.ndarray
+        :param frame_number: int
+        :param readers: int
+        :param timeout: float or None, see acquire
+        :return: slot: int, None when no slot became free in time and the frame was not written
+        """
+        slot = self.acquire(timeout)
+        if slot is None:
+            return None
+        np.copyto(self.buffer(slot, frame.shape), frame)
+        self.publish(slot, frame_number, frame.shape, readers)
+        return slot
+
+    def view(self, slot, frame_number):
+        """
+        :param slot: int
+        :param frame_number: int
+        :return: frame: np.ndarray viewing the slot, valid until the slot is released,
+        None when the slot does not hold this frame any more
+        """
+        if self.header[slot, _FRAME_NUMBER] != frame_number:
+            return None
+        shape = (int(self.header[slot, _HEIGHT]), int(self.header[slot, _WIDTH])) + self.max_frame_shape[2:]
+        return self.buffers[slot][:int(np.prod(shape))].reshape(shape)
+
+    def release(self, slot):
+        with self.condition:
+            if self.header[slot, _REFERENCES] > 0:
+                self.header[slot, _REFERENCES] -= 1
+            if self.header[slot, _REFERENCES] == 0:
+                self.condition.notify_all()
+
+    def release_all(self, slots):
+        """
+        :param slots: iterable of int
+        """
+        for slot in slots:
+            self.release(slot)
+
+    def free_slots(self):
+        with self.condition:
+            return int((self.header[:, _REFERENCES] == 0).sum())
+
+    def close(self):
+        """
+        Detaches the memory, and frees it in the creating process; views must not be used afterwards
+        """
+        self.header = None
+        self.buffers = []
+        if self.memory is None:
+            return
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def ring_frames(video_capture, ring, frames_count=None, start_frame=0, stop_event=None, first_frame=None):
+    """
+    :param video_capture: cv2.VideoCapture
+    :param ring: SharedFrameRing with slots as large as the frames
+    :param frames_count: int or None, reads until the end of the video when None
+    :param start_frame: int, frame number of the first decoded frame
+    :param stop_event: threading.Event or None, stops waiting for a free slot and decoding once set
+    :param first_frame: np.ndarray or None, frame already decoded from video_capture, e.g. by frame_ring_for,
+    yielded before the next decoded ones
+    :return: generator of (slot, frame_number, frame): frames are decoded straight into the slots,
+    which the consumer releases once done with them
+    """
+    frame_shape = video_frame_shape(video_capture)
+    frame_number = start_frame
+    while frames_count is None or frame_number - start_frame < frames_count:
+        slot = _acquire_slot(ring, stop_event)
+        if slot is None:
+            return
+        if first_frame is not None:
+            frame_shape = first_frame.shape
+            buffer = ring.buffer(slot, frame_shape)
+            np.copyto(buffer, first_frame)
+            first_frame = None
+            ring.publish(slot, frame_number, frame_shape)
+            yield slot, frame_number, buffer
+            frame_number += 1
+            continue
+        buffer = ring.buffer(slot, frame_shape)
+        ret, frame = video_capture.read(buffer)
+        if not ret:
+            ring.release(slot)
+            return
+        if frame.ctypes.data != buffer.ctypes.data:
+            # Decoded into a new array when the container reported another frame size
+            frame_shape = frame.shape
+            buffer = ring.buffer(slot, frame_shape)
+            np.copyto(buffer, frame)
+        ring.publish(slot, frame_number, frame_shape)
+        yield slot, frame_number, buffer
+        frame_number += 1
+
+
+def _acquire_slot(ring, stop_event):
+    # Polls the stop event like the pipeline queues do, so a closed pipeline does not leave its source waiting
+    # forever for slots which the stopped stages will never release
+    while stop_event is None or not stop_event.is_set():
+        slot = ring.acquire(timeout=0.1)
+        if slot is not None:
+            return slot
+    return None
+
+
+def ring_frame_batches(video_capture, ring, batch_size, frames_count=None, stop_event=None, first_frame=None):
+    """
+    :param video_capture: cv2.VideoCapture
+    :param ring: SharedFrameRing with at least batch_size slots
+    :param batch_size: int
+    :param frames_count: int or None
+    :param stop_event: threading.Event or None, see ring_frames
+    :param first_frame: np.ndarray or None, see ring_frames
+    :return: generator of (slots, frames), lists like the batches of frame_batches but viewing the slots
+    of the ring, which the consumer releases once done with the batch
+    """
+    if ring.slots < batch_size:
+        raise ValueError(f"A ring of {ring.slots} slots cannot hold batches of {batch_size} frames")
+    slots, frames = [], []
+    for slot, _, frame in ring_frames(video_capture, ring, frames_count, stop_event=stop_event,
+                                      first_frame=first_frame):
+        slots.append(slot)
+        frames.append(frame)
+        if len(frames) == batch_size:
+            yield slots, frames
+            slots, frames = [], []
+    if frames:
+        yield slots, frames
+
+
+def frame_ring_for(video_capture, slots, shared=False):
+    """
+    :param video_capture: cv2.VideoCapture
+    :param slots: int
+    :param shared: bool, see SharedFrameRing
+    :return: (ring, first_frame): SharedFrameRing with slots as large as the frames of the video,
+    and the first frame when the container does not report the frame size and it had to be decoded to learn it,
+    which is to be passed on to ring_frames, None otherwise
+    """
+    frame_shape = video_frame_shape(video_capture)
+    first_frame = None
+    if not all(frame_shape):
+        ret, first_frame = video_capture.read()
+        if ret:
+            frame_shape = first_frame.shape
+        else:
+            first_frame = None
+            frame_shape = (1, 1, 3)
+    return SharedFrameRing(frame_shape, slots, shared), first_frame
+
+
+def video_frame_shape(video_capture):
+    return (int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
@@ -1,7 +1,8 @@
+import os
 import time
 from pathlib import Path
 import numpy as np
-from PyQt6.QtCore import (QThread, pyqtSignal, Qt)
+from PyQt6.QtCore import (QThread, QTimer, pyqtSignal, Qt)
 from PyQt6.QtGui import (QImage, QPixmap, QAction)
 
 from PyQt6.QtWidgets import (QWidget, QMainWindow, QGridLayout, QVBoxLayout, QHBoxLayout,
@@ -9,7 +10,17 @@ from PyQt6.QtWidgets import (QWidget, QMainWindow, QGridLayout, QVBoxLayout, QHB
 import sys
 
 import cv2
-from blurring_faces import FaceTracksFinder, blur_face
+from blurring_faces import FaceTracksFinder, track_cache_parameters, BLUR_MODES, BLUR_GAUSSIAN
+from checkpoint import CheckpointStore
+from export import SegmentCache, VideoExporter
+from frame_cache import FrameCache, FramePrefetcher, KeyframeIndex, cached_preview
+from model_warmup import ModelWarmup
+from preview_rendering import FrameRing, PreviewQueue, render_preview, view_to_frame
+from profiling import profiler_from_environment
+from track_cache import TrackCache
+from track_store import TrackStore
+from track_postprocessing import TrackPostprocessor
+from tracker import TRACKING_DEEPSORT
 
 
 class MainWindow(QMainWindow):
@@ -23,7 +34,7 @@ class MainWindow(QMainWindow):
         self.is_video_loaded = False
         self.is_video_changed = False
         self.video_path = None
-        self.face_tracks = []
+        self.face_tracks = TrackStore()
         self.face_tracker = FaceTracksDetector()
         self.current_frame_number = 0
         self.current_frame = None
@@ -32,8 +43,10 @@ class MainWindow(QMainWindow):
         self.video_player_dims = (800, 800)
         self.selected_ids = []
         self.blur_mode = 0
+        self.blur_style = BLUR_GAUSSIAN
         self.last_selected = 0
         self.id_to_blur_intensity = dict()
+        self.export_workers = os.cpu_count() or 1
         self.setWindowTitle("FacialAutoBlur")
 
         # Grid layout
@@ -101,6 +114,11 @@ class MainWindow(QMainWindow):
         self.blurring_mode_combobox.addItems(["BLUR ALL", "BLUR SELECTED"])
         self.blurring_mode_combobox.currentIndexChanged.connect(self.change_blurring_mode)
 
+        # Blurring style combobox
+        self.blurring_style_combobox = QComboBox(self)
+        self.blurring_style_combobox.addItems([style.upper() for style in BLUR_MODES])
+        self.blurring_style_combobox.currentIndexChanged.connect(self.change_blurring_style)
+
         self.general_layout.addLayout(self.video_player_layout, 0, 0)
         self.general_layout.addLayout(self.right_buttons_layout, 0, 1)
         self.general_layout.addLayout(self.slider_background_layout, 1, 0)
@@ -113,6 +131,8 @@ class MainWindow(QMainWindow):
         self.right_buttons_layout.addWidget(self.face_tracks_progressbar)
         self.right_buttons_layout.addWidget(QLabel("MODE:"))
         self.right_buttons_layout.addWidget(self.blurring_mode_combobox)
+        self.right_buttons_layout.addWidget(QLabel("STYLE:"))
+        self.right_buttons_layout.addWidget(self.blurring_style_combobox)
         self.right_buttons_layout.addWidget(QLabel("BLUR INTENSITY:"))
         self.right_buttons_layout.addWidget(self.blurring_slider)
         self.right_buttons_layout.addWidget(self.save_video)
@@ -132,14 +152,33 @@ class MainWindow(QMainWindow):
         self.layout_widget.setLayout(self.general_layout)
         self.setCentralWidget(self.layout_widget)
 
+        self.preview_renderer = PreviewRenderThread(self.video_player_dims)
+        self.preview_renderer.face_tracks = self.face_tracks
+        self.preview_renderer.id_to_blur_intensity = self.id_to_blur_intensity
+        self.preview_renderer.PreviewUpdate.connect(self.update_pixmap_slot)
+        self.preview_renderer.start()
+
         self.video_player = VideoPlayerThread()
+        self.video_player.preview_size = self.video_player_dims
 
-        self.video_player.ImageUpdate.connect(self.update_pixmap_slot)
+        # Frames go straight from the player thread to the renderer, the GUI thread only gets finished previews
+        self.video_player.ImageUpdate.connect(self.preview_renderer.submit, Qt.ConnectionType.DirectConnection)
         self.video_player.FrameNumberUpdate.connect(self.update_frame_number)
         self.video_player.FrameDimensionsUpdate.connect(self.set_frame_dims)
         self.video_player.MaxFrameUpdate.connect(self.set_max_frame)
 
         self.video_writer = BlurringFacesThread()
+        # Connected once, every further connection would run the slots once more on each search
+        self.face_tracker.detected_face_tracks.connect(self.set_face_tracks)
+        self.face_tracker.detected_all_face_tracks.connect(self.set_all_face_tracks)
+        self.face_tracker.CurrentProcessedFrameUpdate.connect(self.update_face_finding_progressbar)
+        self.face_tracker.ProfilerUpdate.connect(self.show_profile)
+        self.video_writer.ProfilerUpdate.connect(self.show_profile)
+
+        # Models load while the user chooses a video, started once the window is shown
+        self.model_warmup = ModelWarmup(self.face_tracker.path_to_detector)
+        self.face_tracker.model_warmup = self.model_warmup
+        QTimer.singleShot(0, self.model_warmup.start)
         self.start_image = QImage(np.zeros(self.video_player_dims), *self.video_player_dims, QImage.Format.Format_RGB888)
         self.video_layout.setPixmap(QPixmap.fromImage(self.start_image))
 
@@ -147,6 +186,10 @@ class MainWindow(QMainWindow):
         self.blur_mode = blur_mode
         print(self.blur_mode)
 
+    def change_blurring_style(self, blur_style):
+        self.blur_style = BLUR_MODES[blur_style]
+        self.preview_renderer.blur_style = self.blur_style
+
     def change_blurring_intensity(self):
         self.id_to_blur_intensity[self.last_selected] = self.sender().value()
         print(self.last_selected)
@@ -155,25 +198,19 @@ class MainWindow(QMainWindow):
     def get_mouse_position(self, event):
 
         self.label.setText(f"{self.selected_ids} ")
-        if self.face_tracks:
-            aspect_ratio_x = self.frame_width / self.video_player_dims[0]
-            aspect_ratio_y = self.frame_height / self.video_player_dims[1]
-
-            mouse_x_pos = int(event.pos().x() * aspect_ratio_x)
-            mouse_y_pos = int(event.pos().y() * aspect_ratio_y)
-
-
-            for detection in self.face_tracks[self.current_frame_number]:
-                print(detection.id)
-                print(detection.bbox)
-                x1, y1, x2, y2 = detection.bbox
-                if x1 < mouse_x_pos < x2 and y1 < mouse_y_pos < y2:
-                    if detection.id not in self.selected_ids:
-                        self.selected_ids.append(detection.id)
-                        self.last_selected = detection.id
-                    else:
-                        self.selected_ids.remove(detection.id)
-                        self.last_selected = 0
+        frame_position = view_to_frame(event.pos().x(), event.pos().y(), (self.frame_width, self.frame_height),
+                                       self.video_player_dims)
+        if self.face_tracks and frame_position is not None:
+            mouse_x_pos, mouse_y_pos = frame_position
+
+            for detection_id in self.face_tracks.hit_test(self.current_frame_number, mouse_x_pos, mouse_y_pos):
+                print(detection_id)
+                if detection_id not in self.selected_ids:
+                    self.selected_ids.append(detection_id)
+                    self.last_selected = detection_id
+                else:
+                    self.selected_ids.remove(detection_id)
+                    self.last_selected = 0
 
     def write_video(self):
         destination, extension = self.get_path_to_save_video()
@@ -184,12 +221,16 @@ class MainWindow(QMainWindow):
             self.video_writer.save_path = destination
             self.video_writer.extension = extension
             self.video_writer.blur_mode = self.blur_mode
+            self.video_writer.blur_style = self.blur_style
+            self.video_writer.id_to_blur_intensity = dict(self.id_to_blur_intensity)
             self.video_writer.video_dimensions = (self.frame_width, self.frame_height)
+            self.video_writer.workers = self.export_workers
             self.video_writer.start()
 
     def set_frame_dims(self, width, height):
         self.frame_width = width
         self.frame_height = height
+        self.preview_renderer.source_width = width
 
     def set_max_frame(self, max_frame):
         self.slider.setMaximum(max_frame)
@@ -233,32 +274,31 @@ class MainWindow(QMainWindow):
         self.face_tracks.append(track)
         # print(tracks)
 
+    def set_all_face_tracks(self, tracks):
+        self.face_tracks = TrackStore.from_tracks(tracks)
+        self.preview_renderer.face_tracks = self.face_tracks
+
     def update_face_finding_progressbar(self, processed_frames):
         self.slider.blockSignals(True)
         self.face_tracks_progressbar.setValue(processed_frames)
         self.slider.blockSignals(False)
 
-    def update_pixmap_slot(self, image, n):
-
-        if self.face_tracks:
-            if len(self.face_tracks) > n:
-                if self.face_tracks[n]:
+    def show_profile(self, snapshot):
+        stages = ", ".join(f"{stage} p50 {summary['p50_milliseconds']:.1f} ms p95 {summary['p95_milliseconds']:.1f} ms"
+                           for stage, summary in snapshot["stages"].items())
+        print(f"{snapshot['rolling_fps']:.1f} fps, {snapshot['detections_per_frame']:.2f} faces/frame, {stages}")
 
-                    detections = self.face_tracks[n]
-                    for detection in detections:
-                        x1, y1, x2, y2 = detection.bbox
-                        color = (255, 0, 0)
-                        if detection.id in self.id_to_blur_intensity.keys():
-                            color = (0, 255, 0)
-                        if detection.id in self.id_to_blur_intensity.keys():
-                            image = blur_face(image, detection.bbox, sigma=self.id_to_blur_intensity[detection.id])
-                        image = cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-                        image = cv2.putText(image, f"{detection.id}", ((int(x1) + int(x2)) // 2, int(y1) - 10),
-                                                                        cv2.FONT_HERSHEY_SIMPLEX, 2, color, 2)
+    def update_pixmap_slot(self, slot, n):
+        buffer = self.preview_renderer.ring.buffers[slot]
+        image = QImage(buffer.data, buffer.shape[1], buffer.shape[0], buffer.strides[0], QImage.Format.Format_RGB888)
+        # fromImage copies the pixels, so the buffer can go back to the renderer right away
+        self.video_layout.setPixmap(QPixmap.fromImage(image))
+        self.preview_renderer.release(slot)
 
-        resized = cv2.resize(image[:, :, ::-1], (800, 800))
-        final_image = QImage(resized, 800, 800, QImage.Format.Format_RGB888)
-        self.video_layout.setPixmap(QPixmap.fromImage(final_image))
+    def closeEvent(self, event):
+        self.preview_renderer.stop()
+        self.video_player.stop()
+        super().closeEvent(event)
 
     def get_path_to_source_video(self):
         file_name = QFileDialog.getOpenFileName(self, "Open File",
@@ -281,11 +321,11 @@ class MainWindow(QMainWindow):
         self.face_tracker.video_path = self.video_path
 
         self.face_tracker.start()
-        self.face_tracker.detected_face_tracks.connect(self.set_face_tracks)
-        self.face_tracker.CurrentProcessedFrameUpdate.connect(self.update_face_finding_progressbar)
 
 
 class BlurringFacesThread(QThread):
+    # Profiler snapshots while exporting, only with FACE_BLUR_PROFILE set
+    ProfilerUpdate = pyqtSignal(dict)
 
     def __init__(self):
         super().__init__()
@@ -293,31 +333,92 @@ class BlurringFacesThread(QThread):
         self.face_to_blur = None
         self.source_video_path = None
         self.save_path = None
-        self.extension = "mp4v"
+        self.extension = "mp4"
         self.blur_mode = 0
+        self.blur_style = BLUR_GAUSSIAN
+        self.id_to_blur_intensity = dict()
         self.video_dimensions = (0, 0)
+        self.max_queue_size = 8
+        self.workers = 1
+        self.passthrough = True
+        # Saving the same video again after changing the blurred faces re-encodes only the changed segments
+        self.segment_cache = SegmentCache()
+        self.exporter = None
+        self.profiler = profiler_from_environment(self.ProfilerUpdate.emit)
 
     def run(self):
         print(self.face_to_blur)
         print(self.save_path)
-        self.extension += "v"
-        capture = cv2.VideoCapture(self.source_video_path)
-        out = cv2.VideoWriter(self.save_path, cv2.VideoWriter_fourcc(*self.extension), 25, self.video_dimensions)
-
-        ret, frame = capture.read()
-        current_frame = 0
-        while ret:
-            detections = self.face_tracks[current_frame]
-            if detections:
-                for detection in detections:
-                    if self.blur_mode == 0:
-                        frame = blur_face(frame, detection.bbox)
-                    elif self.blur_mode == 1:
-                        if detection.id in self.face_to_blur:
-                            frame = blur_face(frame, detection.bbox)
-            out.write(frame)
-            current_frame += 1
-            ret, frame = capture.read()
+        self.exporter = VideoExporter(self.source_video_path, self.save_path, self.face_tracks, self.extension + "v",
+                                      blur_mode=self.blur_mode, face_to_blur=self.face_to_blur,
+                                      blur_style=self.blur_style, id_to_blur_intensity=self.id_to_blur_intensity,
+                                      max_queue_size=self.max_queue_size, profiler=self.profiler,
+                                      segment_cache=self.segment_cache)
+        self.profiler.reset()
+        start_time = time.perf_counter()
+        if self.passthrough:
+            self.exporter.export_passthrough(self.workers)
+        elif self.workers > 1:
+            self.exporter.export_parallel(self.workers)
+        else:
+            self.exporter.export()
+        if self.profiler.enabled:
+            self.profiler.record("export", time.perf_counter() - start_time)
+            self.ProfilerUpdate.emit(self.profiler.snapshot())
+            self.profiler.close()
+
+    def queue_depths(self):
+        if self.exporter is None or self.exporter.pipeline is None:
+            return {}
+        return self.exporter.pipeline.queue_depths()
+
+
+class PreviewRenderThread(QThread):
+    """
+    Renders preview frames with blurred faces and track overlays off the GUI thread.
+    Only the newest submitted frame waits for rendering, older ones are dropped when the GUI falls behind.
+    """
+    PreviewUpdate = pyqtSignal(int, int)
+
+    def __init__(self, view_size=(800, 800), slots=3):
+        super().__init__()
+        self.ring = FrameRing(view_size, slots)
+        self.queue = PreviewQueue(self.ring)
+        self.face_tracks = TrackStore()
+        self.id_to_blur_intensity = dict()
+        self.blur_style = BLUR_GAUSSIAN
+        self.source_width = 0
+        self.frames_rendered = 0
+
+    def submit(self, frame, frame_number):
+        """
+        Called from the player thread, replaces the frame still waiting for rendering
+        """
+        self.queue.submit(frame, frame_number)
+
+    def release(self, slot):
+        self.queue.release(slot)
+
+    def run(self):
+        while True:
+            taken = self.queue.take()
+            if taken is None:
+                return
+            frame, frame_number, slot = taken
+            render_preview(frame, frame_number, self.face_tracks, dict(self.id_to_blur_intensity), self.blur_style,
+                           self.source_width, self.ring, slot)
+            self.frames_rendered += 1
+            self.PreviewUpdate.emit(slot, frame_number)
+
+    def statistics(self):
+        """
+        :return: statistics: dict
+        """
+        return {"rendered_frames": self.frames_rendered, "dropped_frames": self.queue.frames_dropped}
+
+    def stop(self):
+        self.queue.close()
+        self.wait()
 
 
 class VideoPlayerThread(QThread):
@@ -338,10 +439,15 @@ class VideoPlayerThread(QThread):
         self.frame_width = 0
         self.frame_height = 0
         self.frame_time = 0
+        self.preview_size = (800, 800)
+        self.cache_size_bytes = 512 * 1024 * 1024
+        self.frame_cache = None
+        self.prefetcher = None
+        self.capture_position = 0
+        self.decode_buffer = None
 
     def run(self):
         capture = cv2.VideoCapture(self.video_path)
-        _, frame = capture.read()
 
         self.max_frames_in_video = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
         self.frame_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -350,27 +456,35 @@ class VideoPlayerThread(QThread):
         self.MaxFrameUpdate.emit(self.max_frames_in_video)
         self.FrameDimensionsUpdate.emit(self.frame_width, self.frame_height)
 
+        self.frame_cache = FrameCache(self.cache_size_bytes)
+        keyframe_index = KeyframeIndex(self.video_path)
+        # The first frames are shown while ffprobe still scans the file for keyframes
+        keyframe_index.start()
+        self.prefetcher = FramePrefetcher(self.video_path, self.frame_cache, keyframe_index,
+                                          self.preview_size, self.max_frames_in_video)
+        self.prefetcher.start()
+        self.capture_position = 0
+        frame = self.read_frame(capture, self.current_frame)
+
         while self.is_running and 0 <= self.current_frame < self.max_frames_in_video-1:
             start_time = time.time()
 
             if self.is_frame_changed:
-                capture.set(1, self.current_frame)
                 self.is_frame_changed = False
                 self.is_frame_updated = False
                 self.FrameNumberUpdate.emit(self.current_frame)
-                _, frame = capture.read()
+                frame = self.read_frame(capture, self.current_frame)
 
             if self.is_video_playing:
-                _, frame = capture.read()
-                img1 = frame
+                frame = self.read_frame(capture, self.current_frame)
 
                 self.FrameNumberUpdate.emit(self.current_frame)
-                self.ImageUpdate.emit(img1, self.current_frame)
+                if frame is not None:
+                    self.ImageUpdate.emit(frame, self.current_frame)
                 self.current_frame += 1
             else:
-                if not self.is_frame_updated:
-                    img2 = frame
-                    self.ImageUpdate.emit(img2, self.current_frame)
+                if not self.is_frame_updated and frame is not None:
+                    self.ImageUpdate.emit(frame, self.current_frame)
                     self.FrameNumberUpdate.emit(self.current_frame)
                     self.is_frame_updated = True
             current_frame_time = time.time() - start_time
@@ -378,9 +492,31 @@ class VideoPlayerThread(QThread):
                 time.sleep(np.abs(self.frame_time - current_frame_time))
             if self.current_frame >= self.max_frames_in_video - 1:
                 self.current_frame = self.max_frames_in_video - 1
+        self.prefetcher.stop()
+        capture.release()
+
+    def read_frame(self, capture, frame_number):
+        """
+        Returns the preview-sized frame from the cache, decoding it only when the prefetcher has not done it yet
+        """
+        frame = self.frame_cache.get(frame_number)
+        if frame is None:
+            if self.capture_position != frame_number:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            # Full frames are decoded into one reused buffer, only the cached preview is allocated
+            ret, full_frame = capture.read(self.decode_buffer)
+            self.capture_position = frame_number + 1
+            if ret:
+                self.decode_buffer = full_frame
+                frame = cached_preview(full_frame, self.preview_size)
+                self.frame_cache.put(frame_number, frame)
+        self.prefetcher.set_playhead(frame_number)
+        return frame
 
     def stop(self):
         self.is_running = False
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
         self.quit()
 
 
@@ -389,19 +525,56 @@ class FaceTracksDetector(QThread):
 
     """
     detected_face_tracks = pyqtSignal(list)
+    detected_all_face_tracks = pyqtSignal(object)
     CurrentProcessedFrameUpdate = pyqtSignal(int)
+    # Profiler snapshots while searching, only with FACE_BLUR_PROFILE set
+    ProfilerUpdate = pyqtSignal(dict)
 
     def __init__(self):
         super().__init__()
         self.video_path = None
+        self.path_to_detector = "best.pt"
+        self.detection_threshold = 0.5
+        self.tracking_mode = TRACKING_DEEPSORT
+        self.track_cache = TrackCache()
+        self.track_postprocessor = TrackPostprocessor()
+        self.checkpoints = CheckpointStore()
+        self.profiler = profiler_from_environment(self.ProfilerUpdate.emit)
+        self.model_warmup = None
         self.is_active = False
 
     def run(self):
         self.is_active = True
-        self.face_tracks_finder = FaceTracksFinder(self.video_path, "best.pt")
+        # The finder is built with the same settings, so its cache_parameters key the tracks stored below
+        search_settings = {"detection_threshold": self.detection_threshold, "tracking_mode": self.tracking_mode}
+        cached_face_tracks = self.track_cache.load(self.video_path, self.path_to_detector,
+                                                   **track_cache_parameters(**search_settings))
+        if cached_face_tracks is not None:
+            self.detected_all_face_tracks.emit(self.track_postprocessor(cached_face_tracks))
+            self.CurrentProcessedFrameUpdate.emit(len(cached_face_tracks))
+            return
+
+        detector, image_encoder = None, None
+        if self.model_warmup is not None:
+            # Waits for the models if the search starts before the warm-up is done
+            detector, image_encoder = self.model_warmup.result()
+        self.face_tracks_finder = FaceTracksFinder(self.video_path, self.path_to_detector, **search_settings,
+                                                   detector=detector, image_encoder=image_encoder,
+                                                   checkpoints=self.checkpoints, profiler=self.profiler)
+        self.profiler.reset()
+        # Frames restored from a checkpoint of an interrupted search come first
+        face_tracks = TrackStore()
         for detection in self.face_tracks_finder:
+            face_tracks.append(detection)
             self.detected_face_tracks.emit(detection)
             self.CurrentProcessedFrameUpdate.emit(self.face_tracks_finder.current_frame_number)
+        self.track_cache.store(face_tracks, self.video_path, self.path_to_detector,
+                               **self.face_tracks_finder.cache_parameters())
+        # Replaces the tracks shown while searching with the cleaned up ones
+        self.detected_all_face_tracks.emit(self.track_postprocessor(face_tracks))
+        if self.profiler.enabled:
+            self.ProfilerUpdate.emit(self.profiler.snapshot())
+            self.profiler.close()
 
     def stop(self):
         self.is_active = False
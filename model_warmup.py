@@ -0,0 +1,80 @@
+import threading
+import time
+
+import numpy as np
+
+from detector_backends import load_detector, DETECTOR_ULTRALYTICS
+from tracker import load_image_encoder
+
+
+class ModelWarmup(threading.Thread):
+    """
+    Loads the detector and the appearance encoder in the background and runs one inference of each on a blank
+    input, so the first search does not wait for imports, weights, graph compilation or allocator growth.
+    Started when the application opens, it runs while the user chooses a video.
+    """
+    def __init__(self, path_to_detector="best.pt", detector_backend=DETECTOR_ULTRALYTICS, detector_threads=None,
+                 load_encoder=True, input_size=640):
+        """
+        :param path_to_detector: str
+        :param detector_backend: one of DETECTOR_BACKENDS
+        :param detector_threads: int or None
+        :param load_encoder: bool, False when tracking does not need appearance features
+        :param input_size: int, size of the blank warm-up image
+        """
+        super().__init__(name="model-warmup", daemon=True)
+        self.path_to_detector = path_to_detector
+        self.detector_backend = detector_backend
+        self.detector_threads = detector_threads
+        self.load_encoder = load_encoder
+        self.input_size = input_size
+        self.detector = None
+        self.image_encoder = None
+        self.error = None
+        self.timings = {}
+        self.done = threading.Event()
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        # Both the GUI timer and a search waiting for the models may start the warm-up, whichever comes first
+        with self.start_lock:
+            if self.ident is None:
+                super().start()
+
+    def run(self):
+        try:
+            start_time = time.perf_counter()
+            self.detector = load_detector(self.path_to_detector, self.detector_backend,
+                                          threads=self.detector_threads)
+            self.timings["detector_load_seconds"] = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            self.detector([np.zeros((self.input_size, self.input_size, 3), dtype=np.uint8)])
+            self.timings["detector_warmup_seconds"] = time.perf_counter() - start_time
+            if self.load_encoder:
+                start_time = time.perf_counter()
+                self.image_encoder = load_image_encoder()
+                self.timings["encoder_load_seconds"] = time.perf_counter() - start_time
+                start_time = time.perf_counter()
+                self.image_encoder(np.zeros((1, *self.image_encoder.image_shape), dtype=np.uint8), 1)
+                self.timings["encoder_warmup_seconds"] = time.perf_counter() - start_time
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done.set()
+
+    def result(self, timeout=None):
+        """
+        :param timeout: float or None, seconds to wait for the warm-up, forever when None
+        :return: (detector, image_encoder), image_encoder is None without load_encoder
+        Starts the warm-up if it was not started yet, and raises the error it failed with
+        """
+        self.start()
+        if not self.done.wait(timeout):
+            raise TimeoutError("Models are still loading")
+        if self.error is not None:
+            raise self.error
+        return self.detector, self.image_encoder
+
+    @property
+    def ready(self):
+        return self.done.is_set() and self.error is None
@@ -0,0 +1,151 @@
+import queue
+import threading
+
+_END_OF_STREAM = object()
+
+
+class _StageFailure:
+    """
+    Carries an exception raised inside a stage down to the consumer
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+class PipelineStage(threading.Thread):
+    """
+    Pipeline worker which applies its function to every item of the input queue
+    """
+    def __init__(self, name, function, input_queue, output_queue, stop_event):
+        super().__init__(name=name, daemon=True)
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.stop_event = stop_event
+        self.processed_items = 0
+
+    def run(self):
+        while True:
+            item = _get(self.input_queue, self.stop_event)
+            if item is _END_OF_STREAM or isinstance(item, _StageFailure):
+                _put(self.output_queue, item, self.stop_event)
+                return
+            try:
+                item = self.function(item)
+            except Exception as error:
+                _put(self.output_queue, _StageFailure(error), self.stop_event)
+                return
+            self.processed_items += 1
+            if not _put(self.output_queue, item, self.stop_event):
+                return
+
+
+class SourceStage(threading.Thread):
+    """
+    Pipeline worker which pulls items from an iterable (usually a decoder)
+    """
+    def __init__(self, name, source, output_queue, stop_event):
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.output_queue = output_queue
+        self.stop_event = stop_event
+        self.processed_items = 0
+
+    def run(self):
+        try:
+            for item in self.source:
+                self.processed_items += 1
+                if not _put(self.output_queue, item, self.stop_event):
+                    return
+        except Exception as error:
+            _put(self.output_queue, _StageFailure(error), self.stop_event)
+            return
+        _put(self.output_queue, _END_OF_STREAM, self.stop_event)
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages each in its own thread.
+    Stages are connected by bounded queues, so a slow stage applies backpressure to the previous ones,
+    and every stage has a single worker, so items come out in the order the source produced them.
+    """
+    def __init__(self, source, stages, max_queue_size=4, source_name="decode", stop_event=None):
+        """
+        :param source: iterable
+        :param stages: list of (name, function) tuples
+        :param max_queue_size: int
+        :param source_name: str
+        :param stop_event: threading.Event set when the pipeline is closed, to share with a source which has to
+        notice it while waiting, e.g. for a free slot of a frame ring
+        """
+        self.stop_event = stop_event or threading.Event()
+        self.queues = []
+        self.workers = []
+
+        output_queue = queue.Queue(max_queue_size)
+        self.queues.append((source_name, output_queue))
+        self.workers.append(SourceStage(source_name, source, output_queue, self.stop_event))
+        for name, function in stages:
+            input_queue = output_queue
+            output_queue = queue.Queue(max_queue_size)
+            self.queues.append((name, output_queue))
+            self.workers.append(PipelineStage(name, function, input_queue, output_queue, self.stop_event))
+        self.output_queue = output_queue
+        self.is_started = False
+        self.is_finished = False
+
+    def start(self):
+        if not self.is_started:
+            self.is_started = True
+            for worker in self.workers:
+                worker.start()
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.is_finished:
+            raise StopIteration
+        self.start()
+        item = self.output_queue.get()
+        if item is _END_OF_STREAM:
+            self.is_finished = True
+            raise StopIteration
+        if isinstance(item, _StageFailure):
+            self.close()
+            raise item.error
+        return item
+
+    def queue_depths(self):
+        """
+        :return: depths: dict
+        Returns the number of items waiting in the output queue of every stage
+        """
+        return {name: stage_queue.qsize() for name, stage_queue in self.queues}
+
+    def close(self):
+        self.is_finished = True
+        self.stop_event.set()
+        for worker in self.workers:
+            if worker.is_alive() and worker is not threading.current_thread():
+                worker.join(timeout=1)
+
+
+def _put(target_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(source_queue, stop_event):
+    while not stop_event.is_set():
+        try:
+            return source_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END_OF_STREAM
@@ -0,0 +1,161 @@
+import threading
+
+import cv2
+import numpy as np
+
+from blurring_faces import blur_faces
+
+SELECTED_COLOR = (0, 255, 0)
+UNSELECTED_COLOR = (255, 0, 0)
+
+
+def letterbox(frame_size, view_size):
+    """
+    :param frame_size: (width, height) of the source video
+    :param view_size: (width, height) of the preview
+    :return: (x, y, width, height) of the largest rectangle with the frame aspect ratio centered in the view
+    """
+    frame_width, frame_height = frame_size
+    view_width, view_height = view_size
+    if frame_width <= 0 or frame_height <= 0:
+        return 0, 0, view_width, view_height
+    scale = min(view_width / frame_width, view_height / frame_height)
+    width = max(1, round(frame_width * scale))
+    height = max(1, round(frame_height * scale))
+    return (view_width - width) // 2, (view_height - height) // 2, width, height
+
+
+def view_to_frame(x, y, frame_size, view_size):
+    """
+    :param x: int, position in the preview
+    :param y: int, position in the preview
+    :param frame_size: (width, height) of the source video
+    :param view_size: (width, height) of the preview
+    :return: (x, y) position in the source video, None on the letterbox bars
+    """
+    left, top, width, height = letterbox(frame_size, view_size)
+    if not (left <= x < left + width and top <= y < top + height):
+        return None
+    return int((x - left) * frame_size[0] / width), int((y - top) * frame_size[1] / height)
+
+
+class FrameRing:
+    """
+    Fixed set of reusable RGB preview buffers handed from the renderer to the GUI.
+    A buffer is acquired by the renderer and released by the GUI once it has been copied into a pixmap,
+    when all buffers are still held by the GUI the renderer has to drop the frame.
+    """
+    def __init__(self, view_size, slots=3):
+        self.buffers = [np.zeros((view_size[1], view_size[0], 3), dtype=np.uint8) for _ in range(slots)]
+        self.geometries = [None] * slots
+        self.free_slots = list(range(slots))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        :return: slot: int, None when every buffer is in use
+        """
+        with self.lock:
+            return self.free_slots.pop(0) if self.free_slots else None
+
+    def release(self, slot):
+        with self.lock:
+            if slot not in self.free_slots:
+                self.free_slots.append(slot)
+
+
+class PreviewQueue:
+    """
+    Hand-off of frames from the player to the renderer over a FrameRing.
+    Only the newest submitted frame waits for rendering, older ones are dropped when the renderer falls behind,
+    and a frame is only taken once the GUI has released a buffer to render it into.
+    """
+    def __init__(self, ring):
+        """
+        :param ring: FrameRing
+        """
+        self.ring = ring
+        self.pending_frame = None
+        self.condition = threading.Condition()
+        self.is_open = True
+        self.frames_dropped = 0
+
+    def submit(self, frame, frame_number):
+        """
+        :param frame: np.ndarray
+        :param frame_number: int
+        Replaces the frame still waiting for rendering
+        """
+        with self.condition:
+            if self.pending_frame is not None:
+                self.frames_dropped += 1
+            self.pending_frame = (frame, frame_number)
+            self.condition.notify()
+
+    def release(self, slot):
+        with self.condition:
+            self.ring.release(slot)
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        """
+        :param timeout: float or None, seconds to wait, None waits until a frame can be rendered or the queue is closed
+        :return: (frame, frame_number, slot), None when the queue is closed or the timeout expired
+        """
+        with self.condition:
+            # Waits for a frame and for a buffer the GUI is not holding
+            if not self.condition.wait_for(lambda: not self.is_open or (self.pending_frame is not None
+                                                                         and self.ring.free_slots), timeout):
+                return None
+            if not self.is_open:
+                return None
+            frame, frame_number = self.pending_frame
+            self.pending_frame = None
+            return frame, frame_number, self.ring.acquire()
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+
+def render_preview(frame, frame_number, face_tracks, id_to_blur_intensity, blur_style, source_width, ring, slot):
+    """
+    :param frame: np.ndarray, BGR frame of any size with the aspect ratio of the source video
+    :param frame_number: int
+    :param face_tracks: TrackStore in source video coordinates
+    :param id_to_blur_intensity: dict
+    :param blur_style: one of BLUR_MODES
+    :param source_width: int, width of the source video
+    :param ring: FrameRing
+    :param slot: int, buffer of the ring to render into
+    Scales the frame into the letterboxed preview, then blurs and outlines the faces at preview resolution,
+    so the cost does not depend on the source resolution
+    """
+    buffer = ring.buffers[slot]
+    view_size = (buffer.shape[1], buffer.shape[0])
+    left, top, width, height = letterbox((frame.shape[1], frame.shape[0]), view_size)
+    if ring.geometries[slot] != (left, top, width, height):
+        buffer.fill(0)
+        ring.geometries[slot] = (left, top, width, height)
+    if (width, height) == (frame.shape[1], frame.shape[0]):
+        image = frame.copy()
+    else:
+        image = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+    if len(face_tracks) > frame_number:
+        ids, boxes = face_tracks.frame(frame_number)
+        boxes = boxes * (width / source_width if source_width else 1.0)
+        ids = ids.tolist()
+        blurred_rows = [row for row, detection_id in enumerate(ids) if detection_id in id_to_blur_intensity]
+        image = blur_faces(image, boxes[blurred_rows], [id_to_blur_intensity[ids[row]] for row in blurred_rows],
+                           blur_style)
+        font_scale = max(0.5, 2 * width / source_width) if source_width else 0.5
+        for detection_id, bbox in zip(ids, boxes):
+            x1, y1, x2, y2 = (int(value) for value in bbox)
+            color = SELECTED_COLOR if detection_id in id_to_blur_intensity else UNSELECTED_COLOR
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+            cv2.putText(image, f"{detection_id}", ((x1 + x2) // 2, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                        font_scale, color, 2)
+
+    buffer[top:top + height, left:left + width] = image[:, :, ::-1]
@@ -0,0 +1,239 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+PROFILE_ENVIRONMENT_VARIABLE = "FACE_BLUR_PROFILE"
+
+
+class LatencyHistogram:
+    """
+    Latencies in logarithmic buckets, four per octave from one microsecond, so percentiles are within 10 percent
+    whatever the number of samples, in constant memory
+    """
+    BUCKETS_PER_OCTAVE = 4
+    SMALLEST_LATENCY = 1e-6
+    BUCKETS = 120
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        if seconds > self.SMALLEST_LATENCY:
+            bucket = min(self.BUCKETS - 1, int(self.BUCKETS_PER_OCTAVE * math.log2(seconds / self.SMALLEST_LATENCY)))
+        else:
+            bucket = 0
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: float between 0 and 1
+        :return: seconds: float, geometric middle of the bucket holding the percentile
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(self.maximum, self.SMALLEST_LATENCY * 2 ** ((bucket + 0.5) / self.BUCKETS_PER_OCTAVE))
+        return self.maximum
+
+    def summary(self):
+        return {"count": self.count,
+                "mean_milliseconds": 1000 * self.total / max(1, self.count),
+                "p50_milliseconds": 1000 * self.percentile(0.5),
+                "p95_milliseconds": 1000 * self.percentile(0.95),
+                "p99_milliseconds": 1000 * self.percentile(0.99),
+                "max_milliseconds": 1000 * self.maximum,
+                "total_seconds": self.total}
+
+
+class Profiler:
+    """
+    Per-stage latency histograms, rolling frames/sec, detections per frame and peak memory of a run.
+    Stages are instrumented by wrapping their functions and iterables with timed and iterate, which return them
+    unchanged when the profiler is disabled, so a disabled profiler costs nothing in the stages themselves
+    and a single attribute check per frame.
+    """
+    def __init__(self, enabled=True, trace_path=None, on_update=None, update_interval=1.0, fps_window=2.0):
+        """
+        :param enabled: bool
+        :param trace_path: str or None, every measurement is appended there as a JSON line
+        :param on_update: callable taking the snapshot dict, called from frame at most every update_interval seconds,
+        e.g. the emit of a Qt signal
+        :param update_interval: float, seconds
+        :param fps_window: float, seconds of frames the rolling frames/sec is computed over
+        """
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.on_update = on_update
+        self.update_interval = update_interval
+        self.fps_window = fps_window
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        self.frames = 0
+        self.detections = 0
+        self.frame_times = deque()
+        self.start_time = time.perf_counter()
+        self.last_update = self.start_time
+
+    def record(self, stage, seconds):
+        """
+        :param stage: str
+        :param seconds: float
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.add(seconds)
+            if self.trace_path is not None:
+                self.trace({"stage": stage, "milliseconds": 1000 * seconds})
+
+    def timed(self, stage, function):
+        """
+        :param stage: str
+        :param function: callable
+        :return: function recording the latency of every call as stage, function itself when disabled
+        """
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start_time)
+        return timed_function
+
+    def iterate(self, stage, iterable):
+        """
+        :param stage: str
+        :param iterable: iterable, e.g. decoded frames
+        :return: iterable recording the time of producing every item as stage, iterable itself when disabled
+        """
+        if not self.enabled:
+            return iterable
+
+        def timed_items():
+            iterator = iter(iterable)
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - start_time)
+                yield item
+        return timed_items()
+
+    def frame(self, detections=0):
+        """
+        :param detections: int, faces found on the frame
+        Marks a frame as done, for frames/sec and detections per frame
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            self.frames += 1
+            self.detections += detections
+            self.frame_times.append(now)
+            while now - self.frame_times[0] > self.fps_window:
+                self.frame_times.popleft()
+            if self.trace_path is not None:
+                self.trace({"frame": self.frames, "detections": detections})
+        if self.on_update is not None and now - self.last_update >= self.update_interval:
+            self.last_update = now
+            self.on_update(self.snapshot())
+
+    def rolling_fps(self):
+        if len(self.frame_times) < 2 or self.frame_times[-1] == self.frame_times[0]:
+            return 0.0
+        return (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+
+    def snapshot(self):
+        """
+        :return: snapshot: dict of the measurements so far, stages maps every stage to its latency summary
+        """
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            return {"frames": self.frames,
+                    "elapsed_seconds": elapsed,
+                    "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+                    "rolling_fps": self.rolling_fps(),
+                    "detections_per_frame": self.detections / max(1, self.frames),
+                    "peak_memory_bytes": peak_memory_bytes(),
+                    "stages": {stage: histogram.summary() for stage, histogram in self.histograms.items()}}
+
+    def trace(self, event):
+        # Called with the lock held
+        if self.trace_file is None:
+            self.trace_file = open(self.trace_path, "a")
+        event["time"] = time.perf_counter() - self.start_time
+        self.trace_file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        """
+        Writes the final snapshot to the trace and closes it
+        """
+        if not self.enabled or self.trace_path is None:
+            return
+        snapshot = self.snapshot()
+        with self.lock:
+            self.trace({"snapshot": snapshot})
+            self.trace_file.close()
+            self.trace_file = None
+
+
+# Shared by everything created without a profiler
+DISABLED_PROFILER = Profiler(enabled=False)
+
+
+def profiler_from_environment(on_update=None):
+    """
+    :param on_update: callable, see Profiler
+    :return: Profiler, enabled when FACE_BLUR_PROFILE is set to 1 or to the path of a JSONL trace file
+    """
+    value = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "")
+    if value in ("", "0"):
+        return DISABLED_PROFILER
+    return Profiler(trace_path=None if value == "1" else value, on_update=on_update)
+
+
+def peak_memory_bytes():
+    """
+    :return: peak resident memory of the process in bytes, None when it cannot be read
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in kilobytes on Linux and in bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory_info = psutil.Process().memory_info()
+    return getattr(memory_info, "peak_wset", memory_info.rss)
@@ -0,0 +1,234 @@
+import os
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from blurring_faces import (detect_frames, track_detections_batch, iterate_frames, open_video, blur_faces,
+                            BLUR_GAUSSIAN, DEFAULT_BLUR_STRENGTH)
+from detector_backends import load_detector, DETECTOR_ULTRALYTICS
+from tracker import Tracker, TRACKING_DEEPSORT
+from track_store import DetectedObject
+
+
+def raw_frames(stream, width, height):
+    """
+    :param stream: binary file object, e.g. sys.stdin.buffer fed by ffmpeg -f rawvideo -pix_fmt bgr24 -
+    :param width: int
+    :param height: int
+    :return: generator of BGR frames, stops at the end of the stream
+    """
+    frame_size = width * height * 3
+    while True:
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        buffer = memoryview(frame).cast("B")
+        read = 0
+        while read < frame_size:
+            count = stream.readinto(buffer[read:])
+            if not count:
+                return
+            read += count
+        yield frame
+
+
+def follow_video_frames(path_to_video, poll_interval=0.5, idle_timeout=10.0):
+    """
+    :param path_to_video: str, a recording which may still be written, in a container readable while growing
+    :param poll_interval: float, seconds between checks for new data at the end of the file
+    :param idle_timeout: float, the recording is considered finished after this many seconds without growth
+    :return: generator of frames
+    Decodes the file like tail -f, reopening it past the last decoded frame whenever it grows,
+    see open_video for how it is positioned there
+    """
+    frame_number = 0
+    size = -1
+    idle_since = time.monotonic()
+    while True:
+        video_capture = open_video(path_to_video, frame_number)
+        for frame in iterate_frames(video_capture):
+            frame_number += 1
+            idle_since = time.monotonic()
+            yield frame
+        video_capture.release()
+        while True:
+            new_size = os.path.getsize(path_to_video)
+            if new_size != size:
+                size = new_size
+                break
+            if time.monotonic() - idle_since > idle_timeout:
+                return
+            time.sleep(poll_interval)
+
+
+class RawFrameWriter:
+    """
+    Writes BGR frames as raw video to a binary stream, e.g. sys.stdout.buffer piped into ffmpeg
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, frame):
+        self.stream.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.stream.flush()
+
+
+class LazyVideoWriter:
+    """
+    cv2.VideoWriter opened with the size of the first written frame, which a stream does not know in advance
+    """
+    def __init__(self, save_path, fourcc="mp4v", fps=25):
+        self.save_path = save_path
+        self.fourcc = fourcc
+        self.fps = fps
+        self.video_writer = None
+
+    def write(self, frame):
+        if self.video_writer is None:
+            self.video_writer = cv2.VideoWriter(self.save_path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                                                (frame.shape[1], frame.shape[0]))
+        self.video_writer.write(frame)
+
+    def release(self):
+        if self.video_writer is not None:
+            self.video_writer.release()
+
+
+class LookaheadTrackFilter:
+    """
+    Streaming counterpart of TrackPostprocessor: frames are held back for a few frames, enough to drop tracks
+    shorter than min_track_length and to fill gaps of up to max_gap frames, then released in order.
+    Only the window and the last box of recently seen tracks are kept, so memory does not grow with the video.
+    """
+    def __init__(self, min_track_length=3, max_gap=2):
+        self.min_track_length = min_track_length
+        self.max_gap = max_gap
+        self.lookahead = max(min_track_length, max_gap + 1)
+        self.window = deque()
+        self.observations = {}
+        self.last_seen = {}
+        self.frame_number = 0
+
+    def push(self, frame, detected_objects):
+        """
+        :param frame: np.ndarray
+        :param detected_objects: list of DetectedObject
+        :return: released: list of (frame, detected_objects) tuples
+        """
+        for detected_object in detected_objects:
+            self.observations[detected_object.id] = self.observations.get(detected_object.id, 0) + 1
+        self.window.append((frame, {detected_object.id: detected_object for detected_object in detected_objects}))
+        released = []
+        while len(self.window) > self.lookahead:
+            released.append(self.release())
+        return released
+
+    def flush(self):
+        """
+        :return: released: list of (frame, detected_objects) tuples, every frame still held back
+        """
+        released = []
+        while self.window:
+            released.append(self.release())
+        return released
+
+    def release(self):
+        frame, objects = self.window.popleft()
+        released_objects = [detected_object for track_id, detected_object in objects.items()
+                            if self.observations[track_id] >= self.min_track_length]
+        for track_id, (last_frame_number, last_box) in self.last_seen.items():
+            if track_id in objects:
+                continue
+            next_seen = self.next_seen(track_id, last_frame_number)
+            if next_seen is not None:
+                next_frame_number, next_box = next_seen
+                alpha = (self.frame_number - last_frame_number) / (next_frame_number - last_frame_number)
+                released_objects.append(DetectedObject(track_id, last_box * (1 - alpha) + next_box * alpha))
+
+        for detected_object in released_objects:
+            self.last_seen[detected_object.id] = (self.frame_number, np.asarray(detected_object.bbox, dtype=float))
+        self.forget(objects)
+        self.frame_number += 1
+        return frame, released_objects
+
+    def next_seen(self, track_id, last_frame_number):
+        """
+        :return: (frame_number, box) of the next frame in the window with the track, None when the gap is too long
+        """
+        for offset, (_, objects) in enumerate(self.window, 1):
+            frame_number = self.frame_number + offset
+            if frame_number - last_frame_number > self.max_gap + 1:
+                return None
+            if track_id in objects:
+                return frame_number, np.asarray(objects[track_id].bbox, dtype=float)
+        return None
+
+    def forget(self, objects):
+        # Tracks which cannot be gap-filled any more are dropped, observation counts only while a track is active
+        for track_id in [track_id for track_id, (frame_number, _) in self.last_seen.items()
+                         if self.frame_number - frame_number > self.max_gap]:
+            del self.last_seen[track_id]
+        active = set(self.last_seen)
+        for _, window_objects in self.window:
+            active.update(window_objects)
+        for track_id in [track_id for track_id in self.observations if track_id not in active]:
+            del self.observations[track_id]
+
+
+class StreamingBlurrer:
+    """
+    Detects, tracks, blurs and writes faces in a single pass over a stream of frames.
+    Memory is bounded by the detection batch and the lookahead window, whatever the length of the video.
+    """
+    def __init__(self, path_to_detector="best.pt", detection_threshold=0.5, tracking_mode=TRACKING_DEEPSORT,
+                 blur_style=BLUR_GAUSSIAN, blur_strength=DEFAULT_BLUR_STRENGTH, min_track_length=3, max_gap=2,
+                 batch_size=1, detector=None, image_encoder=None, detector_backend=DETECTOR_ULTRALYTICS,
+                 detector_threads=None):
+        self.detection_threshold = detection_threshold
+        self.blur_style = blur_style
+        self.blur_strength = blur_strength
+        self.min_track_length = min_track_length
+        self.max_gap = max_gap
+        self.batch_size = max(1, batch_size)
+        self.detector = detector or load_detector(path_to_detector, detector_backend, threads=detector_threads)
+        self.tracker = Tracker(tracking_mode, image_encoder)
+
+    def process(self, frames, video_writer):
+        """
+        :param frames: iterable of BGR frames, see raw_frames and follow_video_frames
+        :param video_writer: object with write(frame), see LazyVideoWriter and RawFrameWriter
+        :return: statistics: dict
+        """
+        track_filter = LookaheadTrackFilter(self.min_track_length, self.max_gap)
+        frames_count = 0
+        faces = set()
+        start_time = time.perf_counter()
+
+        def write(released):
+            for frame, detected_objects in released:
+                boxes = np.array([detected_object.bbox for detected_object in detected_objects]).reshape(-1, 4)
+                video_writer.write(blur_faces(frame, boxes, self.blur_strength, self.blur_style))
+                faces.update(detected_object.id for detected_object in detected_objects)
+
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) < self.batch_size:
+                continue
+            for frame_objects in zip(batch, self.track(batch)):
+                write(track_filter.push(*frame_objects))
+            frames_count += len(batch)
+            batch = []
+        if batch:
+            for frame_objects in zip(batch, self.track(batch)):
+                write(track_filter.push(*frame_objects))
+            frames_count += len(batch)
+        write(track_filter.flush())
+        elapsed = time.perf_counter() - start_time
+        return {"frames": frames_count, "faces": len(faces), "seconds": elapsed,
+                "fps": frames_count / elapsed if elapsed else 0.0}
+
+    def track(self, frames):
+        return track_detections_batch(self.tracker, detect_frames(self.detector, frames, self.detection_threshold))
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+
+from track_store import TrackStore
+
+CACHE_FORMAT_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "FaceAutoBlurring")
+CACHE_FILE_SUFFIX = ".tracks"
+
+_file_digests = {}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    :param path: str
+    :param chunk_size: int
+    :return: digest: str
+    Returns a content hash of the file, remembered while the file size and modification time stay the same
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_digests[memo_key] = digest.hexdigest()
+    return _file_digests[memo_key]
+
+
+def content_key(path_to_video, path_to_detector, **parameters):
+    """
+    :return: key: str
+    Returns a key for the content of a video and detector weights together with processing parameters
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps({"video": file_digest(path_to_video),
+                              "detector": file_digest(path_to_detector),
+                              "parameters": parameters}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class TrackCache:
+    """
+    Persistent on-disk cache of face tracks.
+    Entries are keyed by the content of the video and the detector weights together with the detection parameters,
+    so renaming or moving a file keeps its cache entry, while re-encoding it or changing the model does not.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_bytes=512 * 1024 * 1024):
+        """
+        :param cache_dir: str or None, None stores every entry next to its video
+        :param max_size_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+    def key(self, path_to_video, path_to_detector, **parameters):
+        """
+        :return: key: str
+        Returns the cache key for a video, detector weights and detection parameters
+        """
+        return content_key(path_to_video, path_to_detector, version=CACHE_FORMAT_VERSION, **parameters)
+
+    def entry_path(self, path_to_video, key):
+        if self.cache_dir is None:
+            directory, name = os.path.split(os.path.abspath(path_to_video))
+            return os.path.join(directory, f".{name}.{key[:16]}{CACHE_FILE_SUFFIX}")
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def load(self, path_to_video, path_to_detector, **parameters):
+        """
+        :return: tracks: TrackStore or None
+        Returns cached tracks, or None when the video was not processed with these weights and parameters
+        """
+        path = self.entry_path(path_to_video, self.key(path_to_video, path_to_detector, **parameters))
+        if not os.path.exists(path):
+            return None
+        try:
+            # Entries are read rather than mapped, so they can still be evicted while the tracks are in use
+            tracks = TrackStore.load(path, mmap=False)
+        except (OSError, ValueError):
+            return None
+        # Marks the entry as recently used for eviction
+        os.utime(path)
+        return tracks
+
+    def store(self, tracks, path_to_video, path_to_detector, **parameters):
+        """
+        :param tracks: TrackStore or list of lists of DetectedObject
+        :return: path: str
+        Writes tracks to the cache and evicts the least recently used entries above the size limit
+        """
+        path = self.entry_path(path_to_video, self.key(path_to_video, path_to_detector, **parameters))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        TrackStore.from_tracks(tracks).save(path)
+        self.evict(os.path.dirname(path), keep=path)
+        return path
+
+    def evict(self, directory=None, keep=None):
+        """
+        :param directory: str
+        :param keep: str, entry which must not be removed
+        Removes the least recently used entries until the directory fits into max_size_bytes
+        """
+        evict_least_recently_used(directory or self.cache_dir, CACHE_FILE_SUFFIX, self.max_size_bytes, keep)
+
+
+def evict_least_recently_used(directory, suffix, max_size_bytes, keep=None):
+    """
+    :param directory: str or None
+    :param suffix: str, only files with this suffix are cache entries
+    :param max_size_bytes: int
+    :param keep: str, entry which must not be removed
+    Removes the entries with the oldest modification time until the directory fits into max_size_bytes,
+    caches touch an entry whenever they use it
+    """
+    if directory is None or not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(suffix):
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_size <= max_size_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total_size -= size
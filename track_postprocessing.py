@@ -0,0 +1,91 @@
+import numpy as np
+
+from track_store import TrackStore
+
+
+class TrackPostprocessor:
+    """
+    Cleans up face tracks per track id, vectorized over the whole track table:
+    drops tracks seen on fewer than min_track_length frames, fills gaps of up to max_gap frames
+    by interpolating the boxes, and optionally smooths box jitter with a centered moving average
+    """
+    def __init__(self, min_track_length=3, max_gap=2, smoothing_window=0):
+        """
+        :param min_track_length: int
+        :param max_gap: int, longest run of missing frames which is filled
+        :param smoothing_window: int, moving average length in frames, 0 or 1 disables smoothing
+        """
+        self.min_track_length = min_track_length
+        self.max_gap = max_gap
+        self.smoothing_window = smoothing_window
+
+    def __call__(self, tracks):
+        """
+        :param tracks: TrackStore or list of lists of DetectedObject
+        :return: tracks: TrackStore
+        """
+        tracks = TrackStore.from_tracks(tracks)
+        frames_count = len(tracks)
+        if not len(tracks.ids):
+            return TrackStore(tracks.offsets.copy(), tracks.ids.copy(), tracks.boxes.copy(), tracks.scores.copy())
+        frame_numbers = tracks.frame_numbers()
+        # Single integer sort keys are several times faster to sort than np.lexsort
+        order = np.argsort(tracks.ids * (frames_count + 1) + frame_numbers)
+        ids = tracks.ids[order]
+        frame_numbers = frame_numbers[order]
+        boxes = tracks.boxes[order].astype(np.float64)
+        scores = tracks.scores[order]
+
+        track_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        track_lengths = np.diff(np.r_[track_starts, len(ids)])
+        kept = np.repeat(track_lengths >= self.min_track_length, track_lengths)
+        ids, frame_numbers, boxes, scores = ids[kept], frame_numbers[kept], boxes[kept], scores[kept]
+
+        if self.smoothing_window > 1 and len(ids):
+            boxes = smooth_boxes(ids, boxes, self.smoothing_window)
+        if self.max_gap > 0 and len(ids) > 1:
+            ids, frame_numbers, boxes, scores = fill_gaps(ids, frame_numbers, boxes, scores, self.max_gap)
+
+        order = np.argsort(frame_numbers * (int(ids.max(initial=0)) + 1) + ids)
+        offsets = np.zeros(frames_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(frame_numbers, minlength=frames_count), out=offsets[1:])
+        return TrackStore(offsets, ids[order], boxes[order], scores[order])
+
+
+def fill_gaps(ids, frame_numbers, boxes, scores, max_gap):
+    """
+    :return: (ids, frame_numbers, boxes, scores)
+    Appends linearly interpolated rows for runs of up to max_gap missing frames of the same track,
+    rows must be sorted by id and frame number
+    """
+    gaps = np.diff(frame_numbers)
+    fillable = np.flatnonzero((ids[1:] == ids[:-1]) & (gaps > 1) & (gaps <= max_gap + 1))
+    missing = gaps[fillable] - 1
+    if not len(fillable):
+        return ids, frame_numbers, boxes, scores
+    rows = np.repeat(fillable, missing)
+    steps = np.arange(len(rows)) - np.repeat(np.cumsum(missing) - missing, missing) + 1
+    alpha = (steps / gaps[rows])[:, None]
+    filled_boxes = boxes[rows] * (1 - alpha) + boxes[rows + 1] * alpha
+
+    ids = np.concatenate([ids, ids[rows]])
+    frame_numbers = np.concatenate([frame_numbers, frame_numbers[rows] + steps])
+    boxes = np.concatenate([boxes, filled_boxes])
+    scores = np.concatenate([scores, np.full(len(rows), np.nan, dtype=scores.dtype)])
+    return ids, frame_numbers, boxes, scores
+
+
+def smooth_boxes(ids, boxes, window):
+    """
+    :return: boxes: np.ndarray
+    Centered moving average of the boxes of every track, rows must be sorted by id and frame number
+    """
+    rows = np.arange(len(ids))
+    track_starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    track_ends = np.r_[track_starts[1:], len(ids)]
+    track_index = np.cumsum(np.r_[False, ids[1:] != ids[:-1]])
+    half_window = window // 2
+    low = np.maximum(rows - half_window, track_starts[track_index])
+    high = np.minimum(rows + half_window + 1, track_ends[track_index])
+    cumulative = np.vstack([np.zeros((1, 4)), np.cumsum(boxes, axis=0)])
+    return (cumulative[high] - cumulative[low]) / (high - low)[:, None]
@@ -0,0 +1,201 @@
+import os
+
+import numpy as np
+
+TRACK_STORE_ARRAYS = ("offsets", "ids", "boxes", "scores")
+
+
+class DetectedObject:
+    """
+    Reproduce detected object
+    """
+    __slots__ = ("id", "bbox", "score", "feature")
+
+    def __init__(self, object_id, object_bbox, score=None, feature=None):
+        self.id = object_id
+        self.bbox = object_bbox
+        self.score = score
+        self.feature = feature
+
+
+class TrackStore:
+    """
+    Columnar storage of face tracks.
+    Rows of all frames are kept in flat numpy columns (ids, boxes as x1, y1, x2, y2, and scores),
+    rows of frame i are offsets[i]:offsets[i + 1], like in a CSR matrix.
+    Indexing a store returns the frame as a list of DetectedObject views, so it can be used in place
+    of the list of per-frame lists returned by FaceTracksFinder.
+    """
+    def __init__(self, offsets=None, ids=None, boxes=None, scores=None):
+        if offsets is None:
+            offsets = np.zeros(1, dtype=np.int64)
+            ids = np.zeros(0, dtype=np.int64)
+            boxes = np.zeros((0, 4), dtype=np.float64)
+            scores = np.zeros(0, dtype=np.float32)
+        if scores is None:
+            scores = np.full(len(ids), np.nan, dtype=np.float32)
+        self._offsets = offsets
+        self._ids = ids
+        self._boxes = boxes
+        self._scores = scores
+        self._frames_count = len(offsets) - 1
+        self._rows_count = int(offsets[-1])
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        """
+        :param tracks: list of lists of DetectedObject
+        :return: TrackStore
+        """
+        if isinstance(tracks, TrackStore):
+            return tracks
+        store = cls()
+        for frame_tracks in tracks:
+            store.append(frame_tracks)
+        return store
+
+    @property
+    def offsets(self):
+        return self._offsets[:self._frames_count + 1]
+
+    @property
+    def ids(self):
+        return self._ids[:self._rows_count]
+
+    @property
+    def boxes(self):
+        return self._boxes[:self._rows_count]
+
+    @property
+    def scores(self):
+        return self._scores[:self._rows_count]
+
+    def __len__(self):
+        return self._frames_count
+
+    def __getitem__(self, frame_number):
+        if isinstance(frame_number, slice):
+            return [self[i] for i in range(*frame_number.indices(self._frames_count))]
+        if frame_number < 0:
+            frame_number += self._frames_count
+        if not 0 <= frame_number < self._frames_count:
+            raise IndexError("frame number out of range")
+        start, end = self._offsets[frame_number], self._offsets[frame_number + 1]
+        ids = self._ids[start:end].tolist()
+        scores = self._scores[start:end].tolist()
+        return [DetectedObject(ids[row], self._boxes[start + row], None if np.isnan(scores[row]) else scores[row])
+                for row in range(end - start)]
+
+    def __iter__(self):
+        for frame_number in range(self._frames_count):
+            yield self[frame_number]
+
+    def append(self, detected_objects):
+        """
+        :param detected_objects: list of DetectedObject
+        Adds the next frame to the store, columns grow geometrically so appending is amortized O(1)
+        """
+        count = len(detected_objects)
+        self._reserve(self._frames_count + 1, self._rows_count + count)
+        start = self._rows_count
+        for row, detected_object in enumerate(detected_objects, start):
+            self._ids[row] = detected_object.id
+            self._boxes[row] = detected_object.bbox
+            score = getattr(detected_object, "score", None)
+            self._scores[row] = np.nan if score is None else score
+        self._rows_count += count
+        self._frames_count += 1
+        self._offsets[self._frames_count] = self._rows_count
+
+    def _reserve(self, frames_count, rows_count):
+        if frames_count + 1 > len(self._offsets):
+            self._offsets = _grow(self._offsets, max(frames_count + 1, 2 * len(self._offsets)))
+        if rows_count > len(self._ids):
+            capacity = max(rows_count, 2 * len(self._ids), 16)
+            self._ids = _grow(self._ids, capacity)
+            self._boxes = _grow(self._boxes, capacity)
+            self._scores = _grow(self._scores, capacity)
+
+    def frame(self, frame_number):
+        """
+        :param frame_number: int
+        :return: (ids, boxes): np.ndarray views of the frame rows
+        """
+        start, end = self._offsets[frame_number], self._offsets[frame_number + 1]
+        return self._ids[start:end], self._boxes[start:end]
+
+    def frame_numbers(self):
+        """
+        :return: frame_numbers: np.ndarray
+        Returns the frame number of every row
+        """
+        return np.repeat(np.arange(self._frames_count, dtype=np.int64), np.diff(self.offsets))
+
+    def track_ids(self):
+        return np.unique(self.ids)
+
+    def select(self, track_id):
+        """
+        :param track_id: int
+        :return: (frame_numbers, boxes): np.ndarray
+        Returns every box of a single track across all frames
+        """
+        rows = np.flatnonzero(self.ids == track_id)
+        frame_numbers = np.searchsorted(self.offsets, rows, side="right") - 1
+        return frame_numbers, self.boxes[rows]
+
+    def hit_test(self, frame_number, x, y):
+        """
+        :param frame_number: int
+        :param x: float
+        :param y: float
+        :return: ids: list
+        Returns ids of the boxes of the frame which contain the point
+        """
+        if not 0 <= frame_number < self._frames_count:
+            return []
+        ids, boxes = self.frame(frame_number)
+        hits = (boxes[:, 0] < x) & (x < boxes[:, 2]) & (boxes[:, 1] < y) & (y < boxes[:, 3])
+        return ids[hits].tolist()
+
+    def save(self, path):
+        """
+        :param path: str
+        Writes all columns into a single binary file made of consecutive .npy records
+        """
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            for array in (self.offsets, self.ids, self.boxes, self.scores):
+                np.lib.format.write_array(file, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        :param path: str
+        :param mmap: bool, maps the columns read-only instead of reading them into memory
+        :return: TrackStore
+        """
+        arrays = []
+        with open(path, "rb") as file:
+            for _ in TRACK_STORE_ARRAYS:
+                version = np.lib.format.read_magic(file)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+                data_offset = file.tell()
+                count = int(np.prod(shape))
+                if mmap and count:
+                    array = np.memmap(path, dtype=dtype, mode="r", offset=data_offset, shape=shape)
+                else:
+                    array = np.fromfile(file, dtype=dtype, count=count).reshape(shape)
+                file.seek(data_offset + count * dtype.itemsize)
+                arrays.append(array)
+        return cls(*arrays)
+
+
+def _grow(array, capacity):
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
@@ -1,56 +1,351 @@
+import functools
+import time
+
 from deep_sort.deep_sort.tracker import Tracker as DeepSortTracker
-from deep_sort.tools import generate_detections
-from deep_sort.deep_sort import nn_matching
+from deep_sort.deep_sort import nn_matching, iou_matching, linear_assignment
 from deep_sort.deep_sort.detection import Detection
+from deep_sort.deep_sort.kalman_filter import KalmanFilter
+from deep_sort.deep_sort.track import Track as DeepSortTrack
 import numpy as np
 
+from profiling import DISABLED_PROFILER
+
+TRACKING_DEEPSORT = "deepsort"
+TRACKING_IOU = "iou"
+TRACKING_MODES = (TRACKING_DEEPSORT, TRACKING_IOU)
+ENCODER_MODEL_FILENAME = 'model_data\\mars-small128.pb'
+
+
+def load_image_encoder(model_filename=ENCODER_MODEL_FILENAME):
+    """
+    :param model_filename: str
+    :return: image_encoder: generate_detections.ImageEncoder
+    Loads the appearance encoder, which can be shared by several trackers
+    """
+    # Imported here, as it imports TensorFlow, which takes seconds and is not needed until tracking starts
+    from deep_sort.tools import generate_detections
+    return generate_detections.ImageEncoder(model_filename)
+
+
+def _valid_feature(feature):
+    # Detections created without a feature hold np.asarray(None), a 0-d NaN array
+    if feature is None or np.ndim(feature) != 1:
+        return None
+    return feature
+
 
 class Track:
     """
     Reproduce track
     """
-    def __init__(self, track_id, bounding_box):
+    def __init__(self, track_id, bounding_box, feature=None):
         self.track_id = track_id
         self.bounding_box = bounding_box
+        self.feature = feature
 
 
 class Tracker:
     """
     object tracker
     """
-    def __init__(self):
-
-        self.encoder_model_filename = 'model_data\\mars-small128.pb'
+    def __init__(self, mode=TRACKING_DEEPSORT, image_encoder=None, embedding_batch_size=32, profiler=None):
+        """
+        :param mode: TRACKING_DEEPSORT associates every detection by appearance and motion,
+        TRACKING_IOU associates by box overlap with the Kalman prediction
+        and computes appearance features only for ambiguous matches
+        :param image_encoder: loaded appearance encoder to share between trackers
+        :param embedding_batch_size: int
+        :param profiler: Profiler, records the embed and track stages
+        """
+        if mode not in TRACKING_MODES:
+            raise ValueError(f"Unknown tracking mode {mode}, expected one of {TRACKING_MODES}")
+        self.mode = mode
+        self.encoder_model_filename = ENCODER_MODEL_FILENAME
+        self.embedding_batch_size = embedding_batch_size
+        self.profiler = profiler or DISABLED_PROFILER
+        self.image_encoder = image_encoder or load_image_encoder(self.encoder_model_filename)
         self.metric = nn_matching.NearestNeighborDistanceMetric("cosine", 0.4, None)
-        self.tracker = DeepSortTracker(self.metric)
-        self.encoder = generate_detections.create_box_encoder(self.encoder_model_filename, batch_size=1)
+        if self.mode == TRACKING_DEEPSORT:
+            self.tracker = DeepSortTracker(self.metric)
+        else:
+            self.tracker = IouTracker(self.extract_features)
         self.tracks = None
+        self.frames_since_update = 0
+        self.frames_tracked = 0
+        self.tracking_time = 0.0
+        self.embedded_boxes = 0
+
+    def extract_features(self, frames, boxes_per_frame):
+        """
+        :param frames: list of np.ndarray
+        :param boxes_per_frame: list of arrays of [x, y, width, height] boxes
+        :return: features_per_frame: list of np.ndarray
+        Computes appearance features of the boxes of all frames in a single encoder call
+        """
+        from deep_sort.tools.generate_detections import extract_image_patch
+        start_time = time.perf_counter()
+        image_shape = self.image_encoder.image_shape
+        patches = []
+        for frame, boxes in zip(frames, boxes_per_frame):
+            for box in boxes:
+                patch = extract_image_patch(frame, box, image_shape[:2])
+                if patch is None:
+                    patch = np.random.uniform(0., 255., image_shape).astype(np.uint8)
+                patches.append(patch)
+        self.embedded_boxes += len(patches)
+        features = self.image_encoder(np.asarray(patches), self.embedding_batch_size) if patches else []
+        features_per_frame = []
+        start = 0
+        for boxes in boxes_per_frame:
+            features_per_frame.append(features[start:start + len(boxes)])
+            start += len(boxes)
+        self.profiler.record("embed", time.perf_counter() - start_time)
+        return features_per_frame
 
     def update(self, frame, detections):
-        if detections:
-            bounding_boxes = np.asarray([detection[:-1] for detection in detections])
-            bounding_boxes[:, 2:] = bounding_boxes[:, 2:] - bounding_boxes[:, 0:2]
-            scores = [detection[-1] for detection in detections]
+        self.update_batch([frame], [detections])
 
-            features = self.encoder(frame, bounding_boxes)
+    def update_batch(self, frames, detections_per_frame):
+        """
+        :param frames: list of np.ndarray
+        :param detections_per_frame: list of lists of [x1, y1, x2, y2, score]
+        :return: tracks_per_frame: list of lists of Track
+        Updates the tracker frame by frame, in deepsort mode the appearance features of all frames are computed at once.
+        Frames without detections do not update the tracker and get no tracks, like in update.
+        """
+        start_time = time.perf_counter()
+        boxes_per_frame = []
+        for detections in detections_per_frame:
+            bounding_boxes = np.asarray([detection[:-1] for detection in detections]).reshape(-1, 4)
+            bounding_boxes[:, 2:] = bounding_boxes[:, 2:] - bounding_boxes[:, 0:2]
+            boxes_per_frame.append(bounding_boxes)
+        features_per_frame = [None] * len(frames)
+        if self.mode == TRACKING_DEEPSORT:
+            features_per_frame = self.extract_features(frames, boxes_per_frame)
 
+        tracks_per_frame = []
+        for frame, detections, bounding_boxes, features in zip(frames, detections_per_frame, boxes_per_frame,
+                                                               features_per_frame):
+            if not detections:
+                tracks_per_frame.append([])
+                continue
+            scores = [detection[-1] for detection in detections]
             face_detections = []
             for bbox_id, bbox in enumerate(bounding_boxes):
-                face_detections.append(Detection(bbox, scores[bbox_id], features[bbox_id]))
+                feature = None if features is None else features[bbox_id]
+                face_detections.append(Detection(bbox, scores[bbox_id], feature))
 
             self.tracker.predict()
-            self.tracker.update(face_detections)
+            if self.mode == TRACKING_DEEPSORT:
+                self.tracker.update(face_detections)
+            else:
+                self.tracker.update(frame, face_detections)
+            self.frames_since_update = 0
             self.update_tracks()
+            tracks_per_frame.append(self.tracks)
+            self.frames_tracked += 1
+        elapsed = time.perf_counter() - start_time
+        self.tracking_time += elapsed
+        self.profiler.record("track", elapsed)
+        return tracks_per_frame
+
+    def predict(self):
+        """
+        :return: tracks: list of Track
+        Moves the tracks to their Kalman-predicted positions without a detection,
+        the tracks visible on the last updated frame stay visible
+        """
+        self.tracker.predict()
+        self.frames_since_update += 1
+        self.update_tracks()
+        return self.tracks
+
+    def updated_track_ids(self):
+        """
+        :return: track_ids: set of the ids of the tracks updated by the last detections, tentative ones included
+        """
+        return {track.track_id for track in self.tracker.tracks if track.time_since_update == 0}
+
+    def predicted_boxes(self):
+        """
+        :return: boxes: np.ndarray of [x1, y1, x2, y2]
+        Returns where the recently updated tracks, confirmed or not, are expected on the next frame,
+        without changing the tracker state
+        """
+        boxes = []
+        for track in self.tracker.tracks:
+            if track.time_since_update > 1 + self.frames_since_update:
+                continue
+            mean, _ = self.tracker.kf.predict(track.mean, track.covariance)
+            center_x, center_y, aspect_ratio, height = mean[:4]
+            width = aspect_ratio * height
+            boxes.append([center_x - width / 2, center_y - height / 2, center_x + width / 2, center_y + height / 2])
+        return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+    def prediction_uncertainty(self):
+        """
+        :return: uncertainty: float
+        Returns the largest predicted position standard deviation of a confirmed track relative to its height
+        """
+        uncertainty = 0.0
+        for track in self.tracker.tracks:
+            if track.is_confirmed():
+                position_deviation = np.sqrt(track.covariance[0, 0] + track.covariance[1, 1])
+                uncertainty = max(uncertainty, position_deviation / max(track.mean[3], 1.0))
+        return uncertainty
+
+    def state(self):
+        """
+        :return: state: dict
+        Returns everything needed to continue tracking later, without the appearance encoder, so it can be pickled
+        """
+        return {"mode": self.mode, "tracker": self.tracker, "frames_since_update": self.frames_since_update}
+
+    def restore_state(self, state):
+        """
+        :param state: dict returned by state
+        """
+        if state["mode"] != self.mode:
+            raise ValueError(f"Cannot restore a {state['mode']} tracker state in {self.mode} mode")
+        self.tracker = state["tracker"]
+        self.frames_since_update = state["frames_since_update"]
+        if self.mode == TRACKING_DEEPSORT:
+            self.metric = self.tracker.metric
+        else:
+            self.tracker.extract_features = self.extract_features
+        self.update_tracks()
 
     def update_tracks(self):
         tracks = []
         for track in self.tracker.tracks:
-            if not track.is_confirmed() or track.time_since_update > 1:
+            if not track.is_confirmed() or track.time_since_update > 1 + self.frames_since_update:
                 continue
             bounding_box = track.to_tlbr()
             track_id = track.track_id
-            tracks.append(Track(track_id, bounding_box))
+            tracks.append(Track(track_id, bounding_box, self.track_feature(track)))
 
         self.tracks = tracks
 
+    def track_feature(self, track):
+        if self.mode == TRACKING_IOU:
+            # Tracks restored from older checkpoints may still hold such a NaN feature
+            return _valid_feature(getattr(track, "last_feature", None))
+        samples = self.metric.samples.get(track.track_id)
+        return samples[-1] if samples else None
+
+    def statistics(self):
+        """
+        :return: statistics: dict
+        Returns tracking cost per frame and the number of embedded boxes
+        """
+        return {"mode": self.mode,
+                "frames": self.frames_tracked,
+                "milliseconds_per_frame": 1000 * self.tracking_time / max(1, self.frames_tracked),
+                "embedded_boxes": self.embedded_boxes}
+
+
+class IouTracker:
+    """
+    Lightweight multi-target tracker associating detections with Kalman-predicted tracks by box overlap.
+    Appearance features are computed only for detections overlapping several tracks (or tracks overlapping
+    several detections), where overlap alone cannot tell the targets apart.
+    """
+    def __init__(self, extract_features, max_iou_distance=0.7, max_age=70, n_init=3, max_cosine_distance=0.4):
+        self.extract_features = extract_features
+        self.max_iou_distance = max_iou_distance
+        self.max_age = max_age
+        self.n_init = n_init
+        self.max_cosine_distance = max_cosine_distance
+        self.kf = KalmanFilter()
+        self.tracks = []
+        self._next_id = 1
+
+    def __getstate__(self):
+        # extract_features is bound to the encoder of the owning Tracker, which restores it
+        state = self.__dict__.copy()
+        state["extract_features"] = None
+        return state
+
+    def predict(self):
+        for track in self.tracks:
+            track.predict(self.kf)
+
+    def update(self, frame, detections):
+        track_indices = list(range(len(self.tracks)))
+        detection_indices = list(range(len(detections)))
+        cost = self.iou_cost(self.tracks, detections, track_indices, detection_indices)
+        candidates = cost < self.max_iou_distance
+        ambiguous_detections = [j for j in detection_indices
+                                if candidates[:, j].sum() > 1 or any(candidates[i, j] and candidates[i].sum() > 1
+                                                                     for i in track_indices)]
+        ambiguous_tracks = [i for i in track_indices if candidates[i, ambiguous_detections].any()]
+        clear_detections = [j for j in detection_indices if j not in ambiguous_detections]
+        clear_tracks = [i for i in track_indices if i not in ambiguous_tracks]
+
+        matches, _, _ = linear_assignment.min_cost_matching(
+            self.iou_cost, self.max_iou_distance, self.tracks, detections, clear_tracks, clear_detections)
+        # Kept apart from the detections, whose feature is a NaN array when created without one
+        features = {}
+        if ambiguous_detections:
+            extracted = self.extract_features([frame], [[detections[j].tlwh for j in ambiguous_detections]])[0]
+            features = dict(zip(ambiguous_detections, extracted))
+            ambiguous_matches, _, _ = linear_assignment.min_cost_matching(
+                functools.partial(self.appearance_cost, features), self.max_iou_distance, self.tracks, detections,
+                ambiguous_tracks, ambiguous_detections)
+            matches += ambiguous_matches
+
+        matched_tracks = {i for i, _ in matches}
+        matched_detections = {j for _, j in matches}
+        for i, j in matches:
+            self.tracks[i].update(self.kf, detections[j])
+            self.tracks[i].features = []
+            if j in features:
+                self.tracks[i].last_feature = features[j]
+        for i in track_indices:
+            if i not in matched_tracks:
+                self.tracks[i].mark_missed()
+        for j in detection_indices:
+            if j not in matched_detections:
+                self.initiate_track(detections[j], features.get(j))
+        self.tracks = [track for track in self.tracks if not track.is_deleted()]
+
+    def iou_cost(self, tracks, detections, track_indices, detection_indices):
+        """
+        One minus box overlap of tracks and detections. Unlike iou_matching.iou_cost, tracks which were not
+        updated on the previous frame are not excluded, as they may have been predicted over skipped frames.
+        """
+        cost = np.ones((len(track_indices), len(detection_indices)))
+        if len(detection_indices):
+            candidates = np.asarray([detections[j].tlwh for j in detection_indices])
+            for row, i in enumerate(track_indices):
+                cost[row] = 1. - iou_matching.iou(tracks[i].to_tlwh(), candidates)
+        return cost
+
+    def appearance_cost(self, features, tracks, detections, track_indices, detection_indices):
+        """
+        :param features: dict of appearance features of the ambiguous detections by detection index
+        Overlap cost blended with the cosine distance to the last known appearance of the track
+        """
+        cost = self.iou_cost(tracks, detections, track_indices, detection_indices)
+        for row, i in enumerate(track_indices):
+            last_feature = _valid_feature(getattr(tracks[i], "last_feature", None))
+            if last_feature is None:
+                continue
+            for column, j in enumerate(detection_indices):
+                feature = _valid_feature(features.get(j))
+                if cost[row, column] >= self.max_iou_distance or feature is None:
+                    continue
+                cosine_distance = 1 - np.dot(last_feature, feature) / max(
+                    np.linalg.norm(last_feature) * np.linalg.norm(feature), 1e-12)
+                if cosine_distance > self.max_cosine_distance:
+                    cost[row, column] = linear_assignment.INFTY_COST
+                else:
+                    cost[row, column] = 0.5 * cost[row, column] + 0.5 * cosine_distance
+        return cost
 
+    def initiate_track(self, detection, feature=None):
+        mean, covariance = self.kf.initiate(detection.to_xyah())
+        track = DeepSortTrack(mean, covariance, self._next_id, self.n_init, self.max_age)
+        track.last_feature = feature
+        self.tracks.append(track)
+        self._next_id += 1